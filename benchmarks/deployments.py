@@ -0,0 +1,424 @@
+"""
+Throughput and latency of create/update/list/delete, driven through the API of create_app()
+
+    python benchmarks/deployments.py --stacks 1000 --clients 16
+    python benchmarks/deployments.py --kind vm --compare benchmarks/results/<earlier run>.json
+
+Needs no AWS account, network or pulumi CLI. The pulumi programs of the app run
+in-process under pulumi.runtime.set_mocks, and stack checkpoints are kept in a
+throwaway file:// backend. Everything else is the real app: routes, API tokens,
+job queue, stack locks, fingerprints, blob store and database. Only open_stack
+is replaced, because the automation API needs the engine to run a program.
+
+Results are written as JSON to benchmarks/results/ (or --output). --compare
+prints the change against an earlier result and exits with status 1 when a
+phase got slower or less productive than --tolerance allows.
+"""
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PHASES = ("create", "update", "list", "delete")
+
+
+class BenchmarkMocks:
+    """
+    Resource outputs the app reads from its programs, everything else echoes the inputs
+    """
+
+    def __init__(self):
+        # resource to a hash of its inputs, to tell updated resources from unchanged ones
+        self.resources = {}
+
+    def new_resource(self, args):
+        inputs = json.dumps(args.inputs, sort_keys=True, default=str)
+        self.resources[f"{args.typ}::{args.name}"] = hashlib.sha256(inputs.encode()).hexdigest()
+        outputs = dict(args.inputs)
+        if args.typ == "aws:s3/bucket:Bucket":
+            outputs["websiteEndpoint"] = f"{args.name}.s3-website.benchmark.local"
+        elif args.typ == "aws:ec2/instance:Instance":
+            outputs["publicIp"] = "203.0.113.10"
+            outputs["publicDns"] = f"{args.name}.compute.benchmark.local"
+        return [f"{args.name}-id", outputs]
+
+    def call(self, args):
+        # aws.ec2.get_ami of VMs without a pinned AMI
+        return {"id": "ami-0benchmark"}
+
+
+class OutputValue:
+    def __init__(self, value):
+        self.value = value
+
+
+class MockedStack:
+    """
+    The part of auto.Stack used by source.deployments, with checkpoints in a file backend layout
+    """
+
+    def __init__(self, backend: str, project: str, name: str, program):
+        self.name = name
+        self.workspace = self
+        self._program = program
+        self._path = os.path.join(backend, ".pulumi", "stacks", project, f"{name}.json")
+
+    def _load(self) -> dict:
+        with open(self._path) as file:
+            return json.load(file)
+
+    def _save(self, checkpoint: dict):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp_path = f"{self._path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(checkpoint, file)
+        os.replace(tmp_path, self._path)
+
+    @classmethod
+    def create(cls, backend: str, project: str, name: str, program):
+        import pulumi.automation as auto
+
+        stack = cls(backend, project, name, program)
+        if os.path.exists(stack._path):
+            raise auto.StackAlreadyExistsError(auto.CommandResult("", f"stack '{name}' already exists", 255))
+        stack._save({"config": {}, "outputs": {}})
+        return stack
+
+    @classmethod
+    def select(cls, backend: str, project: str, name: str, program):
+        import pulumi.automation as auto
+
+        stack = cls(backend, project, name, program)
+        if not os.path.exists(stack._path):
+            raise auto.StackNotFoundError(auto.CommandResult("", f"no stack named '{name}' found", 255))
+        return stack
+
+    def set_config(self, key: str, value):
+        checkpoint = self._load()
+        checkpoint["config"][key] = value.value
+        self._save(checkpoint)
+
+    @staticmethod
+    def _changes(previous: dict, resources: dict) -> dict:
+        changes = {
+            "create": sum(1 for name in resources if name not in previous),
+            "update": sum(1 for name in resources if name in previous and previous[name] != resources[name]),
+            "same": sum(1 for name in resources if previous.get(name) == resources[name]),
+            "delete": sum(1 for name in previous if name not in resources),
+        }
+        return {change: count for change, count in changes.items() if count}
+
+    def up(self, on_output=None):
+        outputs, resources = contextvars.Context().run(self._evaluate)
+        checkpoint = self._load()
+        changes = self._changes(checkpoint.get("resources", {}), resources)
+        checkpoint["outputs"] = outputs
+        checkpoint["resources"] = resources
+        checkpoint["updated"] = time.time()
+        self._save(checkpoint)
+        if on_output:
+            on_output(f"Updating ({self.name})")
+            on_output(f"Outputs: {', '.join(sorted(outputs))}")
+        return SimpleNamespace(summary=SimpleNamespace(resource_changes=changes))
+
+    def preview(self, on_output=None):
+        _, resources = contextvars.Context().run(self._evaluate)
+        changes = self._changes(self._load().get("resources", {}), resources)
+        if on_output:
+            on_output(f"Previewing update ({self.name})")
+        return SimpleNamespace(change_summary=changes)
+
+    def _evaluate(self) -> tuple:
+        import pulumi
+        from pulumi.runtime.settings import get_root_resource
+        from pulumi.runtime.stack import wait_for_rpcs
+
+        mocks = BenchmarkMocks()
+
+        async def run():
+            pulumi.runtime.set_mocks(mocks, project="benchmark", stack=self.name, preview=False)
+            self._program()
+            await wait_for_rpcs()
+            outputs = {
+                name: await pulumi.Output.from_input(value).future()
+                for name, value in get_root_resource().outputs.items()
+            }
+            return outputs, mocks.resources
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def outputs(self) -> dict:
+        return {name: OutputValue(value) for name, value in self._load()["outputs"].items()}
+
+    def destroy(self, on_output=None):
+        checkpoint = self._load()
+        deleted = len(checkpoint.pop("resources", []))
+        checkpoint["outputs"] = {}
+        self._save(checkpoint)
+        if on_output:
+            on_output(f"Destroying ({self.name})")
+        return SimpleNamespace(summary=SimpleNamespace(resource_changes={"delete": deleted} if deleted else {}))
+
+    def remove_stack(self, name: str):
+        os.remove(self._path)
+
+
+def build_app(workdir: str, workers: int):
+    backend = os.path.join(workdir, "backend")
+    os.makedirs(backend)
+    os.environ.update({
+        "SECRET_KEY": "benchmark",
+        "PROJECT_NAME": "benchmark",
+        "PULUMI_ORG": "benchmark",
+        "DEBUG": "False",
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(workdir, 'database.db')}",
+        "REDIS_URL": "",
+        "DEPLOY_WORKERS": str(workers),
+        "AMI_CACHE_PATH": os.path.join(workdir, "ami_cache.json"),
+        "BLOB_STORE_PATH": os.path.join(workdir, "blobs"),
+        "FETCH_CACHE_PATH": os.path.join(workdir, "fetch_cache.json"),
+        "COMPRESSION_CACHE_PATH": os.path.join(workdir, "compressed"),
+        "STACK_LOG_DIR": os.path.join(workdir, "logs"),
+        "PROFILE_DIR": os.path.join(workdir, "profiles"),
+        "PULUMI_BACKEND_URL": f"file://{backend}",
+        "PULUMI_CONFIG_PASSPHRASE": "benchmark",
+    })
+
+    from source import create_app, deployments, logger
+
+    # per-job info logs would dominate the measurement
+    logger.setLevel(logging.WARNING)
+    logging.getLogger("pulumi").setLevel(logging.WARNING)
+
+    @contextmanager
+    def open_stack(stack_name: str, program, create: bool = False):
+        opener = MockedStack.create if create else MockedStack.select
+        yield opener(backend, "benchmark", stack_name, program)
+
+    deployments.open_stack = open_stack
+    return create_app()
+
+
+def issue_tokens(app, clients: int) -> list:
+    from werkzeug.security import generate_password_hash
+
+    from source import database
+    from source.models import ApiTokens, User
+
+    tokens = []
+    with app.app_context():
+        for index in range(clients):
+            user = User(name=f"bench-{index}", email=f"bench-{index}@benchmark.local",
+                        password=generate_password_hash("benchmark"))
+            database.session.add(user)
+            database.session.flush()
+            api_token, token = ApiTokens.issue(user.id, "benchmark")
+            database.session.add(api_token)
+            tokens.append(token)
+        database.session.commit()
+    return tokens
+
+
+class Client:
+    """
+    One concurrent API client with its own user, test client and stacks
+    """
+
+    def __init__(self, app, token: str, kind: str, names: list, poll_interval: float):
+        self.http = app.test_client()
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.kind = kind
+        self.names = names
+        self.poll_interval = poll_interval
+
+    def _body(self, name: str, revision: int) -> dict:
+        if self.kind == "site":
+            return {"name": name, "content": f"<h1>{name} revision {revision}</h1>"}
+        # a new key changes the fingerprint, so every update redeploys
+        return {"name": name, "keydata": f"ssh-ed25519 AAAA{name}{revision} benchmark", "instance_type": "t2.micro"}
+
+    def _collection(self) -> str:
+        return "/api/v1/sites" if self.kind == "site" else "/api/v1/vms"
+
+    def _wait(self, job: dict) -> str:
+        while job["status"] in ("waiting", "queued", "running"):
+            time.sleep(self.poll_interval)
+            job = self.http.get(f"/api/v1/jobs/{job['id']}", headers=self.headers).get_json()
+        return job["status"]
+
+    def _operation(self, method: str, path: str, body: dict = None) -> dict:
+        started = time.perf_counter()
+        response = self.http.open(path, method=method, json=body, headers=self.headers)
+        submitted = time.perf_counter()
+
+        ok = response.status_code in (200, 202)
+        if response.status_code == 202:
+            ok = self._wait(response.get_json()) == "succeeded"
+        return {"submit_s": submitted - started, "complete_s": time.perf_counter() - started, "ok": ok}
+
+    def create(self) -> list:
+        return [self._operation("POST", self._collection(), self._body(name, 0)) for name in self.names]
+
+    def update(self) -> list:
+        return [self._operation("PUT", f"{self._collection()}/{name}", self._body(name, 1)) for name in self.names]
+
+    def delete(self) -> list:
+        return [self._operation("DELETE", f"{self._collection()}/{name}") for name in self.names]
+
+    def list(self) -> list:
+        # walk every page, one sample per page
+        samples = []
+        cursor = None
+        while True:
+            started = time.perf_counter()
+            query = {"limit": 50, **({"cursor": cursor} if cursor else {})}
+            response = self.http.get(self._collection(), query_string=query, headers=self.headers)
+            elapsed = time.perf_counter() - started
+            samples.append({"submit_s": elapsed, "complete_s": elapsed, "ok": response.status_code == 200})
+
+            cursor = response.get_json()["next_cursor"] if response.status_code == 200 else None
+            if cursor is None:
+                return samples
+
+
+def _percentiles(values: list) -> dict:
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(share):
+        return round(values[min(len(values) - 1, int(share * len(values)))] * 1000, 2)
+
+    return {
+        "mean_ms": round(statistics.mean(values) * 1000, 2),
+        "p50_ms": at(0.50),
+        "p95_ms": at(0.95),
+        "p99_ms": at(0.99),
+        "max_ms": round(values[-1] * 1000, 2),
+    }
+
+
+def run_phase(phase: str, clients: list) -> dict:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        samples = [sample for result in executor.map(lambda client: getattr(client, phase)(), clients)
+                   for sample in result]
+    seconds = time.perf_counter() - started
+
+    return {
+        "operations": len(samples),
+        "errors": sum(1 for sample in samples if not sample["ok"]),
+        "seconds": round(seconds, 3),
+        "throughput_ops_s": round(len(samples) / seconds, 2) if seconds else None,
+        "submit": _percentiles([sample["submit_s"] for sample in samples]),
+        "complete": _percentiles([sample["complete_s"] for sample in samples]),
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, previous: dict, tolerance: float) -> list:
+    """
+    Phases whose p95 completion latency or throughput regressed by more than `tolerance`
+    """
+    regressions = []
+    for phase, result in current["phases"].items():
+        before = previous.get("phases", {}).get(phase)
+        if not before or not before.get("complete") or not result.get("complete"):
+            continue
+
+        latency = result["complete"]["p95_ms"] / before["complete"]["p95_ms"] if before["complete"]["p95_ms"] else 1
+        throughput = result["throughput_ops_s"] / before["throughput_ops_s"] if before["throughput_ops_s"] else 1
+        print(f"{phase:>7}: p95 x{latency:.2f}, throughput x{throughput:.2f}")
+        if latency > 1 + tolerance or throughput < 1 - tolerance:
+            regressions.append(phase)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stacks", type=int, default=200, help="stacks created, updated and deleted in total")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent API clients, one user each")
+    parser.add_argument("--workers", type=int, default=None, help="DEPLOY_WORKERS, defaults to --clients")
+    parser.add_argument("--kind", choices=("site", "vm"), default="site")
+    parser.add_argument("--poll-interval", type=float, default=0.005)
+    parser.add_argument("--output", default=None, help="result file, defaults to benchmarks/results/")
+    parser.add_argument("--compare", default=None, help="earlier result file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="deployments-bench-") as workdir:
+        app = build_app(workdir, args.workers or args.clients)
+        tokens = issue_tokens(app, args.clients)
+
+        names = [f"bench-{args.kind}-{index:05d}" for index in range(args.stacks)]
+        clients = [
+            Client(app, token, args.kind, names[index::args.clients], args.poll_interval)
+            for index, token in enumerate(tokens)
+        ]
+
+        phases = {}
+        for phase in PHASES:
+            phases[phase] = run_phase(phase, clients)
+            print(f"{phase:>7}: {phases[phase]['operations']} ops in {phases[phase]['seconds']}s, "
+                  f"{phases[phase]['throughput_ops_s']} ops/s, {phases[phase]['errors']} errors", file=sys.stderr)
+
+    result = {
+        "benchmark": "deployments",
+        "recorded_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "parameters": {"stacks": args.stacks, "clients": args.clients, "workers": args.workers or args.clients,
+                       "kind": args.kind},
+        "phases": phases,
+    }
+
+    output = args.output or os.path.join(
+        ROOT, "benchmarks", "results",
+        f"deployments-{args.kind}-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(result, file, indent=2)
+    print(json.dumps(result, indent=2))
+    print(f"Result written to {output}", file=sys.stderr)
+
+    failed = any(phase["errors"] for phase in phases.values())
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        if regressions:
+            print(f"Regressed phases: {', '.join(regressions)}", file=sys.stderr)
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Measure cold boot to first served request, each run in a fresh interpreter
+
+    python benchmarks/startup.py --runs 5 --max-seconds 2.0
+
+Exits with status 1 when the median boot time exceeds --max-seconds or when
+pulumi/pulumi_aws were imported before the first deployment, so it can guard
+startup regressions in CI.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs inside the child interpreter, the clock starts before any app import
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+from source import create_app
+app = create_app()
+boot = time.perf_counter() - start
+response = app.test_client().get("/login")
+first_request = time.perf_counter() - start
+print(json.dumps({{
+    "boot_s": boot,
+    "first_request_s": first_request,
+    "status": response.status_code,
+    "heavy_imports": sorted(name for name in ("pulumi", "pulumi_aws", "pulumi.automation") if name in sys.modules),
+}}))
+"""
+
+
+def run_once(workdir: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "SECRET_KEY": "benchmark",
+        "PROJECT_NAME": "benchmark",
+        "PULUMI_ORG": "benchmark",
+        "DEBUG": "False",
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(workdir, 'database.db')}",
+        "REDIS_URL": "",
+    })
+    output = subprocess.run([sys.executable, "-c", CHILD.format(root=ROOT)], cwd=workdir, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="fail when the median time to the first request is above this")
+    args = parser.parse_args()
+
+    results = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as workdir:
+            results.append(run_once(workdir))
+
+    first_requests = [result["first_request_s"] for result in results]
+    heavy_imports = sorted({name for result in results for name in result["heavy_imports"]})
+    summary = {
+        "runs": args.runs,
+        "boot_median_s": round(statistics.median(result["boot_s"] for result in results), 3),
+        "first_request_median_s": round(statistics.median(first_requests), 3),
+        "first_request_max_s": round(max(first_requests), 3),
+        "heavy_imports": heavy_imports,
+    }
+    print(json.dumps(summary, indent=2))
+
+    failed = bool(heavy_imports)
+    if args.max_seconds is not None and summary["first_request_median_s"] > args.max_seconds:
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
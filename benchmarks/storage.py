@@ -0,0 +1,170 @@
+"""
+Stress the database with concurrent job writes from several processes, like gunicorn workers
+
+    python benchmarks/storage.py --processes 4 --threads 4 --commits 200
+    python benchmarks/storage.py --journal-mode DELETE --busy-timeout 0    # the old defaults
+
+Every thread records jobs through the app's models and walks them through
+their queued/running/succeeded commits while reader threads list them. The
+summary reports commit throughput and the failed commits ("database is
+locked"); it exits with status 1 when any commit failed or the throughput is
+below --min-commits-per-second.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs inside every worker process, they all start writing at start_at
+CHILD = """
+import json, sys, threading, time, uuid
+sys.path.insert(0, {root!r})
+from source import create_app, database, logger
+from source.models import DeploymentJobs
+logger.setLevel("WARNING")
+app = create_app()
+
+commits = []
+errors = []
+reads = []
+done = threading.Event()
+
+def write():
+    with app.app_context():
+        for _ in range({commits}):
+            started = time.perf_counter()
+            try:
+                job = DeploymentJobs(id=uuid.uuid4().hex, kind="site.update", status="queued", params="{{}}",
+                                     stack_name=f"stress-{{uuid.uuid4().hex[:8]}}")
+                database.session.add(job)
+                database.session.commit()
+                for status in ("running", "succeeded"):
+                    job.status = status
+                    database.session.commit()
+                commits.append(time.perf_counter() - started)
+            except Exception as err:
+                database.session.rollback()
+                errors.append(str(err).splitlines()[0])
+
+def read():
+    with app.app_context():
+        while not done.is_set():
+            started = time.perf_counter()
+            try:
+                DeploymentJobs.query.order_by(DeploymentJobs.created_at.desc()).limit(50).all()
+                reads.append(time.perf_counter() - started)
+            except Exception as err:
+                errors.append(str(err).splitlines()[0])
+            database.session.remove()
+            # a list page polled by a browser, not a busy loop holding the GIL
+            time.sleep(0.01)
+
+time.sleep(max(0, {start_at} - time.time()))
+started = time.perf_counter()
+writers = [threading.Thread(target=write) for _ in range({threads})]
+readers = [threading.Thread(target=read) for _ in range({readers})]
+for thread in writers + readers:
+    thread.start()
+for thread in writers:
+    thread.join()
+seconds = time.perf_counter() - started
+done.set()
+for thread in readers:
+    thread.join()
+
+print(json.dumps({{"jobs": len(commits), "seconds": seconds, "job_latencies": commits, "read_latencies": reads,
+                  "errors": errors}}))
+"""
+
+
+def percentile(values: list, share: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(share * len(values)))] * 1000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4, help="writer threads per process")
+    parser.add_argument("--readers", type=int, default=2, help="reader threads per process")
+    parser.add_argument("--commits", type=int, default=100, help="jobs per writer thread, 3 commits each")
+    parser.add_argument("--journal-mode", default=None, help="SQLITE_JOURNAL_MODE, the app default when omitted")
+    parser.add_argument("--busy-timeout", type=int, default=None, help="SQLITE_BUSY_TIMEOUT in milliseconds")
+    parser.add_argument("--database-uri", default=None, help="server database to stress instead of a temp sqlite")
+    parser.add_argument("--min-commits-per-second", type=float, default=None)
+    parser.add_argument("--output", default=None, help="also write the summary to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ)
+        env.update({
+            "SECRET_KEY": "benchmark",
+            "PROJECT_NAME": "benchmark",
+            "PULUMI_ORG": "benchmark",
+            "DEBUG": "False",
+            "SQLALCHEMY_DATABASE_URI": args.database_uri or f"sqlite:///{os.path.join(workdir, 'database.db')}",
+            "REDIS_URL": "",
+            "PROFILE_DIR": os.path.join(workdir, "profiles"),
+            "DB_POOL_SIZE": str(args.threads + args.readers),
+        })
+        if args.journal_mode:
+            env["SQLITE_JOURNAL_MODE"] = args.journal_mode
+        if args.busy_timeout is not None:
+            env["SQLITE_BUSY_TIMEOUT"] = str(args.busy_timeout)
+
+        # the schema is created once up front, like the first worker to boot
+        subprocess.run([sys.executable, "-c", f"import sys; sys.path.insert(0, {ROOT!r}); "
+                                              "from source import create_app; create_app()"],
+                       cwd=workdir, env=env, check=True, capture_output=True)
+
+        child = CHILD.format(root=ROOT, commits=args.commits, threads=args.threads, readers=args.readers,
+                             start_at=time.time() + 3)
+        workers = [
+            subprocess.Popen([sys.executable, "-c", child], cwd=workdir, env=env, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, text=True)
+            for _ in range(args.processes)
+        ]
+        results = [json.loads(worker.communicate()[0].strip().splitlines()[-1]) for worker in workers]
+
+    seconds = max(result["seconds"] for result in results)
+    jobs = sum(result["jobs"] for result in results)
+    job_latencies = [latency for result in results for latency in result["job_latencies"]]
+    read_latencies = [latency for result in results for latency in result["read_latencies"]]
+    errors = [error for result in results for error in result["errors"]]
+    summary = {
+        "processes": args.processes,
+        "threads": args.threads,
+        "readers": args.readers,
+        "journal_mode": args.journal_mode or "default",
+        "busy_timeout_ms": args.busy_timeout,
+        "jobs": jobs,
+        "commits": jobs * 3,
+        "seconds": round(seconds, 3),
+        "commits_per_second": round(jobs * 3 / seconds, 1),
+        "job_p50_ms": percentile(job_latencies, 0.5),
+        "job_p99_ms": percentile(job_latencies, 0.99),
+        "reads": len(read_latencies),
+        "read_p99_ms": percentile(read_latencies, 0.99),
+        "failed": len(errors),
+        "errors": sorted(set(errors))[:5],
+    }
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(summary, file, indent=2)
+
+    failed = bool(errors)
+    if args.min_commits_per_second is not None and summary["commits_per_second"] < args.min_commits_per_second:
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
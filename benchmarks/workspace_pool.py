@@ -0,0 +1,81 @@
+"""
+Compare the per-request overhead of selecting a stack with and without the workspace pool
+
+Runs against a throwaway local file backend, so only the pulumi CLI is needed:
+
+    python benchmarks/workspace_pool.py --iterations 20
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# keep the app's module level setup happy without a .env file
+os.environ.setdefault("DEBUG", "False")
+
+import pulumi.automation as auto  # noqa: E402
+
+from source.workspaces import WorkspacePool  # noqa: E402
+
+
+def noop():
+    pass
+
+
+def measure(label: str, iterations: int, select) -> dict:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        select()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return {
+        "label": label,
+        "iterations": iterations,
+        "mean_ms": round(statistics.mean(timings), 2),
+        "p50_ms": round(statistics.median(timings), 2),
+        "max_ms": round(max(timings), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--project", default="workspace-pool-bench")
+    parser.add_argument("--stack", default="bench")
+    args = parser.parse_args()
+
+    backend = tempfile.mkdtemp(prefix="pulumi-backend-")
+    os.environ["PULUMI_BACKEND_URL"] = f"file://{backend}"
+    os.environ.setdefault("PULUMI_CONFIG_PASSPHRASE", "benchmark")
+
+    auto.create_stack(stack_name=args.stack, project_name=args.project, program=noop)
+
+    pool = WorkspacePool()
+    pool.max_size = 1
+    pool.settings_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Pulumi.yaml")
+    # plugin installation is a one-off boot cost, not per-request overhead
+    pool._plugins_checked = True
+    pool.warm(args.project)
+
+    def without_pool():
+        auto.select_stack(stack_name=args.stack, project_name=args.project, program=noop)
+
+    def with_pool():
+        with pool.borrow(args.project, noop) as workspace:
+            auto.Stack.select(args.stack, workspace)
+
+    results = [
+        measure("without pool", args.iterations, without_pool),
+        measure("with pool", args.iterations, with_pool),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import os
 import logging
+from datetime import datetime
 
 from flask import Flask, render_template, request, flash
 from flask_sqlalchemy import SQLAlchemy
@@ -7,25 +8,15 @@ from flask_login import LoginManager, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
 
+from source.logs import log_pipeline
+
 # load env
 load_dotenv()
 
-# logger
+# logger, records are queued and written to the console and stack log files by a listener thread
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-
-# console handler
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-
-# formatter
-formatter = logging.Formatter("[%(levelname)s] - %(asctime)s - %(name)s - %(message)s")
-
-# add formatter to ch
-ch.setFormatter(formatter)
-
-# add ch to logger
-logger.addHandler(ch)
+log_pipeline.start(logger)
 
 # database
 database = SQLAlchemy()
@@ -42,10 +33,7 @@ def create_app():
     Create the main app
     :return: Flask Appapp
     """
-    # install required plugin
-    from .helper_functions import ensure_plugins
-    logger.info("Installing plugin")
-    ensure_plugins()
+    from .storage import database_uri, engine_options, init_storage
 
     # app config
     logger.info("Configuring APP")
@@ -53,40 +41,187 @@ def create_app():
         SECRET_KEY=os.environ["SECRET_KEY"],
         PROJECT_NAME=os.environ["PROJECT_NAME"],
         PULUMI_ORG=os.environ["PULUMI_ORG"],
-        SQLALCHEMY_DATABASE_URI=os.environ["SQLALCHEMY_DATABASE_URI"].format(os.path.join(os.getcwd(), "database.db")),
+        SQLALCHEMY_DATABASE_URI=database_uri(
+            os.environ["SQLALCHEMY_DATABASE_URI"].format(os.path.join(os.getcwd(), "database.db"))
+        ),
+        DB_POOL_SIZE=int(os.environ.get("DB_POOL_SIZE", 10)),
+        DB_MAX_OVERFLOW=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        DB_POOL_RECYCLE=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        SQLITE_JOURNAL_MODE=os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+        SQLITE_SYNCHRONOUS=os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+        SQLITE_BUSY_TIMEOUT=int(os.environ.get("SQLITE_BUSY_TIMEOUT", 30000)),
+        SQLITE_CACHE_KB=int(os.environ.get("SQLITE_CACHE_KB", 16384)),
+        REDIS_URL=os.environ.get("REDIS_URL"),
+        DEPLOY_WORKERS=int(os.environ.get("DEPLOY_WORKERS", 4)),
+        BULK_MAX_PARALLELISM=int(os.environ.get("BULK_MAX_PARALLELISM", 4)),
+        TEARDOWN_RETRIES=int(os.environ.get("TEARDOWN_RETRIES", 2)),
+        FLEET_MAX_SIZE=int(os.environ.get("FLEET_MAX_SIZE", 50)),
+        AMI_CACHE_PATH=os.environ.get("AMI_CACHE_PATH"),
+        AMI_REFRESH_INTERVAL=int(os.environ.get("AMI_REFRESH_INTERVAL", 86400)),
+        BLOB_STORE_PATH=os.environ.get("BLOB_STORE_PATH"),
+        LOG_LEVEL=os.environ.get("LOG_LEVEL", "INFO"),
+        LOG_FORMAT=os.environ.get("LOG_FORMAT", "json").lower(),
+        ENGINE_LOG_SAMPLE=float(os.environ.get("ENGINE_LOG_SAMPLE", 0)),
+        LOG_STREAM_LINES=int(os.environ.get("LOG_STREAM_LINES", 1000)),
+        LOG_STREAM_RETENTION=int(os.environ.get("LOG_STREAM_RETENTION", 3600)),
+        STACK_LOG_DIR=os.environ.get("STACK_LOG_DIR"),
+        STACK_LOG_MAX_BYTES=int(os.environ.get("STACK_LOG_MAX_BYTES", 1024 * 1024)),
+        STACK_LOG_BACKUPS=int(os.environ.get("STACK_LOG_BACKUPS", 3)),
+        SITE_ARCHIVE_MAX_BYTES=int(os.environ.get("SITE_ARCHIVE_MAX_BYTES", 100 * 1024 * 1024)),
+        SITE_ARCHIVE_MAX_FILES=int(os.environ.get("SITE_ARCHIVE_MAX_FILES", 1000)),
+        SITE_COMPRESSION=os.environ.get("SITE_COMPRESSION", "gzip"),
+        SITE_COMPRESSION_MIN_BYTES=int(os.environ.get("SITE_COMPRESSION_MIN_BYTES", 1024)),
+        SITE_HASHED_ASSETS=os.environ.get("SITE_HASHED_ASSETS", "True") == "True",
+        SITE_CACHE_CONTROL=os.environ.get("SITE_CACHE_CONTROL"),
+        COMPRESSION_CACHE_PATH=os.environ.get("COMPRESSION_CACHE_PATH"),
+        FETCH_TIMEOUT=float(os.environ.get("FETCH_TIMEOUT", 30)),
+        FETCH_MAX_BYTES=int(os.environ.get("FETCH_MAX_BYTES", 10 * 1024 * 1024)),
+        FETCH_POOL_SIZE=int(os.environ.get("FETCH_POOL_SIZE", 10)),
+        FETCH_CACHE_PATH=os.environ.get("FETCH_CACHE_PATH"),
+        FETCH_CACHE_SIZE=int(os.environ.get("FETCH_CACHE_SIZE", 1000)),
+        OUTPUTS_CACHE_SIZE=int(os.environ.get("OUTPUTS_CACHE_SIZE", 256)),
+        OUTPUTS_CACHE_TTL=int(os.environ.get("OUTPUTS_CACHE_TTL", 300)),
+        PREVIEW_CACHE_SIZE=int(os.environ.get("PREVIEW_CACHE_SIZE", 256)),
+        PREVIEW_CACHE_TTL=int(os.environ.get("PREVIEW_CACHE_TTL", 600)),
+        USER_CACHE_TTL=int(os.environ.get("USER_CACHE_TTL", 30)),
+        USER_CACHE_SIZE=int(os.environ.get("USER_CACHE_SIZE", 1024)),
+        LIST_PAGE_SIZE=int(os.environ.get("LIST_PAGE_SIZE", 50)),
+        WORKSPACE_POOL_SIZE=int(os.environ.get("WORKSPACE_POOL_SIZE", 8)),
+        WORKSPACE_MAX_USES=int(os.environ.get("WORKSPACE_MAX_USES", 100)),
+        WORKSPACE_BORROW_TIMEOUT=float(os.environ.get("WORKSPACE_BORROW_TIMEOUT", 30)),
+        WORKSPACE_POOL_WARM=int(os.environ.get("WORKSPACE_POOL_WARM", 0)),
+        STACK_LOCK_TTL=int(os.environ.get("STACK_LOCK_TTL", 3600)),
+        RECONCILE_INTERVAL=int(os.environ.get("RECONCILE_INTERVAL", 0)),
+        RECONCILE_PARALLELISM=int(os.environ.get("RECONCILE_PARALLELISM", 4)),
+        RECONCILE_BATCH_SIZE=int(os.environ.get("RECONCILE_BATCH_SIZE", 50)),
+        HISTORY_BATCH_SIZE=int(os.environ.get("HISTORY_BATCH_SIZE", 100)),
+        HISTORY_FLUSH_INTERVAL=float(os.environ.get("HISTORY_FLUSH_INTERVAL", 5)),
+        HISTORY_RETENTION_DAYS=int(os.environ.get("HISTORY_RETENTION_DAYS", 90)),
+        METRICS_TOKEN=os.environ.get("METRICS_TOKEN"),
+        PROFILE_SAMPLE_RATE=float(os.environ.get("PROFILE_SAMPLE_RATE", 0)),
+        PROFILE_SLOW_SECONDS=float(os.environ.get("PROFILE_SLOW_SECONDS", 1)),
+        PROFILE_DIR=os.environ.get("PROFILE_DIR"),
     )
 
-    # initialize the database
+    # console format and level, per-stack log files
+    log_pipeline.init_app(app)
+
+    # initialize the database, pool sized per engine and sqlite tuned for several workers
     logger.info("Initializing database")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"], app.config)
     database.init_app(app)
 
+    # request, commit and stack phase timings on /metrics
+    from .metrics import metrics
+    metrics.init_app(app)
+
+    # deployment job queue, importing deployments registers the job handlers
+    logger.info("Initializing job queue")
+    from .jobs import job_queue
+    from .locks import stack_locks
+    from . import deployments
+    job_queue.init_app(app)
+    stack_locks.init_app(app)
+
+    # operation history, written in batches by a background thread
+    from .history import history
+    history.init_app(app)
+
+    # live engine output of jobs
+    from .log_streams import log_streams
+    log_streams.init_app(app)
+
+    # stack outputs cache used by the update pages, previews of the submitted inputs
+    from .cache import outputs_cache, preview_cache, user_cache
+    outputs_cache.init_app(app)
+    preview_cache.init_app(app)
+    user_cache.init_app(app)
+
+    # persistent AMI lookup cache
+    from .amis import ami_service
+    ami_service.init_app(app)
+
+    # content-addressed blob store for site content and archive site files
+    from .blobs import blob_store
+    from .site_archives import site_assets
+    from .site_build import site_builder
+    blob_store.init_app(app)
+    site_assets.init_app(app)
+    site_builder.init_app(app)
+
+    # pooled, conditional downloads of site sources given as a url
+    from .fetch import source_fetcher
+    source_fetcher.init_app(app)
+
+    # workspace pool, the first workspace also installs the required plugin
+    from .workspaces import workspace_pool
+    workspace_pool.init_app(app)
+    if app.config["WORKSPACE_POOL_WARM"]:
+        logger.info("Warming workspace pool")
+        workspace_pool.warm(app.config["PROJECT_NAME"], app.config["WORKSPACE_POOL_WARM"])
+
+    # syncs the database with the stacks, `flask reconcile` or every RECONCILE_INTERVAL seconds
+    from .reconciler import reconciler
+    reconciler.init_app(app)
+
     from .routes.sites import sites_blue_print
     from .routes.virtual_machines import vm_blue_print
     from .routes.auth import auth_blue_print
+    from .routes.jobs import jobs_blue_print
+    from .routes.api import api_blue_print
     
     # register blueprint
     logger.info("Registering blueprints")
     app.register_blueprint(sites_blue_print)
     app.register_blueprint(vm_blue_print)
     app.register_blueprint(auth_blue_print)
+    app.register_blueprint(jobs_blue_print)
+    app.register_blueprint(api_blue_print)
 
     # models
-    from .models import User, VirtualMachines
+    from .models import ApiTokens, User, VirtualMachines
 
-    # create database
-    if not os.path.exists(app.config.get("SQLALCHEMY_DATABASE_URI")):
-        logger.info("Creating database")
-        with app.app_context():
-            database.create_all()
+    # create the missing tables, columns and indexes, WAL and the other pragmas are set per connection
+    init_storage(app)
+
+    # jobs left behind by a previous run: failed when stale, re-queued when only the queue was lost
+    with app.app_context():
+        job_queue.recover()
 
     # login manager
     login_manager = LoginManager()
     login_manager.login_view = "auth.login"
     login_manager.init_app(app)
 
+    # the JSON API answers 401 instead of redirecting to the login page
+    login_manager.blueprint_login_views = {"api": None}
+
     @login_manager.user_loader
     def load_user(id):
-        return database.get_or_404(User, id)
+        # runs on every request, the row is served from the user cache for a few seconds
+        user = user_cache.get(int(id))
+        if user is None:
+            user = database.get_or_404(User, id)
+            user_cache.set(user)
+        return user
+
+    @login_manager.request_loader
+    def load_user_from_token(request):
+        # API clients authenticate with "Authorization: Bearer <token>"
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            return None
+
+        api_token = ApiTokens.query.filter_by(token_hash=ApiTokens.hash(token.strip())).first()
+        if api_token is None:
+            return None
+
+        # record usage at most once a minute, not on every request
+        now = datetime.utcnow()
+        if api_token.last_used_at is None or (now - api_token.last_used_at).total_seconds() > 60:
+            api_token.last_used_at = now
+            database.session.commit()
+        return database.session.get(User, api_token.refrence_key)
 
     return app
 
@@ -116,7 +251,24 @@ def account_setting():
 
         database.session.commit()
 
+        from .cache import user_cache
+        user_cache.invalidate(current_user.id)
+
         flash("Your profile has been udpated", category="success")
         logger.info(f"{email} profile updated successfully")
 
     return render_template("account_setting.html", sub_title="Settings", name=name, email=email)
+
+
+@app.route("/account-setting/teardown", methods=["POST"])
+@login_required
+def teardown_account():
+    """
+    View handler to delete every site and VM of the user
+    """
+    from .models import Sites, VirtualMachines
+    from .routes.jobs import teardown_response
+
+    sites = [name for (name,) in database.session.query(Sites.name).filter_by(refrence_key=current_user.id)]
+    vms = [name for (name,) in database.session.query(VirtualMachines.name).filter_by(refrence_key=current_user.id)]
+    return teardown_response("teardown", sites, vms, "account_setting")
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from source import logger
+
+# AMIs users can pick from on the create forms
+AMI_CHOICES = {
+    "amzn2-minimal": {
+        "label": "Amazon Linux 2 (minimal)",
+        "owners": ["amazon"],
+        "filters": [{"name": "name", "values": ["*amzn2-ami-minimal-hvm*"]}],
+    },
+    "amzn2": {
+        "label": "Amazon Linux 2",
+        "owners": ["amazon"],
+        "filters": [{"name": "name", "values": ["amzn2-ami-hvm-*-x86_64-gp2"]}],
+    },
+    "ubuntu-22.04": {
+        "label": "Ubuntu 22.04 LTS",
+        "owners": ["099720109477"],
+        "filters": [{"name": "name", "values": ["ubuntu/images/hvm-ssd/ubuntu-jammy-22.04-amd64-server-*"]}],
+    },
+}
+DEFAULT_AMI = "amzn2-minimal"
+
+
+class AmiService:
+    """
+    Resolves AMI choices to AMI ids through a persistent cache
+
+    The cache is a json file keyed by owners, filters and region. A fresh entry
+    is handed to the pulumi program as a pinned id so it skips the get_ami
+    round trip; a missing or stale one makes the program look the AMI up and
+    the resolved id is stored once the deployment succeeds.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.refresh_interval = 86400
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Configure the service from the flask app config
+        :param app: Flask app
+        """
+        self.path = app.config.get("AMI_CACHE_PATH") or os.path.join(app.instance_path, "ami_cache.json")
+        self.refresh_interval = app.config["AMI_REFRESH_INTERVAL"]
+        app.extensions["ami_service"] = self
+
+    @staticmethod
+    def _key(choice: dict, region: str) -> str:
+        payload = json.dumps({"owners": choice["owners"], "filters": choice["filters"], "region": region},
+                             sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.path, "r") as file:
+                    self._entries = json.load(file)
+            except (FileNotFoundError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self._entries, file)
+        os.replace(tmp_path, self.path)
+
+    def cached(self, name: str, region: str):
+        """
+        AMI id cached for a choice, None when unknown or older than the refresh interval
+        :param name: key of AMI_CHOICES
+        :param region: aws region
+        """
+        with self._lock:
+            entry = self._load().get(self._key(AMI_CHOICES[name], region))
+
+        if entry is None or time.time() - entry["resolved_at"] > self.refresh_interval:
+            return None
+        return entry["ami_id"]
+
+    def lookup(self, name: str, region: str) -> dict:
+        """
+        AMI argument for the VM programs: a pinned id or the get_ami lookup parameters
+        :param name: key of AMI_CHOICES
+        :param region: aws region
+        """
+        ami_id = self.cached(name, region)
+        if ami_id:
+            return {"id": ami_id}
+
+        choice = AMI_CHOICES[name]
+        return {"owners": choice["owners"], "filters": choice["filters"]}
+
+    def store(self, name: str, region: str, ami_id: str):
+        """
+        Remember the AMI id a deployment resolved
+        :param name: key of AMI_CHOICES
+        :param region: aws region
+        :param ami_id: resolved AMI id
+        """
+        if not ami_id:
+            return
+
+        with self._lock:
+            key = self._key(AMI_CHOICES[name], region)
+            entry = self._load().get(key)
+            if entry and entry["ami_id"] == ami_id and time.time() - entry["resolved_at"] <= self.refresh_interval:
+                return
+
+            self._entries[key] = {"choice": name, "region": region, "ami_id": ami_id, "resolved_at": time.time()}
+            try:
+                self._save()
+            except OSError as err:
+                logger.warning(f"Could not persist AMI cache -> {err}")
+
+    def choices(self, region: str) -> list:
+        """
+        AMIs to offer on the create forms with their cached ids
+        :param region: aws region
+        """
+        return [
+            {"name": name, "label": choice["label"], "ami_id": self.cached(name, region)}
+            for name, choice in AMI_CHOICES.items()
+        ]
+
+
+ami_service = AmiService()
@@ -0,0 +1,110 @@
+import hashlib
+import mmap
+import os
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobTooLarge(Exception):
+    """
+    Raised when a blob exceeds the size limit it was stored with
+    """
+
+
+class BlobStore:
+    """
+    Content-addressed blob store on local disk
+
+    Blobs are keyed by the sha256 of their content, so identical content shared
+    by several sites is stored once.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def init_app(self, app):
+        """
+        Configure the store from the flask app config
+        :param app: Flask app
+        """
+        self.root = app.config.get("BLOB_STORE_PATH") or os.path.join(app.instance_path, "blobs")
+        os.makedirs(self.root, exist_ok=True)
+        app.extensions["blob_store"] = self
+
+    def path(self, sha256: str) -> str:
+        """
+        Location of a blob
+        :param sha256: hex digest of the blob content
+        """
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def exists(self, sha256: str) -> bool:
+        return os.path.exists(self.path(sha256))
+
+    def put_stream(self, source, limit: int = None):
+        """
+        Stream a blob into the store while hashing it
+        :param source: readable returning bytes
+        :param limit: maximum number of bytes, BlobTooLarge is raised past it
+        :return: (sha256, size)
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                    size += len(chunk)
+                    if limit is not None and size > limit:
+                        raise BlobTooLarge(f"Blob is larger than {limit} bytes")
+                    digest.update(chunk)
+                    tmp.write(chunk)
+
+            sha256 = digest.hexdigest()
+            path = self.path(sha256)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            return sha256, size
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def put_bytes(self, data: bytes) -> str:
+        """
+        Store a blob held in memory
+        :param data: blob content
+        :return: sha256 of the content
+        """
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.path(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.root)
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        return sha256
+
+    def read_text(self, sha256: str, encoding: str = "utf-8"):
+        """
+        Read a text blob through a memory map, None when the blob is missing
+        :param sha256: hex digest of the blob content
+        :param encoding: text encoding of the blob
+        """
+        try:
+            with open(self.path(sha256), "rb") as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return ""
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    # pages fetched from a url are stored as served, whatever their charset
+                    return str(mapped, encoding, "replace")
+        except FileNotFoundError:
+            return None
+
+
+blob_store = BlobStore()
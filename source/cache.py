@@ -0,0 +1,319 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from source import logger
+
+
+class OutputsCache:
+    """
+    Read-through cache of stack outputs keyed by (project, stack name)
+
+    Entries live in an in-memory LRU with a TTL. When REDIS_URL is set a redis
+    tier is shared by every app process, and a per-stack version counter in
+    redis lets invalidations reach the memory tier of the other processes.
+    """
+
+    def __init__(self):
+        self.maxsize = 256
+        self.ttl = 300
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = None
+
+    def init_app(self, app):
+        """
+        Configure the cache from the flask app config
+        :param app: Flask app
+        """
+        self.maxsize = app.config["OUTPUTS_CACHE_SIZE"]
+        self.ttl = app.config["OUTPUTS_CACHE_TTL"]
+        redis_url = app.config.get("REDIS_URL")
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url)
+        app.extensions["outputs_cache"] = self
+
+    @staticmethod
+    def _key(project_name: str, stack_name: str) -> str:
+        return f"outputs:{project_name}:{stack_name}"
+
+    def _version(self, key: str):
+        if self._redis is None:
+            return None
+        try:
+            return self._redis.get(f"{key}:version")
+        except Exception as err:
+            logger.warning(f"Outputs cache redis tier unavailable -> {err}")
+            return None
+
+    def get(self, project_name: str, stack_name: str, loader) -> dict:
+        """
+        Get the outputs of a stack, calling the loader on a miss
+        :param project_name: pulumi project name
+        :param stack_name: name of the stack
+        :param loader: callable returning the outputs as a dict of plain values
+        :return: dict of output name to value
+        """
+        key = self._key(project_name, stack_name)
+        version = self._version(key)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now and entry[1] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+
+        outputs = None
+        if self._redis is not None:
+            try:
+                cached = self._redis.get(key)
+                outputs = json.loads(cached) if cached else None
+            except Exception as err:
+                logger.warning(f"Outputs cache redis tier unavailable -> {err}")
+
+        with self._lock:
+            if outputs is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if outputs is None:
+            outputs = loader()
+            self.set(project_name, stack_name, outputs, version=version)
+        else:
+            self._remember(key, outputs, version)
+
+        return outputs
+
+    def set(self, project_name: str, stack_name: str, outputs: dict, version=None):
+        """
+        Store fresh outputs, e.g. the ones returned by a finished stack.up
+        :param project_name: pulumi project name
+        :param stack_name: name of the stack
+        :param outputs: dict of output name to value
+        :param version: redis version seen before loading, looked up when omitted
+        """
+        key = self._key(project_name, stack_name)
+        if version is None:
+            version = self._version(key)
+
+        if self._redis is not None:
+            try:
+                self._redis.setex(key, self.ttl, json.dumps(outputs))
+            except Exception as err:
+                logger.warning(f"Outputs cache redis tier unavailable -> {err}")
+
+        self._remember(key, outputs, version)
+
+    def _remember(self, key: str, outputs: dict, version):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, version, outputs)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, project_name: str, stack_name: str):
+        """
+        Drop the cached outputs of a stack in every tier
+        :param project_name: pulumi project name
+        :param stack_name: name of the stack
+        """
+        key = self._key(project_name, stack_name)
+        with self._lock:
+            self._entries.pop(key, None)
+
+        if self._redis is not None:
+            try:
+                pipe = self._redis.pipeline()
+                pipe.delete(key)
+                pipe.incr(f"{key}:version")
+                pipe.execute()
+            except Exception as err:
+                logger.warning(f"Outputs cache redis tier unavailable -> {err}")
+
+    def stats(self) -> dict:
+        """
+        Hit and miss counters of this process
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+outputs_cache = OutputsCache()
+
+
+class PreviewCache:
+    """
+    Latest preview of every stack, keyed by (project, stack name) and valid for one input fingerprint
+
+    A preview is reused only for the inputs it ran with and only until the
+    stack is updated or destroyed, entries also expire after a TTL. When
+    REDIS_URL is set the entries live in redis, so every app process sees them.
+    """
+
+    def __init__(self):
+        self.maxsize = 256
+        self.ttl = 600
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = None
+
+    def init_app(self, app):
+        """
+        Configure the cache from the flask app config
+        :param app: Flask app
+        """
+        self.maxsize = app.config["PREVIEW_CACHE_SIZE"]
+        self.ttl = app.config["PREVIEW_CACHE_TTL"]
+        redis_url = app.config.get("REDIS_URL")
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url)
+        app.extensions["preview_cache"] = self
+
+    @staticmethod
+    def _key(project_name: str, stack_name: str) -> str:
+        return f"preview:{project_name}:{stack_name}"
+
+    def get(self, project_name: str, stack_name: str, fingerprint: str):
+        """
+        The cached preview of a stack for the given inputs, None on a miss
+        :param project_name: pulumi project name
+        :param stack_name: name of the stack
+        :param fingerprint: fingerprint of the inputs, see source.fingerprints
+        """
+        key = self._key(project_name, stack_name)
+        preview = None
+        if self._redis is not None:
+            try:
+                cached = self._redis.get(key)
+                preview = json.loads(cached) if cached else None
+            except Exception as err:
+                logger.warning(f"Preview cache redis tier unavailable -> {err}")
+        else:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    preview = entry[1]
+
+        if preview is None or preview.get("fingerprint") != fingerprint:
+            return None
+        return preview
+
+    def set(self, project_name: str, stack_name: str, preview: dict):
+        """
+        Store the preview of a stack, replacing the one of other inputs
+        :param project_name: pulumi project name
+        :param stack_name: name of the stack
+        :param preview: preview with the "fingerprint" of its inputs
+        """
+        key = self._key(project_name, stack_name)
+        if self._redis is not None:
+            try:
+                self._redis.setex(key, self.ttl, json.dumps(preview))
+            except Exception as err:
+                logger.warning(f"Preview cache redis tier unavailable -> {err}")
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, preview)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, project_name: str, stack_name: str):
+        """
+        Drop the preview of a stack whose state changed
+        :param project_name: pulumi project name
+        :param stack_name: name of the stack
+        """
+        key = self._key(project_name, stack_name)
+        with self._lock:
+            self._entries.pop(key, None)
+
+        if self._redis is not None:
+            try:
+                self._redis.delete(key)
+            except Exception as err:
+                logger.warning(f"Preview cache redis tier unavailable -> {err}")
+
+
+preview_cache = PreviewCache()
+
+
+class UserCache:
+    """
+    Short-lived cache of the user rows the session cookie points at
+
+    The login manager loads the user on every request, a cached row is
+    attached to the request's session without a SELECT. Entries expire
+    after a few seconds, so changes made by other processes show up quickly.
+    """
+
+    def __init__(self):
+        self.ttl = 30
+        self.maxsize = 1024
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Configure the cache from the flask app config
+        :param app: Flask app
+        """
+        self.ttl = app.config["USER_CACHE_TTL"]
+        self.maxsize = app.config["USER_CACHE_SIZE"]
+        app.extensions["user_cache"] = self
+
+    def get(self, user_id: int):
+        """
+        The cached user attached to the current session, None on a miss
+        :param user_id: id of the user
+        """
+        from sqlalchemy.orm import make_transient_to_detached
+
+        from source import database
+        from source.models import User
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            self._entries.move_to_end(user_id)
+            columns = entry[1]
+
+        user = User(**columns)
+        make_transient_to_detached(user)
+        return database.session.merge(user, load=False)
+
+    def set(self, user):
+        """
+        Remember the columns of a user row
+        :param user: loaded User
+        """
+        if not self.ttl:
+            return
+        columns = {column.key: getattr(user, column.key) for column in user.__table__.columns}
+        with self._lock:
+            self._entries[user.id] = (time.monotonic() + self.ttl, columns)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        """
+        Drop a user whose row changed
+        :param user_id: id of the user
+        """
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+user_cache = UserCache()
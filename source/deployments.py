@@ -0,0 +1,472 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import current_app
+
+from source import database, logger
+from source.amis import DEFAULT_AMI, ami_service
+from source.cache import outputs_cache, preview_cache
+from source.fingerprints import fleet_fingerprint, site_fingerprint, vm_fingerprint
+from source.helper_functions import (auto, create_pulumi_program_fleet, create_pulumi_program_s3,
+                                     create_pulumi_program_vms)
+from source.history import history
+from source.jobs import ACTIVE_STATUSES, PartialFailure, job_queue
+from source.locks import StackBusy, stack_locks
+from source.log_streams import log_streams
+from source.metrics import metrics
+from source.models import DeploymentJobs, FleetMembers, Sites, VirtualMachines
+from source.regions import DEFAULT_REGION
+from source.site_build import site_builder
+from source.workspaces import WorkspacePoolExhausted, workspace_pool
+
+# preview steps that leave the resources as they are
+NO_CHANGE_OPS = ("same", "read")
+
+# pulumi keeps the monitor, stack and config of the running inline program in module
+# globals, so a process evaluates one program at a time. Jobs of other processes, the
+# redis workers, still run in parallel
+_program_lock = threading.Lock()
+
+
+def _reset_program_lock():
+    # a thread of the parent may have held it when the process forked
+    global _program_lock
+    _program_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_program_lock)
+
+
+@contextmanager
+def running_program():
+    """
+    Hold the lock of the process while the engine runs an inline program, up or preview
+    """
+    with metrics.phase("wait_program"):
+        _program_lock.acquire()
+    try:
+        yield
+    finally:
+        _program_lock.release()
+
+
+def console_url(stack_name: str) -> str:
+    """
+    Link to the stack on the pulumi console
+    :param stack_name: name of the stack
+    """
+    org_name = current_app.config["PULUMI_ORG"]
+    project_name = current_app.config["PROJECT_NAME"]
+    return f"https://app.pulumi.com/{org_name}/{project_name}/{stack_name}"
+
+
+def stack_outputs(stack_name: str) -> dict:
+    """
+    Outputs of a stack as plain values, served from the outputs cache
+    :param stack_name: name of the stack
+    :return: dict of output name to value
+    """
+    def load():
+        # no-op program, just to get outputs
+        with open_stack(stack_name, program=lambda: None) as stack, metrics.phase("outputs"):
+            return {name: output.value for name, output in stack.outputs().items()}
+
+    return outputs_cache.get(current_app.config["PROJECT_NAME"], stack_name, load)
+
+
+def _up(stack) -> dict:
+    project_name = current_app.config["PROJECT_NAME"]
+    outputs_cache.invalidate(project_name, stack.name)
+    preview_cache.invalidate(project_name, stack.name)
+
+    # deploy the stack, tailing the log to the log stream of the job
+    with running_program(), metrics.phase("up"):
+        result = stack.up(on_output=log_streams.write)
+    history.count_changes(result)
+
+    with metrics.phase("outputs"):
+        outs = {name: output.value for name, output in stack.outputs().items()}
+    outputs_cache.set(project_name, stack.name, outs)
+    return outs
+
+
+def _last_change(stack_name: str):
+    # id of the last job that ran on the stack, whatever process ran it and however it ended
+    job = DeploymentJobs.query.filter(
+        DeploymentJobs.stack_name == stack_name,
+        DeploymentJobs.kind.notlike("%.preview%"),
+        DeploymentJobs.started_at.isnot(None),
+        DeploymentJobs.status.notin_(ACTIVE_STATUSES),
+    ).order_by(DeploymentJobs.started_at.desc()).first()
+    return job.id if job else None
+
+
+def _preview(stack, fingerprint: str) -> dict:
+    with running_program(), metrics.phase("preview"):
+        result = stack.preview(on_output=log_streams.write)
+
+    summary = {getattr(op, "value", op): count for op, count in (result.change_summary or {}).items() if count}
+    history.note(resource_changes=summary)
+    preview = {
+        "fingerprint": fingerprint,
+        # the preview only holds while no other job changed the stack
+        "after_job": _last_change(stack.name),
+        "change_summary": summary,
+        "changes": any(op not in NO_CHANGE_OPS for op in summary),
+        "previewed_at": datetime.utcnow().isoformat(),
+    }
+    preview_cache.set(current_app.config["PROJECT_NAME"], stack.name, preview)
+    return preview
+
+
+def _deploy(stack_name: str, program, region: str, fingerprint: str, create: bool = False,
+            preview: bool = False, force: bool = False) -> dict:
+    """
+    Deploy or preview a program on a stack
+    :param stack_name: name of the stack
+    :param program: inline pulumi program
+    :param region: aws region of the stack
+    :param fingerprint: fingerprint of the inputs of the program
+    :param create: create a new stack instead of selecting an existing one
+    :param preview: only preview the changes
+    :param force: run up even when a preview of the same inputs found no changes
+    :return: stack outputs, the preview when `preview` is set
+    """
+    if not (create or preview or force):
+        # the engine already showed these inputs change nothing, the stack is left alone. The
+        # cache of another process is not invalidated by our updates, so the preview must also
+        # have seen the last job that ran on the stack
+        cached = preview_cache.get(current_app.config["PROJECT_NAME"], stack_name, fingerprint)
+        if cached and not cached["changes"] and cached.get("after_job") == _last_change(stack_name):
+            logger.info(f"Preview of {stack_name} found no changes, skipping up")
+            history.note(resource_changes=cached["change_summary"])
+            return stack_outputs(stack_name)
+
+    with open_stack(stack_name, program, create) as stack:
+        with metrics.phase("set_config"):
+            stack.set_config("aws:region", auto.ConfigValue(region))
+        if preview:
+            return _preview(stack, fingerprint)
+        return _up(stack)
+
+
+@contextmanager
+def open_stack(stack_name: str, program, create: bool = False):
+    """
+    Create or select a stack on a workspace borrowed from the workspace pool
+    :param stack_name: name of the stack
+    :param program: inline pulumi program
+    :param create: create a new stack instead of selecting an existing one
+    """
+    started = time.perf_counter()
+    with workspace_pool.borrow(current_app.config["PROJECT_NAME"], program) as workspace:
+        metrics.observe_phase("borrow_workspace", time.perf_counter() - started)
+        if create:
+            with metrics.phase("create_stack"):
+                stack = auto.Stack.create(stack_name, workspace)
+        else:
+            with metrics.phase("select_stack"):
+                stack = auto.Stack.select(stack_name, workspace)
+        yield stack
+
+
+def _destroy(stack_name: str):
+    with open_stack(stack_name, program=lambda: None) as stack:
+        # NOTE: stack.destroy will automatically delete the resource on aws
+        with metrics.phase("destroy"):
+            result = stack.destroy(on_output=log_streams.write)
+        history.count_changes(result)
+        with metrics.phase("remove_stack"):
+            stack.workspace.remove_stack(stack_name)
+    outputs_cache.invalidate(current_app.config["PROJECT_NAME"], stack_name)
+    preview_cache.invalidate(current_app.config["PROJECT_NAME"], stack_name)
+
+
+def _pinned_ami(stack_name: str, ami: str, region: str) -> dict:
+    # an existing stack keeps its AMI until the user picks another one, so a
+    # refreshed cache entry never replaces running instances
+    vm = VirtualMachines.query.filter_by(name=stack_name).first()
+    if vm and vm.ami == ami and vm.ami_id:
+        return {"id": vm.ami_id}
+    return ami_service.lookup(ami, region)
+
+
+@job_queue.handler("site.create")
+@job_queue.handler("site.update")
+@job_queue.handler("site.preview")
+def deploy_site(stack_name: str, content_hash: str = None, files: dict = None, region: str = DEFAULT_REGION,
+                create: bool = False, user_id=None, preview: bool = False, force: bool = False) -> dict:
+    """
+    Deploy the static site stack and store it into the Sites model
+    :param stack_name: name of the stack
+    :param content_hash: blob store hash of the HTML of a single page site
+    :param files: manifest of an archive site, see SiteAssets.unpack
+    :param region: aws region of the stack
+    :param create: create a new stack instead of selecting an existing one
+    :param user_id: owner of the site
+    :param preview: only preview the changes, the Sites row is left alone
+    :param force: deploy even when a preview of the same content found no changes
+    :return: stack outputs, the planned changes for a preview
+    """
+    history.note(region=region)
+
+    # hashed asset names, cache policies and pre-compressed variants of the files
+    with metrics.phase("build_site"):
+        assets = site_builder.build(files or {
+            "index.html": {"sha256": content_hash, "content_type": "text/html; charset=utf-8"},
+        })
+
+    def pulumi_program():
+        return create_pulumi_program_s3(assets, content_hash)
+
+    outs = _deploy(stack_name, pulumi_program, region, site_fingerprint(content_hash, files), create, preview, force)
+    if preview:
+        return outs
+
+    site = Sites.query.filter_by(name=stack_name).first()
+    if site is None:
+        if not create:
+            logger.critical(f"{stack_name} stack name not found on Sites model")
+        site = Sites(name=stack_name, refrence_key=user_id)
+        database.session.add(site)
+
+    site.region = region
+    site.url = f"http://{outs['website_url']}"
+    site.console_url = console_url(stack_name)
+    site.fingerprint = site_fingerprint(content_hash, files)
+    site.content_hash = None if files else content_hash
+    database.session.commit()
+
+    return {"website_url": site.url}
+
+
+@job_queue.handler("vm.create")
+@job_queue.handler("vm.update")
+@job_queue.handler("vm.preview")
+def deploy_vm(stack_name: str, keydata: str, instance_type: str, ami: str = DEFAULT_AMI, region: str = DEFAULT_REGION,
+              create: bool = False, user_id=None, preview: bool = False, force: bool = False) -> dict:
+    """
+    Deploy the virtual machine stack and store it into the VirtualMachines model
+    :param stack_name: name of the stack
+    :param keydata: public key used to connect to the VM
+    :param instance_type: ec2 instance type
+    :param ami: AMI choice, see source.amis.AMI_CHOICES
+    :param region: aws region of the stack
+    :param create: create a new stack instead of selecting an existing one
+    :param user_id: owner of the VM
+    :param preview: only preview the changes, the VirtualMachines row is left alone
+    :param force: deploy even when a preview of the same inputs found no changes
+    :return: stack outputs, the planned changes for a preview
+    """
+    history.note(instance_type=instance_type, region=region)
+    pinned_ami = _pinned_ami(stack_name, ami, region)
+
+    def pulumi_program():
+        return create_pulumi_program_vms(keydata, instance_type, pinned_ami)
+
+    fingerprint = vm_fingerprint(keydata, instance_type, region, ami)
+    outs = _deploy(stack_name, pulumi_program, region, fingerprint, create, preview, force)
+    if preview:
+        return outs
+
+    vm = VirtualMachines.query.filter_by(name=stack_name).first()
+    if vm is None:
+        if not create:
+            logger.critical(f"{stack_name} stack name not found on Virtual Machine model")
+        vm = VirtualMachines(name=stack_name, refrence_key=user_id)
+        database.session.add(vm)
+
+    vm.region = region
+    # the program declares a single instance, nothing of a fleet is left
+    vm.members = []
+    vm.dns_name = f"{outs['public_dns']}"
+    vm.console_url = console_url(stack_name)
+    vm.fingerprint = fingerprint
+    vm.ami = ami
+    vm.ami_id = outs["ami_id"]
+    ami_service.store(ami, region, outs["ami_id"])
+    database.session.commit()
+
+    return {"public_ip": outs["public_ip"], "public_dns": vm.dns_name}
+
+
+@job_queue.handler("vm.create-fleet")
+@job_queue.handler("vm.update-fleet")
+@job_queue.handler("vm.preview-fleet")
+def deploy_fleet(stack_name: str, keydata: str, instances: list, ami: str = DEFAULT_AMI, region: str = DEFAULT_REGION,
+                 create: bool = False, user_id=None, preview: bool = False, force: bool = False) -> dict:
+    """
+    Deploy a fleet stack and store it with its members into the VirtualMachines model
+    :param stack_name: name of the stack
+    :param keydata: public key used to connect to every instance
+    :param instances: list of {"name", "instance_type"} specs
+    :param ami: AMI choice, see source.amis.AMI_CHOICES
+    :param region: aws region of the stack
+    :param create: create a new stack instead of selecting an existing one
+    :param user_id: owner of the fleet
+    :param preview: only preview the changes, the VirtualMachines row is left alone
+    :param force: deploy even when a preview of the same inputs found no changes
+    :return: stack outputs, the planned changes for a preview
+    """
+    history.note(instance_type=",".join(sorted({spec["instance_type"] for spec in instances})), region=region)
+    pinned_ami = _pinned_ami(stack_name, ami, region)
+
+    def pulumi_program():
+        return create_pulumi_program_fleet(keydata, instances, pinned_ami)
+
+    fingerprint = fleet_fingerprint(keydata, instances, region, ami)
+    outs = _deploy(stack_name, pulumi_program, region, fingerprint, create, preview, force)
+    if preview:
+        return outs
+
+    vm = VirtualMachines.query.filter_by(name=stack_name).first()
+    if vm is None:
+        if not create:
+            logger.critical(f"{stack_name} stack name not found on Virtual Machine model")
+        vm = VirtualMachines(name=stack_name, refrence_key=user_id)
+        database.session.add(vm)
+
+    vm.region = region
+    vm.dns_name = None
+    vm.console_url = console_url(stack_name)
+    vm.fingerprint = fingerprint
+    vm.ami = ami
+    vm.ami_id = outs["ami_id"]
+    ami_service.store(ami, region, outs["ami_id"])
+    vm.members = [
+        FleetMembers(
+            name=name,
+            instance_type=member["instance_type"],
+            public_ip=member["public_ip"],
+            dns_name=member["public_dns"],
+        )
+        for name, member in sorted(outs["instances"].items())
+    ]
+    database.session.commit()
+
+    return {"instances": outs["instances"]}
+
+
+@job_queue.handler("site.destroy")
+def destroy_site(stack_name: str) -> dict:
+    """
+    Destroy the static site stack and delete it from the Sites model
+    :param stack_name: name of the stack
+    """
+    _destroy(stack_name)
+
+    site = Sites.query.filter_by(name=stack_name).first()
+    if site:
+        history.note(region=site.region)
+        database.session.delete(site)
+        database.session.commit()
+
+    return {}
+
+
+@job_queue.handler("vm.destroy")
+def destroy_vm(stack_name: str) -> dict:
+    """
+    Destroy the virtual machine stack and delete it from the VirtualMachines model
+    :param stack_name: name of the stack
+    """
+    _destroy(stack_name)
+
+    vm = VirtualMachines.query.filter_by(name=stack_name).first()
+    if vm:
+        types = sorted({member.instance_type for member in vm.members})
+        history.note(program="fleet" if types else "vm", instance_type=",".join(types) or None, region=vm.region)
+        database.session.delete(vm)
+        database.session.commit()
+
+    return {}
+
+
+def _destroy_with_retries(app, log_context, stack_name: str, owner: str, retries: int) -> dict:
+    # runs on a teardown thread: own app context, engine output into the teardown job stream
+    with app.app_context():
+        log_streams.attach(log_context)
+        result = {"stack_name": stack_name, "attempts": 0}
+        try:
+            if not stack_locks.acquire(stack_name, owner):
+                result["error"] = str(StackBusy(stack_name))
+                return result
+
+            try:
+                while True:
+                    result["attempts"] += 1
+                    try:
+                        _destroy(stack_name)
+                        result["destroyed"] = True
+                        return result
+                    except auto.StackNotFoundError:
+                        # already gone, only the row is left to delete
+                        result["destroyed"] = True
+                        return result
+                    except (auto.CommandError, WorkspacePoolExhausted) as err:
+                        if result["attempts"] > retries:
+                            result["error"] = str(err)
+                            return result
+                        logger.warning(f"Destroy of {stack_name} failed, retrying -> {err}")
+                        time.sleep(2 ** result["attempts"])
+                    except Exception as err:
+                        result["error"] = str(err)
+                        return result
+            finally:
+                stack_locks.release(stack_name, owner)
+        finally:
+            log_streams.attach(None)
+
+
+@job_queue.handler("site.teardown")
+@job_queue.handler("vm.teardown")
+@job_queue.handler("teardown")
+def teardown(sites: list = (), vms: list = (), parallelism: int = 4, retries: int = 2) -> dict:
+    """
+    Destroy many site and VM stacks concurrently and delete their rows in one transaction
+    :param sites: names of the site stacks
+    :param vms: names of the VM stacks
+    :param parallelism: maximum number of destroys running at the same time
+    :param retries: how many times a destroy that failed in the engine is retried
+    :return: report with the destroyed and failed stacks
+    """
+    started = time.monotonic()
+    app = current_app._get_current_object()
+    owner = f"teardown-{uuid.uuid4().hex}"
+    names = list(sites) + list(vms)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(names) or 1))) as executor:
+        futures = [
+            executor.submit(_destroy_with_retries, app, log_streams.fork(name), name, owner, retries)
+            for name in names
+        ]
+        results = [future.result() for future in futures]
+
+    destroyed = {result["stack_name"] for result in results if result.get("destroyed")}
+    destroyed_sites = [name for name in sites if name in destroyed]
+    destroyed_vms = [name for name in vms if name in destroyed]
+
+    if destroyed_vms:
+        vm_ids = database.select(VirtualMachines.id).where(VirtualMachines.name.in_(destroyed_vms))
+        FleetMembers.query.filter(FleetMembers.refrence_key.in_(vm_ids)).delete(synchronize_session=False)
+        VirtualMachines.query.filter(VirtualMachines.name.in_(destroyed_vms)).delete(synchronize_session=False)
+    if destroyed_sites:
+        Sites.query.filter(Sites.name.in_(destroyed_sites)).delete(synchronize_session=False)
+    database.session.commit()
+
+    report = {
+        "destroyed": sorted(destroyed),
+        "failed": {result["stack_name"]: result["error"] for result in results if not result.get("destroyed")},
+        "attempts": sum(result["attempts"] for result in results),
+        "seconds": round(time.monotonic() - started, 2),
+    }
+    logger.info(f"Teardown destroyed {len(report['destroyed'])} stacks, {len(report['failed'])} failed")
+
+    if report["failed"]:
+        raise PartialFailure(f"{len(report['failed'])} of {len(names)} stacks could not be destroyed", report)
+    return report
@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from source import logger
+from source.blobs import BlobTooLarge, blob_store
+
+
+class FetchError(Exception):
+    """
+    Raised when a remote site source can't be downloaded
+    """
+
+
+class SourceFetcher:
+    """
+    Downloads remote site sources through a pooled session with conditional GETs
+
+    The result of every download is remembered per url with the ETag and
+    Last-Modified validators of the response. The next fetch of the url sends
+    them back and a 304 answer reuses the remembered result, whose blobs are
+    already in the blob store, so an unchanged source is neither downloaded nor
+    (having the same fingerprint) deployed again.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.timeout = 30
+        self.max_bytes = 10 * 1024 * 1024
+        self.cache_size = 1000
+        self.path = None
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Configure the fetcher from the flask app config
+        :param app: Flask app
+        """
+        self.timeout = app.config["FETCH_TIMEOUT"]
+        self.max_bytes = app.config["FETCH_MAX_BYTES"]
+        self.cache_size = app.config["FETCH_CACHE_SIZE"]
+        self.path = app.config.get("FETCH_CACHE_PATH") or os.path.join(app.instance_path, "fetch_cache.json")
+
+        # one keep-alive connection pool per host, shared by every request thread
+        adapter = HTTPAdapter(pool_connections=app.config["FETCH_POOL_SIZE"],
+                              pool_maxsize=app.config["FETCH_POOL_SIZE"])
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        app.extensions["source_fetcher"] = self
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.path, "r") as file:
+                    self._entries = json.load(file)
+            except (FileNotFoundError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self._entries, file)
+        os.replace(tmp_path, self.path)
+
+    def _cached(self, url: str):
+        with self._lock:
+            entry = self._load().get(url)
+
+        # the remembered result is only usable while its blobs are still stored
+        if entry is None or not all(blob_store.exists(sha256) for sha256 in _blobs(entry["result"])):
+            return None
+        return entry
+
+    def _remember(self, url: str, response, result: dict):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+
+        with self._lock:
+            entries = self._load()
+            entries[url] = {"etag": etag, "last_modified": last_modified, "result": result,
+                            "fetched_at": time.time()}
+            for stale_url in sorted(entries, key=lambda key: entries[key]["fetched_at"])[:-self.cache_size]:
+                del entries[stale_url]
+            try:
+                self._save()
+            except OSError as err:
+                logger.warning(f"Could not persist fetch cache -> {err}")
+
+    def fetch(self, url: str, store) -> dict:
+        """
+        Download a source unless it is unchanged since the previous fetch
+        :param url: http(s) url of the source
+        :param store: called with the streaming response of a changed source, returns the job params
+        :return: job params of the source, see site_source
+        """
+        entry = self._cached(url)
+        headers = {}
+        if entry:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                if entry and response.status_code == 304:
+                    logger.info(f"{url} not modified, reusing the stored copy")
+                    return entry["result"]
+
+                response.raise_for_status()
+                result = store(response)
+        except requests.RequestException as err:
+            raise FetchError(f"Could not download {url} -> {err}")
+
+        self._remember(url, response, result)
+        return result
+
+    def fetch_page(self, url: str) -> dict:
+        """
+        Stream a single HTML page into the blob store
+        :param url: url of the page
+        :return: {"content_hash"} job params
+        """
+        def store(response):
+            # undo any transfer compression while streaming, the size cap applies to the page itself
+            response.raw.decode_content = True
+            try:
+                sha256, _ = blob_store.put_stream(response.raw, limit=self.max_bytes)
+            except BlobTooLarge:
+                raise FetchError(f"{url} is larger than {self.max_bytes} bytes")
+            return {"content_hash": sha256}
+
+        return self.fetch(url, store)
+
+
+def _blobs(result: dict) -> list:
+    if result.get("content_hash"):
+        return [result["content_hash"]]
+    return [entry["sha256"] for entry in result.get("files", {}).values()]
+
+
+source_fetcher = SourceFetcher()
@@ -0,0 +1,49 @@
+import hashlib
+import json
+
+
+def fingerprint(**inputs) -> str:
+    """
+    Stable hash of the desired inputs of a stack
+    :param inputs: json serializable inputs of the pulumi program
+    :return: hex encoded sha256
+    """
+    payload = json.dumps(inputs, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def site_fingerprint(content_hash: str = None, files: dict = None) -> str:
+    """
+    Fingerprint of a static site deployment
+    :param content_hash: sha256 of the HTML of a single page site
+    :param files: manifest of an archive site, object key to {"sha256", "content_type"}
+    """
+    if files:
+        return fingerprint(program="site", files={
+            key: [entry["sha256"], entry["content_type"]] for key, entry in files.items()
+        })
+    return fingerprint(program="site", content=content_hash)
+
+
+def vm_fingerprint(keydata: str, instance_type: str, region: str, ami: str) -> str:
+    """
+    Fingerprint of a virtual machine deployment
+    :param keydata: public key used to connect to the VM
+    :param instance_type: ec2 instance type
+    :param region: aws region
+    :param ami: AMI choice
+    """
+    return fingerprint(program="vm", keydata=(keydata or "").strip(), instance_type=instance_type,
+                       region=region, ami=ami)
+
+
+def fleet_fingerprint(keydata: str, instances: list, region: str, ami: str) -> str:
+    """
+    Fingerprint of a fleet deployment
+    :param keydata: public key used to connect to the instances
+    :param instances: list of {"name", "instance_type"} specs
+    :param region: aws region
+    :param ami: AMI choice
+    """
+    return fingerprint(program="fleet", keydata=(keydata or "").strip(), instances=instances,
+                       region=region, ami=ami)
@@ -1,42 +1,88 @@
+import base64
+import hashlib
+import importlib
 import json
 import os
 from pathlib import Path
 
-import pulumi
-import pulumi_aws as aws
+from source import logger
+
+AWS_PLUGIN_VERSION = "v4.0.0"
+
+
+class _LazyModule:
+    """
+    Stand-in for a module that is only imported on first attribute access
+
+    pulumi and especially pulumi_aws are slow to import, deferring them keeps
+    app startup fast until a deployment actually needs them.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+pulumi = _LazyModule("pulumi")
+aws = _LazyModule("pulumi_aws")
 # pulumi automation framework
-import pulumi.automation as auto
+auto = _LazyModule("pulumi.automation")
 
-from source import logger
+
+def plugin_installed(name: str, version: str, kind: str = "resource") -> bool:
+    """
+    Check the pulumi plugin cache without starting the CLI
+    :param name: plugin name
+    :param version: plugin version, e.g. "v4.0.0"
+    :param kind: plugin kind
+    """
+    pulumi_home = os.environ.get("PULUMI_HOME") or os.path.join(str(Path.home()), ".pulumi")
+    plugin_dir = os.path.join(pulumi_home, "plugins", f"{kind}-{name}-{version}")
+    # the CLI leaves a .partial marker next to plugins it did not finish installing
+    return os.path.isdir(plugin_dir) and not os.path.exists(f"{plugin_dir}.partial")
 
 
 def ensure_plugins():
     """
-    Install plugins
+    Install plugins that are missing from the plugin cache
     """
+    if plugin_installed("aws", AWS_PLUGIN_VERSION):
+        return
+
+    logger.info("Installing plugin")
     work_space = auto.LocalWorkspace()
-    work_space.install_plugin("aws", "v4.0.0")
+    work_space.install_plugin("aws", AWS_PLUGIN_VERSION)
 
 
-def create_pulumi_program_s3(content: str):
+def create_pulumi_program_s3(files: dict, content_hash: str = None):
     """
     Create the website and deploy it to amazon s3 bucket
-    :param content: HTML content - HTML code pass by the user
+    :param files: objects of the site, object key to {"path", "content_type", "cache_control"} and
+        "content_encoding" for pre-compressed files, see SiteBuilder.build
+    :param content_hash: sha256 of the HTML of a single page site
     """
     # create a bucket and expose a website index document
     site_bicket = aws.s3.Bucket(
         "s3-website-bucket", website=aws.s3.BucketWebsiteArgs(index_document="index.html")
     )
-    index_content = content
 
-    # write our index.html into the site bucket
-    aws.s3.BucketObject(
-        "index",
-        bucket=site_bicket.id,
-        content=index_content,
-        key="index.html",
-        content_type="text/html; charset=utf-8",
-    )
+    # one object per file, the paths are content-addressed so pulumi only
+    # updates the objects whose content changed
+    for key, file in sorted(files.items()):
+        aws.s3.BucketObject(
+            "index" if key == "index.html" else f"object-{key}",
+            bucket=site_bicket.id,
+            source=pulumi.FileAsset(file["path"]),
+            key=key,
+            content_type=file["content_type"],
+            content_encoding=file.get("content_encoding"),
+            cache_control=file.get("cache_control"),
+        )
 
     # set the access policy for the bucket so all objects are readable
     aws.s3.BucketPolicy(
@@ -58,20 +104,49 @@ def create_pulumi_program_s3(content: str):
 
     # export the website url
     pulumi.export("website_url", site_bicket.website_endpoint)
-    pulumi.export("website_content", index_content)
+    # the content itself stays in the blob store, only its hash goes into the checkpoint
+    if content_hash:
+        pulumi.export("website_content_hash", content_hash)
 
 
-def create_pulumi_program_vms(keydata: str, instance_type: str):
+def key_fingerprint(public_key: str) -> str:
     """
-    Create the virtual machines and deploy it to amazon ec2 instance
-    :param keydata: 
-    :param instance_type: 
+    SHA256 fingerprint of an OpenSSH public key, in the format of ssh-keygen -l
+    :param public_key: "<type> <base64 key> [comment]"
     """
-    # choose the latest minimal amzn2 linux AMI
-    # TODO: make this something the user can choose
-    ami = aws.ec2.get_ami(most_recent=True,
-                          owners=["amazon"],
-                          filters=[aws.GetAmiFilterArgs(name="name", values=["*amzn2-ami-minimal-hvm*"])])
+    parts = public_key.split()
+    try:
+        blob = base64.b64decode(parts[1], validate=True)
+    except (IndexError, ValueError):
+        return "(unparsable key)"
+    digest = base64.b64encode(hashlib.sha256(blob).digest()).decode().rstrip("=")
+    return f"{parts[0]} SHA256:{digest}"
+
+
+def _ami_id(ami: dict = None):
+    """
+    Id of the AMI to boot, looked up only when the caller has no pinned id
+    :param ami: {"id": ...} or the {"owners", "filters"} of a get_ami lookup
+    """
+    if ami and ami.get("id"):
+        return ami["id"]
+
+    # default to the latest minimal amzn2 linux AMI
+    ami = ami or {"owners": ["amazon"], "filters": [{"name": "name", "values": ["*amzn2-ami-minimal-hvm*"]}]}
+    return aws.ec2.get_ami(most_recent=True,
+                           owners=ami["owners"],
+                           filters=[aws.GetAmiFilterArgs(name=item["name"], values=item["values"])
+                                    for item in ami["filters"]]).id
+
+
+def _vm_base(keydata: str, ami: dict = None):
+    """
+    AMI, security group and keypair shared by the instances of a VM stack
+    :param keydata: public key used to connect to the instances
+    :param ami: pinned AMI id or lookup parameters, see _ami_id
+    """
+    ami_id = _ami_id(ami)
+    pulumi.export("ami_id", ami_id)
     
     group = aws.ec2.SecurityGroup("web-secgrp",
                                   description="Enable SSH access",
@@ -90,16 +165,55 @@ def create_pulumi_program_vms(keydata: str, instance_type: str):
             public_key = file.read()
     
     public_key = public_key.strip()
-    logger.info(f"Public Key: '{public_key}'")
+    # the key itself does not belong in the logs, its fingerprint identifies it
+    logger.info(f"Public key {key_fingerprint(public_key)}")
 
     keypair = aws.ec2.KeyPair("dlami-keypair", public_key=public_key)
+    return ami_id, group, keypair
+
+
+def create_pulumi_program_vms(keydata: str, instance_type: str, ami: dict = None):
+    """
+    Create the virtual machines and deploy it to amazon ec2 instance
+    :param keydata: 
+    :param instance_type: 
+    :param ami: pinned AMI id or lookup parameters, see _ami_id
+    """
+    ami_id, group, keypair = _vm_base(keydata, ami)
     server = aws.ec2.Instance("dlami-server",
                               instance_type=instance_type,
                               vpc_security_group_ids=[group.id],
                               key_name=keypair.id,
-                              ami=ami.id)
+                              ami=ami_id)
 
     pulumi.export("instance_type", server.instance_type)
     pulumi.export("public_key", keypair.public_key)
     pulumi.export("public_ip", server.public_ip)
     pulumi.export("public_dns", server.public_dns)
+
+
+def create_pulumi_program_fleet(keydata: str, instances: list, ami: dict = None):
+    """
+    Create a fleet of virtual machines sharing one security group and keypair
+    :param keydata: public key used to connect to every instance
+    :param instances: list of {"name", "instance_type"} specs, names must be unique
+    :param ami: pinned AMI id or lookup parameters, see _ami_id
+    """
+    ami_id, group, keypair = _vm_base(keydata, ami)
+
+    members = {}
+    for spec in instances:
+        server = aws.ec2.Instance(f"fleet-{spec['name']}",
+                                  instance_type=spec["instance_type"],
+                                  vpc_security_group_ids=[group.id],
+                                  key_name=keypair.id,
+                                  ami=ami_id,
+                                  tags={"Name": spec["name"]})
+        members[spec["name"]] = {
+            "instance_type": server.instance_type,
+            "public_ip": server.public_ip,
+            "public_dns": server.public_dns,
+        }
+
+    pulumi.export("public_key", keypair.public_key)
+    pulumi.export("instances", members)
@@ -0,0 +1,248 @@
+import atexit
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from source import database, logger
+from source.models import OperationHistory
+
+# seconds between two retention prunes of a process
+PRUNE_INTERVAL = 3600
+
+
+def _program_and_kind(job_kind: str) -> tuple:
+    # "site.create" -> ("site", "create"), "vm.update-fleet" -> ("fleet", "update"), "teardown" -> ("all", "teardown")
+    prefix, _, operation = job_kind.rpartition(".")
+    operation, _, variant = operation.partition("-")
+    return variant or prefix or "all", operation
+
+
+def percentile(values: list, share: float):
+    """
+    Nearest-rank percentile
+    :param values: sorted values
+    :param share: 0.5 for the median, 0.95 for p95
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(share * len(values))) - 1))]
+
+
+class History:
+    """
+    Append-only history of the stack operations run by the job workers
+
+    A job thread collects the phase timings and resource changes of its
+    operation, the finished record is queued and a writer thread inserts the
+    queued records in batches, every `flush_interval` seconds or once
+    `batch_size` of them are waiting. The writer also deletes records older
+    than `retention_days`.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.batch_size = 100
+        self.flush_interval = 5.0
+        self.retention_days = 90
+        self._pending = []
+        self._local = threading.local()
+        self._condition = threading.Condition()
+        self._pruned_at = None
+        self._pid = None
+        self._thread = None
+
+    def init_app(self, app):
+        """
+        Configure the history from the flask app config
+        :param app: Flask app
+        """
+        self.app = app
+        self.batch_size = app.config["HISTORY_BATCH_SIZE"]
+        self.flush_interval = app.config["HISTORY_FLUSH_INTERVAL"]
+        self.retention_days = app.config["HISTORY_RETENTION_DAYS"]
+        app.extensions["history"] = self
+        # records of jobs that finished right before shutdown
+        atexit.register(self.flush)
+
+    def begin(self, job):
+        """
+        Start collecting the details of a job run by the current thread
+        :param job: the DeploymentJobs row
+        """
+        program, kind = _program_and_kind(job.kind)
+        self._local.current = {"program": program, "kind": kind, "resource_changes": {}}
+
+    def note(self, **fields):
+        """
+        Add details of the operation run by the current thread, e.g. instance_type or region
+        """
+        current = getattr(self._local, "current", None)
+        if current is not None:
+            current.update({name: value for name, value in fields.items() if value is not None})
+
+    def count_changes(self, result):
+        """
+        Add the resource changes of an up or destroy result to the operation of the current thread
+        :param result: auto.UpResult or auto.DestroyResult
+        """
+        current = getattr(self._local, "current", None)
+        changes = result.summary.resource_changes if result is not None and result.summary else None
+        if current is None or not changes:
+            return
+        for change, count in changes.items():
+            current["resource_changes"][change] = current["resource_changes"].get(change, 0) + count
+
+    def end(self, job, phases: dict):
+        """
+        Queue the record of a finished job, the writer thread inserts it
+        :param job: the finished DeploymentJobs row
+        :param phases: seconds per phase, see metrics.collect
+        """
+        current = getattr(self._local, "current", None)
+        self._local.current = None
+        if current is None or job.started_at is None or job.finished_at is None:
+            return
+
+        record = {
+            "job_id": job.id,
+            "stack_name": job.stack_name,
+            "program": current["program"],
+            "kind": current["kind"],
+            "instance_type": current.get("instance_type"),
+            "region": current.get("region"),
+            "status": job.status,
+            "phases": json.dumps({name: round(seconds, 4) for name, seconds in phases.items()}),
+            "resource_changes": json.dumps(current["resource_changes"]),
+            "duration": job.duration,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+            "refrence_key": job.refrence_key,
+        }
+        self._ensure_thread()
+        with self._condition:
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+
+    def _ensure_thread(self):
+        # started lazily, once per process, like the job workers
+        with self._condition:
+            if self._pid == os.getpid() and self._thread:
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name="history-writer", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                if len(self._pending) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+            try:
+                self.flush()
+                if self._pruned_at is None or time.monotonic() - self._pruned_at > PRUNE_INTERVAL:
+                    self._pruned_at = time.monotonic()
+                    self.prune()
+            except Exception as err:
+                logger.warning(f"History writer failed -> {err}")
+
+    def flush(self) -> int:
+        """
+        Insert the queued records
+        :return: number of inserted records
+        """
+        with self._condition:
+            records, self._pending = self._pending, []
+        if not records or self.app is None:
+            return 0
+
+        with self.app.app_context():
+            try:
+                # one multi-row insert per batch instead of a commit per job
+                for start in range(0, len(records), self.batch_size):
+                    database.session.execute(insert(OperationHistory), records[start:start + self.batch_size])
+                database.session.commit()
+            except Exception as err:
+                database.session.rollback()
+                logger.warning(f"Could not write {len(records)} history records -> {err}")
+                return 0
+        return len(records)
+
+    def prune(self) -> int:
+        """
+        Delete the records older than the retention period
+        :return: number of deleted records
+        """
+        if self.retention_days <= 0:
+            return 0
+
+        cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+        with self.app.app_context():
+            deleted = OperationHistory.query.filter(OperationHistory.finished_at < cutoff) \
+                .delete(synchronize_session=False)
+            database.session.commit()
+        if deleted:
+            logger.info(f"Pruned {deleted} history records older than {self.retention_days} days")
+        return deleted
+
+    def stats(self, days: int = 7, program: str = None) -> list:
+        """
+        Duration percentiles of the operations per program, kind and instance type
+        :param days: window of finished operations to aggregate
+        :param program: only aggregate site, vm or fleet operations
+        :return: one dict per group, p50/p95 of the window and p50 of the window before it
+        """
+        now = datetime.utcnow()
+        window = timedelta(days=days)
+        query = database.session.query(
+            OperationHistory.program,
+            OperationHistory.kind,
+            OperationHistory.instance_type,
+            OperationHistory.status,
+            OperationHistory.duration,
+            OperationHistory.finished_at,
+        ).filter(OperationHistory.finished_at >= now - 2 * window)
+        if program:
+            query = query.filter(OperationHistory.program == program)
+
+        groups = {}
+        for row in query:
+            group = groups.setdefault((row.program, row.kind, row.instance_type or ""), {
+                "count": 0, "failed": 0, "durations": [], "previous": [],
+            })
+            if row.finished_at < now - window:
+                # the window before, to spot operations getting slower
+                if row.status == "succeeded":
+                    group["previous"].append(row.duration)
+                continue
+
+            group["count"] += 1
+            if row.status == "succeeded":
+                group["durations"].append(row.duration)
+            else:
+                group["failed"] += 1
+
+        stats = []
+        for (program_name, kind, instance_type), group in sorted(groups.items()):
+            if not group["count"]:
+                continue
+            durations = sorted(group["durations"])
+            stats.append({
+                "program": program_name,
+                "kind": kind,
+                "instance_type": instance_type or None,
+                "count": group["count"],
+                "failed": group["failed"],
+                "p50": percentile(durations, 0.5),
+                "p95": percentile(durations, 0.95),
+                "max": durations[-1] if durations else None,
+                "previous_p50": percentile(sorted(group["previous"]), 0.5),
+            })
+        return stats
+
+
+history = History()
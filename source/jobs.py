@@ -0,0 +1,479 @@
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from source import database, logger
+from source.fingerprints import fingerprint
+from source.history import history
+from source.locks import StackBusy, stack_locks
+from source.log_streams import log_streams
+from source.metrics import metrics
+from source.models import DeploymentJobs
+
+# waiting jobs belong to a batch and are queued once the batch has a free slot
+ACTIVE_STATUSES = ("waiting", "queued", "running")
+
+# seconds a job may run before its stack lock is taken, a lock missing after that means the job died
+LOCK_GRACE = 30
+
+
+class PartialFailure(Exception):
+    """
+    Raised by handlers that finished part of their work, the outputs are still recorded
+    """
+
+    def __init__(self, message: str, outputs: dict):
+        super().__init__(message)
+        self.outputs = outputs
+
+
+class InProcessBroker:
+    """
+    Hands job ids to the worker threads of the current process
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def put(self, job_id: str):
+        self._queue.put(job_id)
+
+    def get(self, timeout: float = 1.0):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class RedisBroker:
+    """
+    Shares job ids between every app process through a redis list
+    """
+
+    def __init__(self, url: str, key: str = "deployment-jobs"):
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self._key = key
+
+    def put(self, job_id: str):
+        self._client.rpush(self._key, job_id)
+
+    def get(self, timeout: float = 1.0):
+        item = self._client.blpop(self._key, timeout=max(1, int(timeout)))
+        return item[1].decode() if item else None
+
+
+class JobQueue:
+    """
+    Bounded pool of worker threads running stack operations outside the request
+    """
+
+    def __init__(self):
+        self.app = None
+        self.broker = None
+        self.handlers = {}
+        self._workers = []
+        # ids of the jobs the worker threads of this process are running
+        self._running = set()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Bind the queue to the flask app and pick a broker
+        :param app: Flask app
+        """
+        self.app = app
+        redis_url = app.config.get("REDIS_URL")
+        self.broker = RedisBroker(redis_url) if redis_url else InProcessBroker()
+        app.extensions["job_queue"] = self
+
+    def handler(self, kind: str):
+        """
+        Register the function that runs jobs of the given kind
+        :param kind: job kind, e.g. "site.create"
+        """
+        def decorator(func):
+            self.handlers[kind] = func
+            return func
+        return decorator
+
+    def submit(self, kind: str, stack_name: str, params: dict, user_id=None) -> DeploymentJobs:
+        """
+        Record a new job and hand it to the workers
+        :param kind: job kind, must have a registered handler
+        :param stack_name: name of the stack the job operates on
+        :param params: keyword arguments for the handler, must be json serializable
+        :param user_id: id of the user who requested the job
+        :return: the queued job
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"No handler registered for '{kind}' jobs")
+
+        op_key = fingerprint(kind=kind, params=params)
+        with stack_locks.submitting(stack_name):
+            # an identical operation in flight is reused, anything else on the stack conflicts
+            in_flight = active_job(stack_name)
+            if in_flight is not None:
+                if in_flight.op_key == op_key and in_flight.refrence_key == user_id:
+                    logger.info(f"Coalesced {kind} for {stack_name} onto job {in_flight.id}")
+                    return in_flight
+                raise StackBusy(stack_name, in_flight)
+
+            job = DeploymentJobs(
+                id=uuid.uuid4().hex,
+                kind=kind,
+                stack_name=stack_name,
+                status="queued",
+                params=json.dumps(params),
+                op_key=op_key,
+                refrence_key=user_id,
+            )
+            database.session.add(job)
+            database.session.commit()
+
+        self._ensure_workers()
+        self.broker.put(job.id)
+        logger.info(f"Queued {kind} job {job.id} for {stack_name}")
+        return job
+
+    def submit_batch(self, kind: str, items: list, parallelism: int, user_id=None) -> str:
+        """
+        Record a batch of jobs of which at most `parallelism` run at the same time
+        :param kind: job kind, must have a registered handler
+        :param items: list of (stack name, params) tuples
+        :param parallelism: maximum number of jobs of the batch in flight
+        :param user_id: id of the user who requested the jobs
+        :return: the batch id
+        :raises StackBusy: when one of the stacks already has a job in flight, nothing is queued then
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"No handler registered for '{kind}' jobs")
+
+        batch_id = uuid.uuid4().hex
+        stack_names = [stack_name for stack_name, _ in items]
+        with stack_locks.submitting(*stack_names):
+            for stack_name in stack_names:
+                in_flight = active_job(stack_name)
+                if in_flight is not None:
+                    raise StackBusy(stack_name, in_flight)
+
+            jobs = [
+                DeploymentJobs(
+                    id=uuid.uuid4().hex,
+                    kind=kind,
+                    stack_name=stack_name,
+                    status="queued" if index < parallelism else "waiting",
+                    params=json.dumps(params),
+                    op_key=fingerprint(kind=kind, params=params),
+                    batch_id=batch_id,
+                    refrence_key=user_id,
+                )
+                for index, (stack_name, params) in enumerate(items)
+            ]
+            database.session.add_all(jobs)
+            database.session.commit()
+
+        self._ensure_workers()
+        for job in jobs:
+            if job.status == "queued":
+                self.broker.put(job.id)
+
+        logger.info(f"Queued batch {batch_id} of {len(jobs)} {kind} jobs, {parallelism} at a time")
+        return batch_id
+
+    def cancel_batch(self, batch_id: str) -> int:
+        """
+        Cancel the jobs of a batch that have not started yet, running jobs are left to finish
+        :param batch_id: id of the batch
+        :return: number of cancelled jobs
+        """
+        cancelled = DeploymentJobs.query.filter(
+            DeploymentJobs.batch_id == batch_id,
+            DeploymentJobs.status.in_(("waiting", "queued")),
+        ).update({"status": "cancelled", "finished_at": datetime.utcnow()}, synchronize_session=False)
+        database.session.commit()
+        return cancelled
+
+    def _dispatch_next(self, batch_id: str):
+        # hand the next waiting job of the batch to the workers, the conditional
+        # update makes sure only one finishing job claims it
+        while True:
+            job = DeploymentJobs.query.filter_by(batch_id=batch_id, status="waiting") \
+                .order_by(DeploymentJobs.created_at).first()
+            if job is None:
+                return
+
+            claimed = DeploymentJobs.query.filter_by(id=job.id, status="waiting") \
+                .update({"status": "queued"}, synchronize_session=False)
+            database.session.commit()
+            if claimed:
+                self.broker.put(job.id)
+                return
+
+    def _ensure_workers(self):
+        # workers are started lazily so forked gunicorn workers get their own threads
+        with self._lock:
+            if self._pid == os.getpid() and self._workers:
+                return
+            self._pid = os.getpid()
+            self._workers = []
+            for index in range(self.app.config["DEPLOY_WORKERS"]):
+                worker = threading.Thread(target=self._work, name=f"deploy-worker-{index}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            try:
+                job_id = self.broker.get()
+                if job_id is not None:
+                    self.run(job_id)
+            except Exception as err:
+                # a worker thread outlives any error, run already failed the job it was on
+                logger.critical(f"Deploy worker error -> {err}")
+                time.sleep(1)
+
+    def run(self, job_id: str):
+        """
+        Run a queued job and record its result
+        :param job_id: id of the job
+        """
+        with self.app.app_context():
+            # one worker, of any process, moves a queued job to running
+            claimed = DeploymentJobs.query.filter_by(id=job_id, status="queued").update({
+                "status": "running",
+                "started_at": datetime.utcnow(),
+                "worker": worker_name(),
+            }, synchronize_session=False)
+            database.session.commit()
+            if not claimed:
+                return
+
+            job = database.session.get(DeploymentJobs, job_id)
+            kind, stack_name, batch_id = job.kind, job.stack_name, job.batch_id
+            self._running.add(job_id)
+            locked = False
+            try:
+                # fail fast without touching the pulumi CLI when another worker holds the stack
+                locked = stack_locks.acquire(stack_name, job_id)
+                if locked:
+                    self._execute(job)
+                else:
+                    logger.warning(f"{kind} job {job_id} skipped, {stack_name} is locked")
+                    job.status = "failed"
+                    job.error = str(StackBusy(stack_name))
+                    job.finished_at = datetime.utcnow()
+                    database.session.commit()
+            except Exception as err:
+                database.session.rollback()
+                logger.critical(f"{kind} job {job_id} for {stack_name} could not be run -> {err}")
+                fail_job(job_id, str(err))
+            finally:
+                if locked:
+                    stack_locks.release(stack_name, job_id)
+                self._running.discard(job_id)
+
+            if batch_id:
+                self._dispatch_next(batch_id)
+
+    def _execute(self, job: DeploymentJobs):
+        # engine output of the job is streamed to its log stream
+        log_streams.begin(job.id, job.stack_name)
+        history.begin(job)
+        with metrics.collect() as phases:
+            try:
+                outputs = self.handlers[job.kind](**json.loads(job.params))
+                job.outputs = json.dumps(outputs or {})
+                job.status = "succeeded"
+            except Exception as err:
+                database.session.rollback()
+                logger.critical(f"{job.kind} job {job.id} for {job.stack_name} failed -> {err}")
+                if isinstance(err, PartialFailure):
+                    job.outputs = json.dumps(err.outputs)
+                job.error = str(err)
+                job.status = "failed"
+            finally:
+                log_streams.end()
+
+        job.finished_at = datetime.utcnow()
+        database.session.commit()
+        metrics.observe_job(job.kind, job.status, job.duration)
+        # queued, the history writer inserts it with the records of other jobs
+        history.end(job, phases)
+
+    def worker_alive(self, job: DeploymentJobs):
+        """
+        Whether the process and worker thread running a job are still there
+        :param job: a running job
+        :return: True or False, None when it can't be told from this host
+        """
+        host, _, pid = (job.worker or "").rpartition(":")
+        if not pid.isdigit() or host != socket.gethostname():
+            # ran before workers were recorded or on another host
+            return None
+
+        if int(pid) == os.getpid():
+            return job.id in self._running
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def recover(self):
+        """
+        Pick up the jobs a previous run of the app left behind, called once at boot
+        """
+        active = DeploymentJobs.query.filter(DeploymentJobs.status.in_(ACTIVE_STATUSES)).all()
+        for job in active:
+            if job_is_stale(job):
+                logger.warning(f"{job.status.capitalize()} job {job.id} for {job.stack_name} is stale, marking it failed")
+                fail_job(job.id, STALE_ERROR)
+
+        queued = []
+        if isinstance(self.broker, InProcessBroker):
+            # the in-process queue died with the previous process, run() makes sure
+            # a job another live process also queued runs only once
+            queued = [job_id for (job_id,) in database.session.query(DeploymentJobs.id)
+                      .filter_by(status="queued").order_by(DeploymentJobs.created_at)]
+
+        # batches whose running jobs are gone have nothing left to dispatch their waiting jobs
+        stalled = [
+            batch_id for (batch_id,) in database.session.query(DeploymentJobs.batch_id)
+            .filter_by(status="waiting").distinct()
+            if not DeploymentJobs.query.filter(
+                DeploymentJobs.batch_id == batch_id,
+                DeploymentJobs.status.in_(("queued", "running")),
+            ).first()
+        ]
+
+        if queued or stalled:
+            self._ensure_workers()
+            for job_id in queued:
+                self.broker.put(job_id)
+            for batch_id in stalled:
+                self._dispatch_next(batch_id)
+            logger.info(f"Recovered {len(queued)} queued jobs and {len(stalled)} stalled batches")
+
+
+STALE_ERROR = "The job was abandoned by a stopped worker or did not finish in time"
+
+
+def job_is_stale(job: DeploymentJobs) -> bool:
+    """
+    True when a job in flight can't finish anymore and must not hold its stack
+    :param job: a waiting, queued or running job
+    """
+    since = job.started_at or job.created_at
+    age = (datetime.utcnow() - since).total_seconds() if since else 0
+    # the stack lock of a job expires after the same time
+    if age > stack_locks.ttl:
+        return True
+    if job.status != "running":
+        return False
+
+    if not stack_locks.shared:
+        # the locks of other processes are invisible here, their workers are not
+        alive = job_queue.worker_alive(job)
+        if alive is not None:
+            return not alive
+    return age > LOCK_GRACE and not stack_locks.held(job.stack_name)
+
+
+def worker_name() -> str:
+    """
+    Name of the current process in DeploymentJobs.worker
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def fail_job(job_id: str, error: str):
+    """
+    Mark a job that is still in flight as failed
+    :param job_id: id of the job
+    :param error: reason shown to the user
+    """
+    try:
+        DeploymentJobs.query.filter(
+            DeploymentJobs.id == job_id,
+            DeploymentJobs.status.in_(ACTIVE_STATUSES),
+        ).update({"status": "failed", "error": error, "finished_at": datetime.utcnow()}, synchronize_session=False)
+        database.session.commit()
+    except Exception as err:
+        database.session.rollback()
+        logger.critical(f"Could not mark job {job_id} failed -> {err}")
+
+
+def active_job(stack_name: str):
+    """
+    The job in flight for a stack, None when the stack is idle, stale jobs are failed on the way
+    :param stack_name: name of the stack
+    """
+    while True:
+        job = DeploymentJobs.query.filter(
+            DeploymentJobs.stack_name == stack_name,
+            DeploymentJobs.status.in_(ACTIVE_STATUSES),
+        ).order_by(DeploymentJobs.created_at).first()
+        if job is None or not job_is_stale(job):
+            return job
+
+        logger.warning(f"{job.status.capitalize()} job {job.id} for {stack_name} is stale, marking it failed")
+        fail_job(job.id, STALE_ERROR)
+
+
+def stack_in_flight(stack_name: str) -> bool:
+    """
+    True when a job for the stack is queued or running
+    :param stack_name: name of the stack
+    """
+    return active_job(stack_name) is not None
+
+
+def batch_summary(batch_id: str) -> dict:
+    """
+    Per-stack results of a batch and the number of jobs in each status
+    :param batch_id: id of the batch
+    """
+    jobs = DeploymentJobs.query.filter_by(batch_id=batch_id).order_by(DeploymentJobs.created_at).all()
+    counts = {}
+    for job in jobs:
+        counts[job.status] = counts.get(job.status, 0) + 1
+
+    return {
+        "batch_id": batch_id,
+        "total": len(jobs),
+        "done": not any(job.status in ACTIVE_STATUSES for job in jobs),
+        "counts": counts,
+        "jobs": [job.to_dict() for job in jobs],
+    }
+
+
+def visible_jobs(user_id: int, prefix, failed_within: int = 3600):
+    """
+    Jobs to show on a list page: everything in flight plus recent failures
+    :param user_id: owner of the jobs
+    :param prefix: job kind prefix, e.g. "site.", or a tuple of prefixes
+    :param failed_within: how long (seconds) a failed job stays visible
+    """
+    since = datetime.utcnow() - timedelta(seconds=failed_within)
+    prefixes = (prefix,) if isinstance(prefix, str) else prefix
+    return DeploymentJobs.query.filter(
+        DeploymentJobs.refrence_key == user_id,
+        database.or_(*[DeploymentJobs.kind.startswith(item) for item in prefixes]),
+        database.or_(
+            DeploymentJobs.status.in_(ACTIVE_STATUSES),
+            database.and_(DeploymentJobs.status == "failed", DeploymentJobs.finished_at >= since),
+        ),
+    ).order_by(DeploymentJobs.created_at.desc()).all()
+
+
+job_queue = JobQueue()
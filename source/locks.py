@@ -0,0 +1,179 @@
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from source import logger
+
+
+class StackBusy(Exception):
+    """
+    Raised when a stack already has a conflicting operation in flight
+    """
+
+    def __init__(self, stack_name: str, job=None):
+        super().__init__(f"Stack '{stack_name}' already has an operation in progress")
+        self.stack_name = stack_name
+        # the job holding the stack, when known
+        self.job = job
+
+
+def internal_name(name: str) -> str:
+    """
+    Lock or job name of an operation that isn't tied to one stack
+    :param name: e.g. reconciler
+    :return: a name no stack can have, pulumi stack names can't hold a colon
+    """
+    return f"internal:{name}"
+
+
+class InProcessLocks:
+    """
+    Stack locks shared by the threads of the current process
+    """
+
+    # other processes can't see these locks
+    shared = False
+
+    def __init__(self):
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, name: str, owner: str, ttl: int) -> bool:
+        with self._lock:
+            if self._owners.get(name, owner) != owner:
+                return False
+            self._owners[name] = owner
+            return True
+
+    def release(self, name: str, owner: str):
+        with self._lock:
+            if self._owners.get(name) == owner:
+                del self._owners[name]
+
+    def held(self, name: str) -> bool:
+        with self._lock:
+            return name in self._owners
+
+
+class RedisLocks:
+    """
+    Stack locks shared by every app process through redis
+
+    Locks expire after their ttl so a crashed worker can't hold a stack forever.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "stack-lock:"):
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._held = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, name: str, owner: str, ttl: int) -> bool:
+        with self._lock:
+            if name in self._held:
+                return self._held[name][0] == owner
+
+            lock = self._client.lock(f"{self._prefix}{name}", timeout=ttl, blocking=False, thread_local=False)
+            if not lock.acquire(token=owner):
+                return False
+            self._held[name] = (owner, lock)
+            return True
+
+    def release(self, name: str, owner: str):
+        with self._lock:
+            held = self._held.get(name)
+            if held is None or held[0] != owner:
+                return
+            del self._held[name]
+
+        try:
+            held[1].release()
+        except Exception as err:
+            # the lock expired and may belong to someone else now, leave it alone
+            logger.warning(f"Could not release lock of {name} -> {err}")
+
+    def held(self, name: str) -> bool:
+        return bool(self._client.exists(f"{self._prefix}{name}"))
+
+
+class StackLocks:
+    """
+    Per-stack locks taken by the job workers while they run a stack operation,
+    so two operations never reach the pulumi CLI for the same stack at once
+    """
+
+    def __init__(self):
+        self.ttl = 3600
+        self.backend = InProcessLocks()
+        # short lock around checking for in flight jobs and recording a new one
+        self._submit_lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Pick the lock backend from the flask app config
+        :param app: Flask app
+        """
+        self.ttl = app.config["STACK_LOCK_TTL"]
+        redis_url = app.config.get("REDIS_URL")
+        self.backend = RedisLocks(redis_url) if redis_url else InProcessLocks()
+        app.extensions["stack_locks"] = self
+
+    def acquire(self, stack_name: str, owner: str) -> bool:
+        """
+        Take the lock of a stack without waiting
+        :param stack_name: name of the stack
+        :param owner: id of the operation taking the lock, the job id
+        :return: True when the lock is now held by the owner
+        """
+        return self.backend.acquire(stack_name, owner, self.ttl)
+
+    def release(self, stack_name: str, owner: str):
+        """
+        Release the lock of a stack if the owner still holds it
+        :param stack_name: name of the stack
+        :param owner: id of the operation that took the lock
+        """
+        self.backend.release(stack_name, owner)
+
+    def held(self, stack_name: str) -> bool:
+        return self.backend.held(stack_name)
+
+    @property
+    def shared(self) -> bool:
+        """
+        True when the locks are seen by every app process
+        """
+        return self.backend.shared
+
+    @contextmanager
+    def submitting(self, *stack_names: str):
+        """
+        Serialize submissions for stacks, across processes when redis is configured
+        :param stack_names: names of the stacks, a batch locks all of its stacks at once
+        """
+        owner = uuid.uuid4().hex
+        acquired = []
+        with self._submit_lock:
+            try:
+                # in a fixed order so two batches sharing stacks can't wait on each other
+                for stack_name in sorted(set(stack_names)):
+                    name = f"submit:{stack_name}"
+                    for _ in range(50):
+                        if self.backend.acquire(name, owner, 10):
+                            break
+                        time.sleep(0.1)
+                    else:
+                        raise StackBusy(stack_name)
+                    acquired.append(name)
+                yield
+            finally:
+                for name in acquired:
+                    self.backend.release(name, owner)
+
+
+stack_locks = StackLocks()
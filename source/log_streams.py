@@ -0,0 +1,216 @@
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+from source import logger
+from source.logs import bind
+
+# engine output lines, every line reaches the stack log file, the console only a sample
+engine_logger = logger.getChild("engine")
+
+# entry ids of a redis stream, "<milliseconds>-<sequence>"
+REDIS_ENTRY_ID = re.compile(r"^\d+(-\d+)?$")
+
+
+class MemoryLogStream:
+    """
+    Bounded ring buffer of the engine output of one stack operation
+
+    Every line gets an increasing offset, readers resume from the last offset
+    they saw and only miss lines that already fell out of the buffer.
+    """
+
+    def __init__(self, max_lines: int):
+        self._lines = deque(maxlen=max_lines)
+        self._next = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def write(self, line: str):
+        with self._condition:
+            self._lines.append((self._next, line))
+            self._next += 1
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def read(self, since, timeout: float):
+        """
+        Lines after an offset, waiting up to `timeout` seconds for new ones
+        :param since: last offset the reader saw, None to read from the start
+        :param timeout: seconds to wait when there is nothing new
+        :return: (list of (offset, line), closed)
+        """
+        start = -1 if since is None else int(since)
+        with self._condition:
+            if self._next - 1 <= start and not self._closed:
+                self._condition.wait(timeout)
+            lines = [(offset, line) for offset, line in self._lines if offset > start]
+            return lines, self._closed and (not lines or lines[-1][0] == self._next - 1)
+
+
+class RedisLogStream:
+    """
+    Log stream kept in a capped redis stream, so any app process can tail it
+    """
+
+    def __init__(self, client, key: str, max_lines: int, retention: int):
+        self._client = client
+        self._key = key
+        self._max_lines = max_lines
+        self._retention = retention
+
+    def write(self, line: str):
+        self._client.xadd(self._key, {"line": line}, maxlen=self._max_lines, approximate=True)
+
+    def close(self):
+        self._client.xadd(self._key, {"eof": "1"}, maxlen=self._max_lines, approximate=True)
+        self._client.expire(self._key, self._retention)
+
+    def read(self, since, timeout: float):
+        entries = self._client.xread({self._key: since or "0-0"}, block=int(timeout * 1000), count=500)
+        lines = []
+        closed = False
+        for _, items in entries:
+            for entry_id, fields in items:
+                if b"eof" in fields:
+                    closed = True
+                else:
+                    lines.append((entry_id.decode(), fields[b"line"].decode(errors="replace")))
+        return lines, closed
+
+
+class LogStreams:
+    """
+    Per-operation log streams of the engine output
+
+    The lines are also logged, tagged with the stack and operation, so they end
+    up in the rotating log file of the stack, see source.logs.
+    """
+
+    def __init__(self):
+        self.max_lines = 1000
+        self.retention = 3600
+        self._streams = OrderedDict()
+        self._redis = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Configure the streams from the flask app config
+        :param app: Flask app
+        """
+        self.max_lines = app.config["LOG_STREAM_LINES"]
+        self.retention = app.config["LOG_STREAM_RETENTION"]
+
+        redis_url = app.config.get("REDIS_URL")
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url)
+        app.extensions["log_streams"] = self
+
+    def _stream(self, operation_id: str, create: bool):
+        if self._redis is not None:
+            return RedisLogStream(self._redis, f"logs:{operation_id}", self.max_lines, self.retention)
+
+        with self._lock:
+            stream = self._streams.get(operation_id)
+            if stream is None and create:
+                stream = self._streams[operation_id] = (time.monotonic(), MemoryLogStream(self.max_lines))
+                # forget streams of operations that finished a while ago
+                while self._streams and time.monotonic() - next(iter(self._streams.values()))[0] > self.retention:
+                    self._streams.popitem(last=False)
+            return stream[1] if stream else None
+
+    def begin(self, operation_id: str, stack_name: str):
+        """
+        Start collecting the output of an operation run by the current thread
+        :param operation_id: id of the operation, the job id
+        :param stack_name: name of the stack the operation works on
+        """
+        self.attach((self._stream(operation_id, create=True), stack_name, operation_id))
+
+    def fork(self, stack_name: str):
+        """
+        Context for another thread to write into the stream of the current operation,
+        lines are tagged with the given stack
+        :param stack_name: name of the stack the other thread works on
+        """
+        current = getattr(self._local, "current", None)
+        return (current[0], stack_name, current[2]) if current else (None, stack_name, None)
+
+    def attach(self, context):
+        """
+        Make the calling thread write to a context returned by fork
+        :param context: context from fork, None to stop writing
+        """
+        self._local.current = context
+        if context:
+            bind(context[1], context[2])
+        else:
+            bind()
+
+    def end(self):
+        """
+        Close the stream of the operation run by the current thread
+        """
+        current = getattr(self._local, "current", None)
+        self.attach(None)
+        if current and current[0] is not None:
+            try:
+                current[0].close()
+            except Exception as err:
+                logger.warning(f"Could not close log stream -> {err}")
+
+    def write(self, line: str):
+        """
+        on_output callback for stack operations, writes to the stream of the current operation
+        :param line: engine output line
+        """
+        # only queued here, the listener thread writes the files
+        engine_logger.info(line.rstrip("\n"))
+        current = getattr(self._local, "current", None)
+        if current is None or current[0] is None:
+            return
+
+        try:
+            current[0].write(line)
+        except Exception as err:
+            logger.warning(f"Could not write log stream -> {err}")
+
+    def offset(self, value: str):
+        """
+        Parse an offset sent by a reader, e.g. the Last-Event-ID header
+        :param value: offset as sent, None or empty to read from the start
+        :return: the offset to pass to read
+        :raises ValueError: when the value is not an offset of the stream backend
+        """
+        if not value:
+            return None
+        if self._redis is not None:
+            if not REDIS_ENTRY_ID.match(value):
+                raise ValueError(f"Invalid log stream offset '{value}'")
+            return value
+        return int(value)
+
+    def read(self, operation_id: str, since, timeout: float = 15.0):
+        """
+        Lines of an operation after an offset, see MemoryLogStream.read
+        :param operation_id: id of the operation
+        :param since: last offset the reader saw
+        :param timeout: seconds to wait for new lines
+        :return: (list of (offset, line), closed), closed is None for operations without a stream
+            here, they did not start yet, finished a while ago or run in another process
+        """
+        stream = self._stream(operation_id, create=False)
+        if stream is None:
+            return [], None
+        return stream.read(since, timeout)
+
+
+log_streams = LogStreams()
@@ -0,0 +1,202 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+TEXT_FORMAT = "[%(levelname)s] - %(asctime)s - %(name)s - %(message)s"
+
+# stack and operation of the work the current thread is doing, see bind
+_context = threading.local()
+
+
+def bind(stack: str = None, operation: str = None):
+    """
+    Tag the records logged by the current thread with a stack and operation
+    :param stack: stack name, None to clear the tags
+    :param operation: id of the operation, the job id
+    """
+    _context.stack = stack
+    _context.operation = operation
+
+
+class ContextFilter(logging.Filter):
+    """
+    Copies the tags of the emitting thread onto the record, runs before the record is queued
+    """
+
+    def filter(self, record):
+        if not hasattr(record, "stack"):
+            record.stack = getattr(_context, "stack", None)
+        if not hasattr(record, "operation"):
+            record.operation = getattr(_context, "operation", None)
+        return True
+
+
+class EngineFilter(logging.Filter):
+    """
+    Keeps a sample of the engine output lines, lines mentioning an error always pass
+    """
+
+    def __init__(self, engine_logger: str, sample_rate: float = 0.0):
+        super().__init__()
+        self.engine_logger = engine_logger
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        if record.name != self.engine_logger:
+            return True
+        if "error" in record.getMessage().lower():
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "stack", None):
+            entry["stack"] = record.stack
+        if getattr(record, "operation", None):
+            entry["operation"] = record.operation
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class StackFileHandler(logging.Handler):
+    """
+    Routes the records tagged with a stack to a rotating log file of that stack
+    """
+
+    def __init__(self, max_open: int = 64):
+        super().__init__()
+        self.log_dir = None
+        self.max_bytes = 1024 * 1024
+        self.backups = 3
+        self.max_open = max_open
+        self._files = OrderedDict()
+        self.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+
+    def _file(self, stack_name: str):
+        safe_name = re.sub(r"[^a-zA-Z0-9_.-]", "_", stack_name)
+        handler = self._files.get(safe_name)
+        if handler is None:
+            handler = RotatingFileHandler(os.path.join(self.log_dir, f"{safe_name}.log"),
+                                          maxBytes=self.max_bytes, backupCount=self.backups, delay=True)
+            handler.setFormatter(self.formatter)
+            self._files[safe_name] = handler
+
+            # keep a bounded number of open log files
+            while len(self._files) > self.max_open:
+                _, evicted = self._files.popitem(last=False)
+                evicted.close()
+        else:
+            self._files.move_to_end(safe_name)
+        return handler
+
+    def emit(self, record):
+        # only the listener thread emits, the open files need no lock
+        stack_name = getattr(record, "stack", None)
+        if not stack_name or self.log_dir is None:
+            return
+        try:
+            self._file(stack_name).emit(record)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        for handler in self._files.values():
+            handler.close()
+        self._files.clear()
+        super().close()
+
+
+class LogPipeline:
+    """
+    Non-blocking logging: records are queued by the emitting thread and written by a listener thread
+
+    The listener writes to the console and, for records tagged with a stack, to
+    the rotating log file of that stack. Engine output lines always reach the
+    stack files, the console only gets a sample of them.
+    """
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.console = logging.StreamHandler()
+        self.stack_files = StackFileHandler()
+        self.engine_filter = None
+        self._handler = None
+        self._listener = None
+
+    def start(self, logger: logging.Logger):
+        """
+        Route a logger through the queue, called once when the package is imported
+        :param logger: the application logger
+        """
+        self.console.setFormatter(logging.Formatter(TEXT_FORMAT))
+        self.engine_filter = EngineFilter(f"{logger.name}.engine")
+        self.console.addFilter(self.engine_filter)
+
+        self._handler = QueueHandler(self.queue)
+        self._handler.addFilter(ContextFilter())
+        logger.addHandler(self._handler)
+
+        self._start_listener()
+        atexit.register(self.stop)
+        # threads don't survive a fork, e.g. gunicorn --preload workers
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _start_listener(self):
+        self._listener = QueueListener(self.queue, self.console, self.stack_files, respect_handler_level=True)
+        self._listener.start()
+
+    def _after_fork(self):
+        # a fresh queue, the records the parent queued are written by the parent
+        if self._listener is None:
+            return
+        self.queue = queue.SimpleQueue()
+        self._handler.queue = self.queue
+        self._start_listener()
+
+    def init_app(self, app):
+        """
+        Configure the sinks from the flask app config
+        :param app: Flask app
+        """
+        self.console.setLevel(app.config["LOG_LEVEL"].upper())
+        if app.config["LOG_FORMAT"] == "json":
+            self.console.setFormatter(JsonFormatter())
+        self.engine_filter.sample_rate = app.config["ENGINE_LOG_SAMPLE"]
+
+        self.stack_files.max_bytes = app.config["STACK_LOG_MAX_BYTES"]
+        self.stack_files.backups = app.config["STACK_LOG_BACKUPS"]
+        self.stack_files.log_dir = app.config.get("STACK_LOG_DIR") or os.path.join(app.instance_path, "logs")
+        os.makedirs(self.stack_files.log_dir, exist_ok=True)
+        app.extensions["log_pipeline"] = self
+
+    def stop(self):
+        """
+        Write out the queued records and stop the listener
+        """
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+            self.stack_files.close()
+
+
+log_pipeline = LogPipeline()
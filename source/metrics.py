@@ -0,0 +1,267 @@
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, abort, g, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from source import logger
+
+# seconds, wide enough for both requests and stack operations
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Histogram:
+    """
+    Cumulative bucket counts, sum and count of observations, per label set
+    """
+
+    def __init__(self, name: str, help_text: str, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, labels: tuple, value: float):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(labels + (('le', str(bound)),))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(labels)} {count}")
+        return lines
+
+
+class Counter:
+    """
+    Monotonic counter per label set
+    """
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._series = {}
+
+    def inc(self, labels: tuple, value: float = 1):
+        self._series[labels] = self._series.get(labels, 0) + value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(labels)} {value}" for labels, value in sorted(self._series.items())]
+        return lines
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for key, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    """
+    In-process request and deployment phase metrics, served in the prometheus text format
+
+    Slow requests can be profiled: a sampled share of requests runs under
+    cProfile and the profile is dumped when the request took longer than the
+    configured threshold.
+    """
+
+    def __init__(self):
+        self.requests = Histogram("http_request_duration_seconds", "Request latency per route")
+        self.responses = Counter("http_responses_total", "Responses per route and status")
+        self.phases = Histogram("stack_phase_duration_seconds", "Duration of the phases of stack operations")
+        self.jobs = Histogram("deployment_job_duration_seconds", "Duration of deployment jobs")
+        self.token = None
+        self.profile_rate = 0.0
+        self.profile_threshold = 1.0
+        self.profile_dir = None
+        self._collectors = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._profiling = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Time every request, every db commit and serve /metrics
+        :param app: Flask app
+        """
+        self.token = app.config.get("METRICS_TOKEN")
+        self.profile_rate = app.config["PROFILE_SAMPLE_RATE"]
+        self.profile_threshold = app.config["PROFILE_SLOW_SECONDS"]
+        self.profile_dir = app.config.get("PROFILE_DIR") or os.path.join(app.instance_path, "profiles")
+        app.extensions["metrics"] = self
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule("/metrics", "metrics", self._serve)
+        self._collectors.append(_state_lines)
+
+        # every commit of the app, whichever route or job it runs in
+        event.listen(Session, "before_commit", self._before_commit)
+        event.listen(Session, "after_commit", self._after_commit)
+        event.listen(Session, "after_rollback", self._after_commit)
+
+    @contextmanager
+    def phase(self, name: str, **labels):
+        """
+        Time a phase of a stack operation
+        :param name: phase name, e.g. "up" or "select_stack"
+        :param labels: extra labels, keep their cardinality low
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(name, time.perf_counter() - start, **labels)
+
+    def observe_phase(self, name: str, seconds: float, **labels):
+        with self._lock:
+            self.phases.observe((("phase", name),) + tuple(sorted(labels.items())), seconds)
+
+        collected = getattr(self._local, "phases", None)
+        if collected is not None:
+            collected[name] = collected.get(name, 0.0) + seconds
+
+    @contextmanager
+    def collect(self):
+        """
+        Also sum up the phases timed by the current thread, e.g. for the history of one job
+        :return: dict of phase name to seconds, filled while the block runs
+        """
+        collected = self._local.phases = {}
+        try:
+            yield collected
+        finally:
+            self._local.phases = None
+
+    def observe_job(self, kind: str, status: str, seconds: float):
+        with self._lock:
+            self.jobs.observe((("kind", kind), ("status", status)), seconds)
+
+    def _before_commit(self, session):
+        session.info["metrics_commit_started"] = time.perf_counter()
+
+    def _after_commit(self, session):
+        started = session.info.pop("metrics_commit_started", None)
+        if started is not None:
+            self.observe_phase("db_commit", time.perf_counter() - started)
+
+    def _before_request(self):
+        g.metrics_started = time.perf_counter()
+        if self.profile_rate and random.random() < self.profile_rate and self._profiling.acquire(blocking=False):
+            g.metrics_profile = cProfile.Profile()
+            g.metrics_profile.enable()
+
+    def _after_request(self, response):
+        started = g.pop("metrics_started", None)
+        if started is None:
+            return response
+        seconds = time.perf_counter() - started
+
+        # the url rule keeps the label set bounded, unlike the path
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        with self._lock:
+            self.requests.observe((("method", request.method), ("route", route)), seconds)
+            self.responses.inc((("method", request.method), ("route", route), ("status", response.status_code)))
+        g.metrics_seconds = seconds
+        return response
+
+    def _teardown_request(self, exc):
+        # runs after failed requests too, so the profiler is always released
+        profile = g.pop("metrics_profile", None)
+        if profile is None:
+            return
+
+        profile.disable()
+        self._profiling.release()
+        seconds = g.pop("metrics_seconds", None)
+        if seconds is not None and seconds >= self.profile_threshold:
+            self._dump(profile, request.url_rule.rule if request.url_rule else "unmatched", seconds)
+
+    def _dump(self, profile, route: str, seconds: float):
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            safe_route = re.sub(r"[^a-zA-Z0-9_.-]", "_", route).strip("_") or "root"
+            path = os.path.join(self.profile_dir, f"{int(time.time())}-{safe_route}.prof")
+            profile.dump_stats(path)
+            logger.info(f"Request to {route} took {seconds:.2f}s, profile written to {path}")
+        except OSError as err:
+            logger.warning(f"Could not write request profile -> {err}")
+
+    def render(self) -> str:
+        with self._lock:
+            lines = self.requests.render() + self.responses.render() + self.phases.render() + self.jobs.render()
+
+        for collect in self._collectors:
+            try:
+                lines += collect()
+            except Exception as err:
+                logger.warning(f"Metrics collector failed -> {err}")
+        return "\n".join(lines) + "\n"
+
+    def _serve(self):
+        if self.token and request.headers.get("Authorization") != f"Bearer {self.token}":
+            abort(401)
+        return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+
+def gauge(name: str, help_text: str, values: dict) -> list:
+    """
+    Prometheus text lines of a gauge
+    :param name: metric name
+    :param help_text: metric description
+    :param values: label tuple to value
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    lines += [f"{name}{_labels(labels)} {value}" for labels, value in sorted(values.items())]
+    return lines
+
+
+def _state_lines() -> list:
+    from source import database
+    from source.cache import outputs_cache
+    from source.jobs import ACTIVE_STATUSES
+    from source.models import DeploymentJobs
+    from source.workspaces import workspace_pool
+
+    cache = outputs_cache.stats()
+    lines = gauge("outputs_cache_entries", "Stack outputs held by the outputs cache", {(): cache["size"]})
+    lines += gauge("outputs_cache_hits", "Outputs cache hits of this process", {(): cache["hits"]})
+    lines += gauge("outputs_cache_misses", "Outputs cache misses of this process", {(): cache["misses"]})
+
+    pool = workspace_pool.stats()
+    lines += gauge("workspace_pool_created", "Workspaces created per project",
+                   {(("project", project),): stats["created"] for project, stats in pool.items()})
+    lines += gauge("workspace_pool_idle", "Idle workspaces per project",
+                   {(("project", project),): stats["idle"] for project, stats in pool.items()})
+
+    counts = database.session.query(DeploymentJobs.status, database.func.count()) \
+        .filter(DeploymentJobs.status.in_(ACTIVE_STATUSES)).group_by(DeploymentJobs.status).all()
+    active = {(("status", status),): 0 for status in ACTIVE_STATUSES}
+    active.update({(("status", status),): count for status, count in counts})
+    lines += gauge("deployment_jobs", "Deployment jobs in flight per status", active)
+    return lines
+
+
+metrics = Metrics()
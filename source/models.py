@@ -1,4 +1,10 @@
-from source import database
+import hashlib
+import json
+import secrets
+from datetime import datetime
+
+from source import database, logger
+from source.regions import DEFAULT_REGION
 from flask_login import UserMixin
 
 
@@ -9,6 +15,8 @@ class User(database.Model, UserMixin):
     password = database.Column(database.String(300))
     virtual_machines = database.relationship("VirtualMachines")
     sites = database.relationship("Sites")
+    jobs = database.relationship("DeploymentJobs")
+    api_tokens = database.relationship("ApiTokens")
 
 
 class VirtualMachines(database.Model):
@@ -16,7 +24,44 @@ class VirtualMachines(database.Model):
     name = database.Column(database.String(500), unique=True)
     dns_name = database.Column(database.String(500))
     console_url = database.Column(database.String(500))
-    refrence_key = database.Column(database.Integer, database.ForeignKey("user.id"))
+    # hash of the inputs of the last successful deployment
+    fingerprint = database.Column(database.String(64))
+    # AMI choice and the id the stack is pinned to
+    ami = database.Column(database.String(100))
+    ami_id = database.Column(database.String(100))
+    # aws region of the stack, None for stacks deployed before regions were stored
+    region = database.Column(database.String(30))
+    refrence_key = database.Column(database.Integer, database.ForeignKey("user.id"), index=True)
+    # instances of a fleet stack, empty for a single VM
+    members = database.relationship("FleetMembers", cascade="all, delete-orphan")
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "dns_name": self.dns_name,
+            "console_url": self.console_url,
+            "ami": self.ami,
+            "ami_id": self.ami_id,
+            "region": self.region or DEFAULT_REGION,
+            "members": [member.to_dict() for member in self.members],
+        }
+
+
+class FleetMembers(database.Model):
+    id = database.Column(database.Integer, primary_key=True)
+    name = database.Column(database.String(500))
+    instance_type = database.Column(database.String(100))
+    public_ip = database.Column(database.String(100))
+    dns_name = database.Column(database.String(500))
+    refrence_key = database.Column(database.Integer, database.ForeignKey("virtual_machines.id"), index=True)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "instance_type": self.instance_type,
+            "public_ip": self.public_ip,
+            "dns_name": self.dns_name,
+        }
 
 
 class Sites(database.Model):
@@ -24,4 +69,183 @@ class Sites(database.Model):
     name = database.Column(database.String(500), unique=True)
     url = database.Column(database.String(500))
     console_url = database.Column(database.String(500))
+    # hash of the inputs of the last successful deployment
+    fingerprint = database.Column(database.String(64))
+    # blob store hash of the HTML of a single page site, empty for archive sites
+    content_hash = database.Column(database.String(64))
+    # aws region of the stack, None for stacks deployed before regions were stored
+    region = database.Column(database.String(30))
+    refrence_key = database.Column(database.Integer, database.ForeignKey("user.id"), index=True)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "url": self.url,
+            "console_url": self.console_url,
+            "region": self.region or DEFAULT_REGION,
+        }
+
+
+class ApiTokens(database.Model):
+    id = database.Column(database.Integer, primary_key=True)
+    name = database.Column(database.String(100))
+    # sha256 of the token, the token itself is only shown once
+    token_hash = database.Column(database.String(64), unique=True, index=True)
+    created_at = database.Column(database.DateTime, default=datetime.utcnow)
+    last_used_at = database.Column(database.DateTime)
+    refrence_key = database.Column(database.Integer, database.ForeignKey("user.id"), index=True)
+
+    @staticmethod
+    def hash(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @classmethod
+    def issue(cls, user_id: int, name: str):
+        """
+        Create a token for a user
+        :param user_id: owner of the token
+        :param name: label to recognize the token by
+        :return: (ApiTokens row, token)
+        """
+        token = secrets.token_urlsafe(32)
+        return cls(name=name, token_hash=cls.hash(token), refrence_key=user_id), token
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "last_used_at": self.last_used_at.isoformat() if self.last_used_at else None,
+        }
+
+
+class DeploymentJobs(database.Model):
+    __table_args__ = (
+        # the job in flight of a stack and the job lists of a user
+        database.Index("ix_deployment_jobs_stack_status", "stack_name", "status"),
+        database.Index("ix_deployment_jobs_owner_created", "refrence_key", "created_at"),
+    )
+
+    id = database.Column(database.String(32), primary_key=True)
+    # operation name, e.g. "site.create" or "vm.destroy"
+    kind = database.Column(database.String(50))
+    stack_name = database.Column(database.String(500))
+    # waiting, queued, running, succeeded, failed or cancelled
+    status = database.Column(database.String(20), default="queued")
+    # jobs submitted together share a batch id
+    batch_id = database.Column(database.String(32), index=True)
+    params = database.Column(database.Text)
+    # hash of kind and params, identical submissions share it
+    op_key = database.Column(database.String(64))
+    outputs = database.Column(database.Text)
+    error = database.Column(database.Text)
+    created_at = database.Column(database.DateTime, default=datetime.utcnow)
+    started_at = database.Column(database.DateTime)
+    finished_at = database.Column(database.DateTime)
+    # "<hostname>:<pid>" of the process running the job
+    worker = database.Column(database.String(100))
+    refrence_key = database.Column(database.Integer, database.ForeignKey("user.id"))
+
+    @property
+    def duration(self):
+        """
+        Seconds spent running the job, None while it has not finished
+        """
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return (self.finished_at - self.started_at).total_seconds()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "stack_name": self.stack_name,
+            "status": self.status,
+            "batch_id": self.batch_id,
+            "outputs": json.loads(self.outputs) if self.outputs else None,
+            "error": self.error,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "duration": self.duration,
+        }
+
+
+class OperationHistory(database.Model):
+    """
+    Append-only record of a finished stack operation, written in batches by source.history
+    """
+    __table_args__ = (
+        # duration percentiles per program and instance type, see History.stats
+        database.Index("ix_operation_history_program", "program", "instance_type", "finished_at"),
+        database.Index("ix_operation_history_owner_finished", "refrence_key", "finished_at"),
+    )
+
+    id = database.Column(database.Integer, primary_key=True)
+    job_id = database.Column(database.String(32))
+    stack_name = database.Column(database.String(500))
+    # site, vm or fleet, the kind of stack the operation worked on
+    program = database.Column(database.String(20))
+    # create, update, destroy or teardown
+    kind = database.Column(database.String(20))
+    # instance type of a VM, the sorted distinct types of a fleet
+    instance_type = database.Column(database.String(200))
+    region = database.Column(database.String(30))
+    # succeeded or failed
+    status = database.Column(database.String(20))
+    # JSON, seconds per phase, see metrics.phase
+    phases = database.Column(database.Text)
+    # JSON, resources per change kind from the update summary, e.g. {"create": 3, "same": 1}
+    resource_changes = database.Column(database.Text)
+    duration = database.Column(database.Float)
+    started_at = database.Column(database.DateTime)
+    finished_at = database.Column(database.DateTime, index=True)
     refrence_key = database.Column(database.Integer, database.ForeignKey("user.id"))
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "stack_name": self.stack_name,
+            "program": self.program,
+            "kind": self.kind,
+            "instance_type": self.instance_type,
+            "region": self.region,
+            "status": self.status,
+            "phases": json.loads(self.phases) if self.phases else {},
+            "resource_changes": json.loads(self.resource_changes) if self.resource_changes else {},
+            "duration": self.duration,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+def create_missing_columns():
+    """
+    Add columns declared after a table was first created, create_all only creates missing tables
+
+    Only nullable columns can be added in place, their rows start out NULL.
+    """
+    inspector = database.inspect(database.engine)
+    preparer = database.engine.dialect.identifier_preparer
+    for table in database.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable:
+                logger.warning(f"Column {table.name}.{column.name} is missing and can't be added, it is not nullable")
+                continue
+
+            logger.info(f"Adding column {table.name}.{column.name}")
+            definition = f"{preparer.format_column(column)} {column.type.compile(dialect=database.engine.dialect)}"
+            with database.engine.begin() as connection:
+                connection.execute(database.text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {definition}"))
+
+
+def create_missing_indexes():
+    """
+    Add indexes declared after a table was first created, create_all only creates missing tables
+    """
+    for table in database.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(database.engine, checkfirst=True)
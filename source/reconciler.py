@@ -0,0 +1,235 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import click
+from flask import current_app
+
+from source import database, logger
+from source.cache import outputs_cache, preview_cache
+from source.deployments import console_url, open_stack
+from source.helper_functions import auto
+from source.jobs import ACTIVE_STATUSES
+from source.locks import internal_name, stack_locks
+from source.log_streams import log_streams
+from source.metrics import metrics
+from source.models import DeploymentJobs, Sites, VirtualMachines
+from source.regions import DEFAULT_REGION
+from source.workspaces import workspace_pool
+
+# only one process reconciles at a time
+RECONCILER_LOCK = internal_name("reconciler")
+
+
+class Reconciler:
+    """
+    Syncs the Sites and VirtualMachines rows with the stacks of the pulumi project
+
+    Every run lists the stacks, reads the outputs of the ones updated since the
+    previous run (most recent first, at most `batch_size` of them) on a bounded
+    thread pool and writes the corrected rows in one transaction. Stacks without
+    a row and rows without a stack are reported, not deleted.
+
+    The outputs come from the checkpoints, which only hold what the app's own
+    jobs deployed. A refresh run first refreshes the checkpoints from AWS, so
+    resources changed or deleted outside pulumi are reported as drifted.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.interval = 0
+        self.parallelism = 4
+        self.batch_size = 50
+        self.last_report = None
+        # stack name to the last_update the stack had when its outputs were read
+        self._synced = {}
+        self._pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Configure the reconciler from the flask app config and register the `flask reconcile` command
+        :param app: Flask app
+        """
+        self.app = app
+        self.interval = app.config["RECONCILE_INTERVAL"]
+        self.parallelism = app.config["RECONCILE_PARALLELISM"]
+        self.batch_size = app.config["RECONCILE_BATCH_SIZE"]
+        app.extensions["reconciler"] = self
+
+        @app.cli.command("reconcile")
+        @click.option("--full", is_flag=True, help="Read the outputs of every stack, not only the updated ones")
+        @click.option("--refresh", is_flag=True,
+                      help="Refresh the stacks from AWS first, jobs submitted meanwhile find their stack locked")
+        def reconcile_command(full, refresh):
+            """Sync the database with the stacks of the pulumi project."""
+            click.echo(self.run(full=full, refresh=refresh))
+
+        if self.interval > 0:
+            app.before_request(self._ensure_thread)
+
+    def _ensure_thread(self):
+        # started lazily, once per process, like the job workers
+        with self._lock:
+            if self._pid == os.getpid() and self._thread:
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name="reconciler", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self.app.app_context():
+                    self.run()
+            except Exception as err:
+                logger.warning(f"Reconcile failed -> {err}")
+
+    def _list_stacks(self) -> dict:
+        with workspace_pool.borrow(current_app.config["PROJECT_NAME"], lambda: None) as workspace:
+            return {summary.name.split("/")[-1]: summary for summary in workspace.list_stacks()}
+
+    def _read_outputs(self, app, stack_name: str, region: str = None):
+        # with a region the stack is refreshed in it first, returns (stack name, outputs, drift)
+        with app.app_context():
+            owner = uuid.uuid4().hex
+            if region and not stack_locks.acquire(stack_name, owner):
+                logger.info(f"{stack_name} is locked by a job, not refreshed")
+                return stack_name, None, None
+
+            drift = None
+            try:
+                with open_stack(stack_name, program=lambda: None) as stack:
+                    if region:
+                        stack.set_config("aws:region", auto.ConfigValue(region))
+                        with metrics.phase("refresh"):
+                            result = stack.refresh(on_output=log_streams.write)
+                        changes = result.summary.resource_changes if result.summary else None
+                        drift = {op: count for op, count in (changes or {}).items() if op != "same" and count}
+                        if drift:
+                            # a preview of the old state would skip an up that is needed now
+                            preview_cache.invalidate(app.config["PROJECT_NAME"], stack_name)
+                    outs = {name: output.value for name, output in stack.outputs().items()}
+            except Exception as err:
+                logger.warning(f"Could not read outputs of {stack_name} -> {err}")
+                return stack_name, None, None
+            finally:
+                if region:
+                    stack_locks.release(stack_name, owner)
+
+            outputs_cache.set(app.config["PROJECT_NAME"], stack_name, outs)
+            return stack_name, outs, drift
+
+    def run(self, full: bool = False, refresh: bool = False) -> dict:
+        """
+        Reconcile the database with the stacks once
+        :param full: read the outputs of every stack instead of only the updated ones
+        :param refresh: refresh every stack from AWS first, `parallelism` at a time
+        :return: report of the corrected rows, the drifted stacks and the orphans
+        """
+        owner = uuid.uuid4().hex
+        if not stack_locks.acquire(RECONCILER_LOCK, owner):
+            logger.info("Reconcile already running, skipped")
+            return {"skipped": True}
+
+        try:
+            return self._run(full, refresh)
+        finally:
+            stack_locks.release(RECONCILER_LOCK, owner)
+
+    def _run(self, full: bool, refresh: bool) -> dict:
+        started = time.monotonic()
+        stacks = self._list_stacks()
+        sites = {site.name: site for site in Sites.query}
+        vms = {vm.name: vm for vm in VirtualMachines.query}
+        busy = {
+            stack_name for (stack_name,) in database.session.query(DeploymentJobs.stack_name)
+            .filter(DeploymentJobs.status.in_(ACTIVE_STATUSES))
+        }
+
+        # stacks touched since the last sync first, busy ones are left to their job
+        pending = [
+            summary for name, summary in stacks.items()
+            if (name in sites or name in vms)
+            and name not in busy
+            and not summary.update_in_progress
+            and (full or refresh or name not in self._synced or self._synced[name] != summary.last_update)
+        ]
+        pending.sort(key=lambda summary: summary.last_update or datetime.min, reverse=True)
+        pending = pending[:self.batch_size]
+
+        def read(summary):
+            stack_name = summary.name.split("/")[-1]
+            row = sites.get(stack_name) or vms.get(stack_name)
+            return self._read_outputs(app, stack_name, (row.region or DEFAULT_REGION) if refresh else None)
+
+        app = current_app._get_current_object()
+        with ThreadPoolExecutor(max_workers=max(1, self.parallelism)) as executor:
+            results = list(executor.map(read, pending))
+
+        site_updates = []
+        vm_updates = []
+        corrected = []
+        drifted = {}
+        for (stack_name, outs, drift), summary in zip(results, pending):
+            if outs is None:
+                continue
+            if drift:
+                drifted[stack_name] = drift
+            # a refresh moves last_update, the next run reads the stack again
+            self._synced[stack_name] = summary.last_update
+            expected_console_url = console_url(stack_name)
+
+            site = sites.get(stack_name)
+            if site is not None and outs.get("website_url"):
+                url = f"http://{outs['website_url']}"
+                if site.url != url or site.console_url != expected_console_url:
+                    site_updates.append({"id": site.id, "url": url, "console_url": expected_console_url})
+                    corrected.append(stack_name)
+
+            vm = vms.get(stack_name)
+            if vm is not None:
+                # fleets have no single dns name, their members are rebuilt by deployments
+                dns_name = outs.get("public_dns") if "instances" not in outs else vm.dns_name
+                if vm.dns_name != dns_name or vm.console_url != expected_console_url:
+                    vm_updates.append({"id": vm.id, "dns_name": dns_name, "console_url": expected_console_url})
+                    corrected.append(stack_name)
+
+        # one transaction for every corrected row
+        if site_updates:
+            database.session.execute(database.update(Sites), site_updates)
+        if vm_updates:
+            database.session.execute(database.update(VirtualMachines), vm_updates)
+        database.session.commit()
+
+        # a row is only orphaned when no job is about to create or delete its stack
+        report = {
+            "stacks": len(stacks),
+            "checked": len(pending),
+            "corrected": sorted(corrected),
+            "drifted": drifted,
+            "stacks_without_row": sorted(
+                name for name in stacks
+                if name not in sites and name not in vms and name not in busy
+            ),
+            "rows_without_stack": sorted(
+                name for name in list(sites) + list(vms)
+                if name not in stacks and name not in busy
+            ),
+            "seconds": round(time.monotonic() - started, 2),
+        }
+        self.last_report = report
+
+        logger.info(f"Reconciled {report['checked']} of {report['stacks']} stacks, "
+                    f"{len(corrected)} rows corrected, {len(drifted)} stacks drifted, "
+                    f"{len(report['stacks_without_row'])} stacks and "
+                    f"{len(report['rows_without_stack'])} rows orphaned")
+        return report
+
+
+reconciler = Reconciler()
@@ -0,0 +1,24 @@
+# AWS regions users can deploy to
+REGIONS = {
+    "us-east-1": "US East (N. Virginia)",
+    "us-west-2": "US West (Oregon)",
+    "eu-west-1": "Europe (Ireland)",
+    "eu-central-1": "Europe (Frankfurt)",
+    "ap-south-1": "Asia Pacific (Mumbai)",
+    "ap-southeast-1": "Asia Pacific (Singapore)",
+    "ap-northeast-1": "Asia Pacific (Tokyo)",
+    "sa-east-1": "South America (São Paulo)",
+}
+DEFAULT_REGION = "us-east-1"
+
+
+def regional_stacks(stack_name: str, regions: list) -> list:
+    """
+    Stack names of a deployment fanned out to several regions
+    :param stack_name: name picked by the user
+    :param regions: regions to deploy to
+    :return: list of (stack name, region), a single region keeps the name as is
+    """
+    if len(regions) == 1:
+        return [(stack_name, regions[0])]
+    return [(f"{stack_name}-{region}", region) for region in regions]
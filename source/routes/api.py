@@ -0,0 +1,413 @@
+from flask import Blueprint, abort, jsonify, request, url_for
+from flask_login import current_user, login_required
+from sqlalchemy.orm import selectinload
+from werkzeug.exceptions import HTTPException
+
+from source import database, logger
+from source.blobs import BlobTooLarge
+from source.fetch import FetchError
+from source.fingerprints import fleet_fingerprint, site_fingerprint, vm_fingerprint
+from source.history import history
+from source.jobs import ACTIVE_STATUSES, batch_summary, job_queue
+from source.locks import StackBusy
+from source.models import ApiTokens, DeploymentJobs, OperationHistory, Sites, VirtualMachines
+from source.regions import DEFAULT_REGION, regional_stacks
+from source.routes.jobs import (_owned, _owned_batch, _owned_job, busy_response, preview_response, queued_response,
+                                selected_regions, submit_regional)
+from source.routes.sites import site_source
+from source.routes.virtual_machines import _ami_choice, _fleet_error, instance_types
+from source.site_archives import ArchiveError
+
+api_blue_print = Blueprint("api", __name__, url_prefix="/api/v1")
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+@api_blue_print.errorhandler(HTTPException)
+def api_error(err: HTTPException):
+    """
+    Errors of the API are answered with JSON instead of HTML pages
+    """
+    return jsonify({"error": err.description}), err.code
+
+
+def _payload() -> dict:
+    if not request.is_json:
+        abort(415, "Send a JSON body with Content-Type: application/json")
+    return request.get_json() or {}
+
+
+def _cached_json(data: dict):
+    # polling clients send the ETag back in If-None-Match and get an empty 304
+    response = jsonify(data)
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def _page(query, model):
+    """
+    Keyset paginated listing, clients follow next_cursor until it is null
+    :param query: query of the rows visible to the user
+    :param model: model of the rows, must have an integer id
+    """
+    limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    cursor = request.args.get("cursor", type=int)
+
+    if cursor is not None:
+        query = query.filter(model.id > cursor)
+    rows = query.order_by(model.id).limit(limit + 1).all()
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return _cached_json({
+        "items": [row.to_dict() for row in rows],
+        "next_cursor": rows[-1].id if more else None,
+    })
+
+
+@api_blue_print.route("/sites", methods=["GET"])
+@login_required
+def list_sites():
+    """
+    API handler to list the sites of the user
+    """
+    return _page(Sites.query.filter_by(refrence_key=current_user.id), Sites)
+
+
+@api_blue_print.route("/sites/<string:name>", methods=["GET"])
+@login_required
+def get_site(name: str):
+    """
+    API handler to get a site
+    :param name: stack name of the site
+    """
+    return _cached_json(_owned(Sites, name).to_dict())
+
+
+def _api_site_source(payload: dict) -> dict:
+    if not payload.get("content") and not payload.get("url"):
+        abort(400, "Send the HTML as 'content' or a page or archive 'url'")
+    try:
+        return site_source(file_url=payload.get("url"), content=payload.get("content"))
+    except (ArchiveError, BlobTooLarge, FetchError) as err:
+        abort(400, str(err))
+
+
+@api_blue_print.route("/sites", methods=["POST"])
+@login_required
+def create_site():
+    """
+    API handler to create a site in one or more regions, answers 202 with the job or batch
+    """
+    payload = _payload()
+    stack_name = str(payload.get("name") or "")
+    if not stack_name:
+        abort(400, "A site needs a 'name'")
+
+    stacks = regional_stacks(stack_name, selected_regions())
+    if Sites.query.filter(Sites.name.in_([name for name, _ in stacks])).first():
+        abort(409, f"Site with name '{stack_name}' already exists")
+
+    return submit_regional("site.create", stacks, {
+        "create": True,
+        "user_id": current_user.id,
+        **_api_site_source(payload),
+    }, "sites.list_sites", f"Site '{stack_name}' is being created")
+
+
+@api_blue_print.route("/sites/<string:name>", methods=["PUT"])
+@login_required
+def update_site(name: str):
+    """
+    API handler to update the content of a site, answers 200 when it is already up to date
+    :param name: stack name of the site
+    """
+    site = _owned(Sites, name)
+    payload = _payload()
+    source = _api_site_source(payload)
+
+    if not payload.get("force") and site.fingerprint == site_fingerprint(**source):
+        return jsonify({"up_to_date": True, "site": site.to_dict()})
+
+    try:
+        job = job_queue.submit("site.update", name, {
+            "stack_name": name,
+            "region": site.region or DEFAULT_REGION,
+            "force": bool(payload.get("force")),
+            **source,
+        }, user_id=current_user.id)
+    except StackBusy as err:
+        return busy_response(err, "sites.list_sites", str(err))
+    return queued_response(job, "sites.list_sites", f"Site '{name}' is being updated")
+
+
+@api_blue_print.route("/sites/<string:name>/preview", methods=["POST"])
+@login_required
+def preview_site(name: str):
+    """
+    API handler to preview an update of a site, takes the body of PUT /sites/<name>.
+    Answers 200 with a cached preview of the same content, otherwise 202 with the preview job
+    :param name: stack name of the site
+    """
+    site = _owned(Sites, name)
+    source = _api_site_source(_payload())
+    params = {"stack_name": name, "region": site.region or DEFAULT_REGION, **source}
+    return preview_response("site.preview", name, params, site_fingerprint(**source), "sites.list_sites")
+
+
+@api_blue_print.route("/sites/<string:name>", methods=["DELETE"])
+@login_required
+def delete_site(name: str):
+    """
+    API handler to delete a site
+    :param name: stack name of the site
+    """
+    _owned(Sites, name)
+    try:
+        job = job_queue.submit("site.destroy", name, {"stack_name": name}, user_id=current_user.id)
+    except StackBusy as err:
+        return busy_response(err, "sites.list_sites", str(err))
+    return queued_response(job, "sites.list_sites", f"Site '{name}' is being deleted")
+
+
+@api_blue_print.route("/vms", methods=["GET"])
+@login_required
+def list_vms():
+    """
+    API handler to list the VMS and fleets of the user
+    """
+    query = VirtualMachines.query.filter_by(refrence_key=current_user.id).options(selectinload(VirtualMachines.members))
+    return _page(query, VirtualMachines)
+
+
+@api_blue_print.route("/vms/<string:name>", methods=["GET"])
+@login_required
+def get_vm(name: str):
+    """
+    API handler to get a VM or fleet
+    :param name: stack name of the VM
+    """
+    return _cached_json(_owned(VirtualMachines, name).to_dict())
+
+
+def _api_vm_spec(payload: dict) -> dict:
+    # a VM has an "instance_type", a fleet a list of {"name", "instance_type"} "instances"
+    if not payload.get("keydata"):
+        abort(400, "A VM needs the public key as 'keydata'")
+
+    spec = {"keydata": payload["keydata"], "ami": _ami_choice()}
+    if "instances" in payload:
+        instances = [
+            {"name": str(instance.get("name", "")), "instance_type": instance.get("instance_type") or instance_types[0]}
+            for instance in payload.get("instances") or []
+        ]
+        error = _fleet_error(instances)
+        if error:
+            abort(400, error)
+        spec["instances"] = instances
+    else:
+        spec["instance_type"] = payload.get("instance_type") or instance_types[0]
+        if spec["instance_type"] not in instance_types:
+            abort(400, f"Unsupported instance type '{spec['instance_type']}'")
+    return spec
+
+
+@api_blue_print.route("/vms", methods=["POST"])
+@login_required
+def create_vm():
+    """
+    API handler to create a VM or fleet in one or more regions, answers 202 with the job or batch
+    """
+    payload = _payload()
+    stack_name = str(payload.get("name") or "")
+    if not stack_name:
+        abort(400, "A VM needs a 'name'")
+    spec = _api_vm_spec(payload)
+
+    stacks = regional_stacks(stack_name, selected_regions())
+    if VirtualMachines.query.filter(VirtualMachines.name.in_([name for name, _ in stacks])).first():
+        abort(409, f"VM with name '{stack_name}' already exists")
+
+    kind = "vm.create-fleet" if "instances" in spec else "vm.create"
+    return submit_regional(kind, stacks, {
+        **spec,
+        "create": True,
+        "user_id": current_user.id,
+    }, "virtual_machines.list_vms", f"VM '{stack_name}' is being created")
+
+
+def _vm_spec_for(vm: VirtualMachines, payload: dict) -> dict:
+    # a single VM stays a single VM and a fleet a fleet, the other program would delete their instances
+    spec = _api_vm_spec(payload)
+    if bool(vm.members) != ("instances" in spec):
+        expected = "'instances'" if vm.members else "an 'instance_type'"
+        abort(409, f"'{vm.name}' is a {'fleet' if vm.members else 'single VM'}, send {expected}")
+    return spec
+
+
+def _vm_fingerprint(spec: dict, region: str) -> str:
+    if "instances" in spec:
+        return fleet_fingerprint(spec["keydata"], spec["instances"], region, spec["ami"])
+    return vm_fingerprint(spec["keydata"], spec["instance_type"], region, spec["ami"])
+
+
+@api_blue_print.route("/vms/<string:name>", methods=["PUT"])
+@login_required
+def update_vm(name: str):
+    """
+    API handler to update a VM or fleet, answers 200 when it is already up to date
+    :param name: stack name of the VM
+    """
+    vm = _owned(VirtualMachines, name)
+    payload = _payload()
+    spec = _vm_spec_for(vm, payload)
+    region = vm.region or DEFAULT_REGION
+    kind = "vm.update-fleet" if "instances" in spec else "vm.update"
+
+    if not payload.get("force") and vm.fingerprint == _vm_fingerprint(spec, region):
+        return jsonify({"up_to_date": True, "vm": vm.to_dict()})
+
+    try:
+        job = job_queue.submit(kind, name, {"stack_name": name, "region": region, "force": bool(payload.get("force")),
+                                            **spec}, user_id=current_user.id)
+    except StackBusy as err:
+        return busy_response(err, "virtual_machines.list_vms", str(err))
+    return queued_response(job, "virtual_machines.list_vms", f"VM '{name}' is being updated")
+
+
+@api_blue_print.route("/vms/<string:name>/preview", methods=["POST"])
+@login_required
+def preview_vm(name: str):
+    """
+    API handler to preview an update of a VM or fleet, takes the body of PUT /vms/<name>.
+    Answers 200 with a cached preview of the same inputs, otherwise 202 with the preview job
+    :param name: stack name of the VM
+    """
+    vm = _owned(VirtualMachines, name)
+    spec = _vm_spec_for(vm, _payload())
+    region = vm.region or DEFAULT_REGION
+    kind = "vm.preview-fleet" if "instances" in spec else "vm.preview"
+    return preview_response(kind, name, {"stack_name": name, "region": region, **spec},
+                            _vm_fingerprint(spec, region), "virtual_machines.list_vms")
+
+
+@api_blue_print.route("/vms/<string:name>", methods=["DELETE"])
+@login_required
+def delete_vm(name: str):
+    """
+    API handler to delete a VM or fleet
+    :param name: stack name of the VM
+    """
+    _owned(VirtualMachines, name)
+    try:
+        job = job_queue.submit("vm.destroy", name, {"stack_name": name}, user_id=current_user.id)
+    except StackBusy as err:
+        return busy_response(err, "virtual_machines.list_vms", str(err))
+    return queued_response(job, "virtual_machines.list_vms", f"VM '{name}' is being deleted")
+
+
+@api_blue_print.route("/jobs", methods=["GET"])
+@login_required
+def list_jobs():
+    """
+    API handler to list the jobs of the user, newest first, ?active=1 only returns jobs in flight
+    """
+    query = DeploymentJobs.query.filter_by(refrence_key=current_user.id)
+    if request.args.get("active"):
+        query = query.filter(DeploymentJobs.status.in_(ACTIVE_STATUSES))
+
+    limit = max(1, min(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    jobs = query.order_by(DeploymentJobs.created_at.desc()).limit(limit).all()
+    return _cached_json({"items": [job.to_dict() for job in jobs]})
+
+
+@api_blue_print.route("/jobs/<string:id>", methods=["GET"])
+@login_required
+def get_job(id: str):
+    """
+    API handler to poll a job handle
+    :param id: job id
+    """
+    return _cached_json(_owned_job(id).to_dict())
+
+
+@api_blue_print.route("/history", methods=["GET"])
+@login_required
+def list_history():
+    """
+    API handler to list the finished operations of the user, newest first, ?stack=<name> for one stack
+    """
+    query = OperationHistory.query.filter_by(refrence_key=current_user.id)
+    if request.args.get("stack"):
+        query = query.filter_by(stack_name=request.args["stack"])
+
+    limit = max(1, min(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    records = query.order_by(OperationHistory.finished_at.desc()).limit(limit).all()
+    return _cached_json({"items": [record.to_dict() for record in records]})
+
+
+@api_blue_print.route("/history/stats", methods=["GET"])
+@login_required
+def history_stats():
+    """
+    API handler for the p50/p95 durations per program, kind and instance type,
+    ?days=<n> sets the window and ?program=site|vm|fleet narrows it
+    """
+    days = max(1, min(request.args.get("days", 7, type=int), history.retention_days or 365))
+    return _cached_json({"days": days, "items": history.stats(days, request.args.get("program"))})
+
+
+@api_blue_print.route("/batches/<string:id>", methods=["GET"])
+@login_required
+def get_batch(id: str):
+    """
+    API handler to poll a batch handle
+    :param id: batch id
+    """
+    _owned_batch(id)
+    return _cached_json(batch_summary(id))
+
+
+@api_blue_print.route("/tokens", methods=["GET"])
+@login_required
+def list_tokens():
+    """
+    API handler to list the API tokens of the user, without the tokens themselves
+    """
+    return jsonify({"items": [token.to_dict() for token in current_user.api_tokens]})
+
+
+@api_blue_print.route("/tokens", methods=["POST"])
+@login_required
+def create_token():
+    """
+    API handler to create an API token, the token is only part of this response
+    """
+    payload = request.get_json(silent=True) or {}
+    api_token, token = ApiTokens.issue(current_user.id, str(payload.get("name") or "api"))
+    database.session.add(api_token)
+    database.session.commit()
+
+    logger.info(f"API token {api_token.id} created for user {current_user.id}")
+    response = jsonify({**api_token.to_dict(), "token": token})
+    response.status_code = 201
+    response.headers["Location"] = url_for("api.list_tokens")
+    return response
+
+
+@api_blue_print.route("/tokens/<int:id>", methods=["DELETE"])
+@login_required
+def delete_token(id: int):
+    """
+    API handler to revoke an API token
+    :param id: token id
+    """
+    api_token = database.session.get(ApiTokens, id)
+    if api_token is None or api_token.refrence_key != current_user.id:
+        abort(404, "No such token")
+
+    database.session.delete(api_token)
+    database.session.commit()
+    return "", 204
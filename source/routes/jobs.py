@@ -0,0 +1,353 @@
+import time
+
+from flask import (Blueprint, Response, abort, current_app, flash, jsonify, redirect,
+                   render_template, request, stream_with_context, url_for)
+from flask_login import login_required, current_user
+
+from source import database
+from source.cache import preview_cache
+from source.history import history
+from source.jobs import ACTIVE_STATUSES, batch_summary, job_queue
+from source.locks import StackBusy, internal_name
+from source.log_streams import log_streams
+from source.models import DeploymentJobs, OperationHistory
+from source.regions import DEFAULT_REGION, REGIONS
+
+jobs_blue_print = Blueprint("jobs", __name__, url_prefix="/jobs")
+
+
+def wants_json() -> bool:
+    """
+    True when the client sent JSON, called the JSON API or prefers a JSON response over HTML
+    """
+    if request.is_json or request.blueprint == "api":
+        return True
+    best = request.accept_mimetypes.best_match(["text/html", "application/json"])
+    return best == "application/json"
+
+
+def queued_response(job: DeploymentJobs, endpoint: str, message: str):
+    """
+    Answer a request whose work was handed to the job queue
+    :param job: the queued job
+    :param endpoint: page to redirect HTML clients to
+    :param message: flash message for HTML clients
+    """
+    if wants_json():
+        response = jsonify(job.to_dict())
+        response.status_code = 202
+        status_endpoint = "api.get_job" if request.blueprint == "api" else "jobs.job_status"
+        response.headers["Location"] = url_for(status_endpoint, id=job.id)
+        return response
+
+    flash(message, category="info")
+    return redirect(url_for(endpoint))
+
+
+def busy_response(err: StackBusy, endpoint: str, message: str):
+    """
+    Answer a request that conflicts with an operation already in flight on the stack
+    :param err: the conflict raised by the job queue
+    :param endpoint: page to redirect HTML clients to
+    :param message: flash message for HTML clients
+    """
+    if wants_json():
+        response = jsonify({"error": str(err), "job": err.job.to_dict() if err.job else None})
+        response.status_code = 409
+        return response
+
+    flash(message, category="danger")
+    return redirect(url_for(endpoint))
+
+
+def preview_message(stack_name: str, preview: dict) -> str:
+    """
+    One line summary of a preview for flash messages
+    :param stack_name: name of the previewed stack
+    :param preview: preview from the preview cache or a preview job
+    """
+    if not preview["changes"]:
+        return f"'{stack_name}' is up to date, the update would change nothing"
+    changes = ", ".join(f"{count} to {op}" for op, count in sorted(preview["change_summary"].items()) if op != "same")
+    return f"Updating '{stack_name}' would change resources: {changes}"
+
+
+def preview_response(kind: str, stack_name: str, params: dict, fingerprint: str, endpoint: str):
+    """
+    Answer a preview request from the preview cache, or hand a preview job to the job queue
+    :param kind: preview job kind, e.g. "site.preview"
+    :param stack_name: name of the stack to preview
+    :param params: handler params of the update that is previewed
+    :param fingerprint: fingerprint of the inputs, see source.fingerprints
+    :param endpoint: page to redirect HTML clients to when the stack is busy
+    """
+    cached = preview_cache.get(current_app.config["PROJECT_NAME"], stack_name, fingerprint)
+    if cached is not None:
+        if wants_json():
+            return jsonify({**cached, "cached": True})
+        # back to the update form the preview was requested from
+        flash(preview_message(stack_name, cached), category="info")
+        return redirect(request.url)
+
+    try:
+        job = job_queue.submit(kind, stack_name, {**params, "preview": True}, user_id=current_user.id)
+    except StackBusy as err:
+        return busy_response(err, endpoint, f"'{stack_name}' already has an operation in progress")
+
+    if wants_json():
+        return queued_response(job, endpoint, "")
+
+    # the engine output of the preview lists the planned steps
+    flash(f"Previewing the update of '{stack_name}'", category="info")
+    return redirect(url_for("jobs.job_logs", id=job.id))
+
+
+def batch_response(batch_id: str, endpoint: str, message: str):
+    """
+    Answer a request whose work was handed to the job queue as a batch
+    :param batch_id: id of the queued batch
+    :param endpoint: page to redirect HTML clients to
+    :param message: flash message for HTML clients
+    """
+    if wants_json():
+        response = jsonify(batch_summary(batch_id))
+        response.status_code = 202
+        status_endpoint = "api.get_batch" if request.blueprint == "api" else "jobs.batch_status"
+        response.headers["Location"] = url_for(status_endpoint, id=batch_id)
+        return response
+
+    flash(message, category="info")
+    return redirect(url_for(endpoint))
+
+
+def selected_names():
+    """
+    Stack names picked on a list page, from the "names" form checkboxes or JSON list,
+    None when every stack was asked for with all=on
+    """
+    if request.is_json:
+        payload = request.get_json() or {}
+        return None if payload.get("all") in (True, "on") else list(payload.get("names") or [])
+    return None if request.form.get("all") == "on" else request.form.getlist("names")
+
+
+def teardown_response(kind: str, sites: list, vms: list, endpoint: str):
+    """
+    Hand a bulk destroy of the current user's stacks to the job queue
+    :param kind: teardown job kind, decides which list page shows the job
+    :param sites: names of site stacks owned by the user
+    :param vms: names of VM stacks owned by the user
+    :param endpoint: page to redirect HTML clients to
+    """
+    if not sites and not vms:
+        if wants_json():
+            return jsonify({"error": "Nothing to delete"}), 400
+        flash("Select at least one stack to delete", category="danger")
+        return redirect(url_for(endpoint))
+
+    # one teardown per user at a time, the job locks every stack it destroys
+    stack_name = internal_name(f"teardown-{current_user.id}")
+    try:
+        job = job_queue.submit(kind, stack_name, {
+            "sites": sites,
+            "vms": vms,
+            "parallelism": current_app.config["BULK_MAX_PARALLELISM"],
+            "retries": current_app.config["TEARDOWN_RETRIES"],
+        }, user_id=current_user.id)
+    except StackBusy as err:
+        return busy_response(err, endpoint, "A bulk delete is already in progress")
+
+    return queued_response(job, endpoint, f"{len(sites) + len(vms)} stacks are being deleted")
+
+
+def selected_regions() -> list:
+    """
+    Regions picked on a create form, from the "regions" select or JSON list
+    """
+    if request.is_json:
+        regions = (request.get_json() or {}).get("regions") or []
+    else:
+        regions = request.form.getlist("regions")
+    regions = list(dict.fromkeys(regions)) or [DEFAULT_REGION]
+
+    for region in regions:
+        if region not in REGIONS:
+            abort(400, f"Unsupported region '{region}'")
+    return regions
+
+
+def submit_regional(kind: str, stacks: list, params: dict, endpoint: str, message: str):
+    """
+    Queue a create job per regional stack, several regions run in parallel as one batch
+    :param kind: job kind
+    :param stacks: list of (stack name, region), see source.regions.regional_stacks
+    :param params: handler params shared by every region
+    :param endpoint: page to redirect HTML clients to
+    :param message: flash message for HTML clients
+    """
+    if len(stacks) == 1:
+        stack_name, region = stacks[0]
+        try:
+            job = job_queue.submit(kind, stack_name, {
+                **params,
+                "stack_name": stack_name,
+                "region": region,
+            }, user_id=current_user.id)
+        except StackBusy as err:
+            return busy_response(err, endpoint, f"'{stack_name}' already exists, pick a unique name")
+        return queued_response(job, endpoint, message)
+
+    try:
+        batch_id = job_queue.submit_batch(kind, [
+            (stack_name, {**params, "stack_name": stack_name, "region": region})
+            for stack_name, region in stacks
+        ], len(stacks), user_id=current_user.id)
+    except StackBusy as err:
+        return busy_response(err, endpoint, f"'{err.stack_name}' already exists, pick a unique name")
+    return batch_response(batch_id, endpoint, f"{message} in {len(stacks)} regions")
+
+
+def name_page(query, model):
+    """
+    One page of a list page sorted by stack name, ?after=<name> starts after that stack
+    :param query: query of the rows visible to the user
+    :param model: model of the rows, must have a unique name
+    :return: (rows of the page, name to continue after or None on the last page)
+    """
+    page_size = current_app.config["LIST_PAGE_SIZE"]
+    after = request.args.get("after")
+    if after:
+        query = query.filter(model.name > after)
+
+    # keyset pagination on the unique name index, as fast on the last page as on the first
+    rows = query.order_by(model.name).limit(page_size + 1).all()
+    if len(rows) > page_size:
+        return rows[:page_size], rows[page_size - 1].name
+    return rows, None
+
+
+def _owned(model, name: str):
+    # stacks of other users look like missing ones
+    row = model.query.filter_by(name=name, refrence_key=current_user.id).first()
+    if row is None:
+        abort(404, f"No stack named '{name}'")
+    return row
+
+
+def _owned_batch(batch_id: str):
+    job = DeploymentJobs.query.filter_by(batch_id=batch_id).first()
+    if job is None or job.refrence_key != current_user.id:
+        abort(404)
+
+
+def _owned_job(job_id: str) -> DeploymentJobs:
+    job = database.session.get(DeploymentJobs, job_id)
+    if job is None or job.refrence_key != current_user.id:
+        abort(404)
+    return job
+
+
+@jobs_blue_print.route("/history", methods=["GET"])
+@login_required
+def operation_history():
+    """
+    View handler for the duration percentiles of every operation and the recent operations of the user
+    """
+    days = max(1, min(request.args.get("days", 7, type=int), history.retention_days or 365))
+    recent = OperationHistory.query.filter_by(refrence_key=current_user.id) \
+        .order_by(OperationHistory.finished_at.desc()).limit(current_app.config["LIST_PAGE_SIZE"]).all()
+    return render_template("jobs/history.html", stats=history.stats(days), recent=recent, days=days,
+                           sub_title="History")
+
+
+@jobs_blue_print.route("/<string:id>", methods=["GET"])
+@login_required
+def job_status(id: str):
+    """
+    View handler to get the status of a deployment job
+    :param id: job id
+    """
+    return jsonify(_owned_job(id).to_dict())
+
+
+@jobs_blue_print.route("/<string:id>/logs", methods=["GET"])
+@login_required
+def job_logs(id: str):
+    """
+    View handler for the page following the deployment log of a job
+    :param id: job id
+    """
+    job = _owned_job(id)
+    return render_template("jobs/logs.html", job=job, sub_title="Deployment log")
+
+
+@jobs_blue_print.route("/<string:id>/logs/stream", methods=["GET"])
+@login_required
+def stream_job_logs(id: str):
+    """
+    View handler streaming the deployment log of a job as server-sent events,
+    clients resume with the Last-Event-ID header or the offset query parameter
+    :param id: job id
+    """
+    job_id = _owned_job(id).id
+    try:
+        since = log_streams.offset(request.headers.get("Last-Event-ID") or request.args.get("offset"))
+    except ValueError as err:
+        abort(400, str(err))
+
+    def events():
+        offset = since
+        while True:
+            lines, closed = log_streams.read(job_id, offset)
+            for offset, line in lines:
+                data = "\n".join(f"data: {part}" for part in line.splitlines() or [""])
+                yield f"id: {offset}\n{data}\n\n"
+
+            if not lines and not closed:
+                # the stream may not exist yet or live in another process, stop once the job is done
+                database.session.expire_all()
+                job = database.session.get(DeploymentJobs, job_id)
+                unknown = closed is None
+                closed = job is None or job.status not in ACTIVE_STATUSES
+                if not closed:
+                    if unknown:
+                        # nothing to block on, e.g. the job is still queued
+                        time.sleep(1)
+                    yield ": keep-alive\n\n"
+
+            if closed:
+                yield "event: end\ndata: \n\n"
+                return
+
+    response = Response(stream_with_context(events()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@jobs_blue_print.route("/batches/<string:id>", methods=["GET"])
+@login_required
+def batch_status(id: str):
+    """
+    View handler to get the per-stack results of a batch
+    :param id: batch id
+    """
+    _owned_batch(id)
+    return jsonify(batch_summary(id))
+
+
+@jobs_blue_print.route("/batches/<string:id>/cancel", methods=["POST"])
+@login_required
+def cancel_batch(id: str):
+    """
+    View handler to cancel the jobs of a batch that have not started yet
+    :param id: batch id
+    """
+    _owned_batch(id)
+    cancelled = job_queue.cancel_batch(id)
+
+    if wants_json():
+        return jsonify(batch_summary(id))
+
+    flash(f"Cancelled {cancelled} pending deployments", category="info")
+    return redirect(request.referrer or url_for("index"))
@@ -1,24 +1,62 @@
-import requests
-from flask import (current_app, Blueprint, request, flash,
+from flask import (Blueprint, request, flash,
                    redirect, url_for, render_template)
 from flask_login import login_required, current_user
 
-from source import logger, database
-from source.helper_functions import create_pulumi_program_s3, auto
+from source import logger
+from source.deployments import stack_outputs
+from source.fetch import FetchError, source_fetcher
+from source.fingerprints import site_fingerprint
+from source.jobs import job_queue, visible_jobs
+from source.blobs import blob_store
+from source.locks import StackBusy
 from source.models import Sites
+from source.site_archives import ArchiveError, is_archive, site_assets
+from source.regions import DEFAULT_REGION, REGIONS, regional_stacks
+from source.routes.jobs import (_owned, busy_response, name_page, preview_response, queued_response, selected_names,
+                                selected_regions, submit_regional, teardown_response)
 
 sites_blue_print = Blueprint("sites", __name__, url_prefix="/sites")
 
 
+def site_source(archive=None, file_url: str = None, content: str = None) -> dict:
+    """
+    Job params describing a site: an archive manifest or the HTML content
+    :param archive: uploaded zip or tar archive
+    :param file_url: url of the HTML page or of an archive
+    :param content: HTML of a single page site
+    """
+    if archive and archive.filename:
+        return {"files": site_assets.unpack(archive.stream, archive.filename)}
+
+    # remote sources go through the fetcher, an unchanged source is not downloaded again
+    if file_url and is_archive(file_url):
+        def unpack(response):
+            return {"files": site_assets.unpack_response(response, file_url)}
+
+        return source_fetcher.fetch(file_url, unpack)
+
+    if file_url:
+        return source_fetcher.fetch_page(file_url)
+
+    return {"content_hash": blob_store.put_bytes(str(content).encode())}
+
+
+def _site_source() -> dict:
+    return site_source(request.files.get("site-archive"), request.form.get("file-url"),
+                       request.form.get("site-content"))
+
+
 @sites_blue_print.route("/", methods=["GET"])
 @login_required
 def list_sites():
     """
     View handler to lists all sites
     """
-    # get all sites of user from the database
-    sites = current_user.sites
-    return render_template("sites/index.html", sites=sites, sub_title="Sites")
+    # one page of the sites of the user, copies of a site in several regions are listed next to each other
+    sites, next_after = name_page(Sites.query.filter_by(refrence_key=current_user.id), Sites)
+    jobs = visible_jobs(current_user.id, ("site.", "teardown"))
+    return render_template("sites/index.html", sites=sites, jobs=jobs, default_region=DEFAULT_REGION,
+                           next_after=next_after, sub_title="Sites")
 
 
 @sites_blue_print.route("/new", methods=["GET", "POST"])
@@ -28,113 +66,75 @@ def create_site():
     View handler for creating new sites
     """
     if request.method == "POST":
-        stack_name = request.form.get("site-id")
-        file_url = request.form.get("file-url")
-        org_name = current_app.config["PULUMI_ORG"]
-        project_name = current_app.config["PROJECT_NAME"]
+        stack_name = str(request.form.get("site-id"))
+        stacks = regional_stacks(stack_name, selected_regions())
 
-        if file_url:
-            site_content = requests.get(file_url).text
-        else:
-            site_content = request.form.get("site-content")
-
-        def pulumi_program():
-            return create_pulumi_program_s3(str(site_content))
-
-        try:
-            # create a new stack, genrating our pulumi program on the fly from the POST body
-            stack = auto.create_stack(
-                stack_name=str(stack_name),
-                project_name=current_app.config["PROJECT_NAME"],
-                program=pulumi_program
-            )
-            stack.set_config("aws:region", auto.ConfigValue("us-east-1"))
-
-            # deploy the stack, tailing the log to stdout
-            stack.up(on_output=logger.info)
-
-            # store the newly created stack into Sites model
-            outs = stack.outputs()
-            new_site = Sites(
-                name=stack.name,
-                url=f"http://{outs['website_url'].value}",
-                console_url=f"https://app.pulumi.com/{org_name}/{project_name}/{stack.name}"
-            )
-            database.session.add(new_site)
-            database.session.commit()
-
-            flash(f"Successfully created site '{stack_name}'", category="success")
-
-        except auto.StackAlreadyExistsError:
+        if Sites.query.filter(Sites.name.in_([name for name, _ in stacks])).first():
             logger.info(f"{stack_name} already exists")
             flash(f"Site with name '{stack_name}' already exists, pick a unique name", category="danger")
+            return redirect(url_for("sites.list_sites"))
 
-        return render_template(url_for("sites.list_sites"))
+        try:
+            source = _site_source()
+        except (ArchiveError, FetchError) as err:
+            flash(str(err), category="danger")
+            return redirect(url_for("sites.create_site"))
 
-    return render_template("sites/create.html")
+        # the stacks are created and deployed by job workers, a repeated submit joins the queued job
+        return submit_regional("site.create", stacks, {
+            "create": True,
+            "user_id": current_user.id,
+            **source,
+        }, "sites.list_sites", f"Site '{stack_name}' is being created")
+
+    return render_template("sites/create.html", regions=REGIONS, curr_regions=[DEFAULT_REGION])
 
 
 @sites_blue_print.route("/<string:id>/update", methods=["GET", "POST"])
 @login_required
 def update_site(id: str):
     stack_name = id
+    site = _owned(Sites, stack_name)
 
     if request.method == "POST":
-        file_url = request.form.get("file-url")
-        if file_url:
-            site_content = requests.get(file_url).text
-        else:
-            site_content = str(request.form.get("site-content"))
-
-        def pulumi_program():
-            create_pulumi_program_s3(str(site_content))
-
         try:
-            stack = auto.select_stack(
-                stack_name=stack_name,
-                project_name=current_app.config["PROJECT_NAME"],
-                program=pulumi_program,
-            )
-            stack.set_config("aws:region", auto.ConfigValue("us-east-1"))
-
-            # deploy the stack, tailing the logs to stdout
-            stack.up(on_output=logger.info)
-
-            # update the VirtualMachines model
-            outs = stack.outputs()
-            site = Sites.query.filter_by(name=stack_name).first()
-
-            if site:
-                site.name = stack.name
-                site.url = f"http://{outs['website_url'].value}",
-                site.console_url = f"https://app.pulumi.com/{org_name}/{project_name}/{stack.name}"
-                database.session.commit()
-            else:
-                logger.critical(
-                    f"{stack_name} stack name not found on Sites model")
-
-            flash(f"Site '{stack_name}' successfully updated!", category="success")
-
-        except auto.ConcurrentUpdateError:
-            logger.info(f"{stack_name} already has an udpate in progress")
-            flash(f"Site '{stack_name}' already has an udpate in progress", category="danger")
-
-        except Exception as err:
-            logger.critical(f"An error occurred while updating {stack_name} Site -> {err}")
+            source = _site_source()
+        except (ArchiveError, FetchError) as err:
             flash(str(err), category="danger")
+            return redirect(url_for("sites.update_site", id=stack_name))
+        force = request.form.get("force") == "on"
+        params = {
+            "stack_name": stack_name,
+            "region": site.region or DEFAULT_REGION,
+            **source,
+        }
+
+        if request.form.get("preview"):
+            return preview_response("site.preview", stack_name, params, site_fingerprint(**source),
+                                    "sites.list_sites")
+
+        # skip the engine run when the content is what was last deployed
+        if not force and site.fingerprint == site_fingerprint(**source):
+            flash(f"Site '{stack_name}' is already up to date", category="info")
+            return redirect(url_for("sites.list_sites"))
+
+        try:
+            job = job_queue.submit("site.update", stack_name, {**params, "force": force}, user_id=current_user.id)
+        except StackBusy as err:
+            logger.info(f"{stack_name} already has an operation in progress")
+            return busy_response(err, "sites.list_sites",
+                                 f"Site '{stack_name}' already has an operation in progress")
 
-        return redirect(url_for("sites.list_sites"))
+        return queued_response(job, "sites.list_sites", f"Site '{stack_name}' is being updated")
 
-    stack = auto.select_stack(
-        stack_name=stack_name,
-        project_name=current_app.config["PROJECT_NAME"],
-        # noop just to get the outputs
-        program=lambda: None,
-    )
-    outs = stack.outputs()
-    content_output = outs.get("website_content")
-    content = content_output.value if content_output else None
-    return render_template("sites/update.html", name=stack_name, content=content)
+    if site.content_hash:
+        content = blob_store.read_text(site.content_hash)
+    else:
+        # sites deployed before the blob store kept their HTML in the stack outputs
+        content = stack_outputs(stack_name).get("website_content")
+
+    return render_template("sites/update.html", name=stack_name, content=content,
+                           is_archive=not site.content_hash and content is None)
 
 
 @sites_blue_print.route("/<string:id>/delete", methods=["POST"])
@@ -145,32 +145,28 @@ def delete_sites(id: str):
     :param id: site id
     """
     stack_name = id
+    _owned(Sites, stack_name)
 
     try:
-        stack = auto.select_stack(
-            stack_name=stack_name,
-            project_name=current_app.config["PROJECT_NAME"],
-            # no-op program, just to get outputs
-            program=lambda: None
-        )
-
-        # NOTE: stack.destroy will automatically delete the resource on aws
-        stack.destroy(on_output=logger.info)
-        stack.workspace.remove_stack(stack_name)
-
-        # delete the stack from Sites model
-        site = Sites.query.filter_by(name=stack_name).first()
-        database.session.delete(site)
-        database.session.commit()
+        job = job_queue.submit("site.destroy", stack_name, {"stack_name": stack_name}, user_id=current_user.id)
+    except StackBusy as err:
+        logger.info(f"{stack_name} already has an operation in progress")
+        return busy_response(err, "sites.list_sites",
+                             f"Site '{stack_name}' already has an operation in progress")
 
-        flash(f"Site '{stack_name}' successfully deleted!", category="success")
+    return queued_response(job, "sites.list_sites", f"Site '{stack_name}' is being deleted")
 
-    except auto.ConcurrentUpdateError:
-        logger.info(f"{stack_name} deletion is in progress")
-        flash(f"Error: site '{stack_name}' already has an deletion in progress", category="danger")
 
-    except Exception as err:
-        logger.critical(f"An error occurred while deleting the stack {stack_name} -> {err}")
-        flash(str(err), category="danger")
+@sites_blue_print.route("/delete", methods=["POST"])
+@login_required
+def delete_many_sites():
+    """
+    View handler to delete the selected sites, or every site of the user with all=on
+    """
+    query = Sites.query.filter_by(refrence_key=current_user.id)
+    names = selected_names()
+    if names is not None:
+        query = query.filter(Sites.name.in_(names))
+    names = [site.name for site in query]
 
-    return redirect(url_for("sites.list_sites"))
+    return teardown_response("site.teardown", names, [], "sites.list_sites")
@@ -1,14 +1,33 @@
-from flask import (current_app, Blueprint, request, flash,
+import re
+
+from flask import (abort, current_app, Blueprint, request, flash,
                    redirect, url_for, render_template)
 from flask_login import login_required, current_user
-
-from source import logger, database
-from source.helper_functions import auto, create_pulumi_program_vms
+from sqlalchemy.orm import selectinload
+
+from source import logger
+from source.amis import AMI_CHOICES, DEFAULT_AMI, ami_service
+from source.deployments import stack_outputs
+from source.fingerprints import fleet_fingerprint, vm_fingerprint
+from source.jobs import job_queue, stack_in_flight, visible_jobs
+from source.locks import StackBusy
 from source.models import VirtualMachines
+from source.regions import DEFAULT_REGION, REGIONS, regional_stacks
+from source.routes.jobs import (_owned, batch_response, busy_response, name_page, preview_response, queued_response,
+                                selected_names, selected_regions, submit_regional, teardown_response)
 
 
 vm_blue_print = Blueprint("virtual_machines", __name__, url_prefix="/vms")
 instance_types = ["t2.micro"]
+member_name_pattern = re.compile(r"^[a-zA-Z0-9-]{1,60}$")
+
+
+def _ami_choice() -> str:
+    payload = request.get_json() if request.is_json else request.form
+    ami = payload.get("ami") or DEFAULT_AMI
+    if ami not in AMI_CHOICES:
+        abort(400, f"Unsupported AMI '{ami}'")
+    return ami
 
 
 @vm_blue_print.route("/", methods=["GET"])
@@ -17,9 +36,15 @@ def list_vms():
     """
     View handler to lists all VMS
     """
-    # get all virtual machines of user from the database
-    vms = current_user.virtual_machines
-    return render_template("virtual_machines/index.html", vms=vms, sub_title="Virtual Machines")
+    # one page of the VMs of the user with their fleet members loaded in one extra query,
+    # copies of a VM in several regions are listed next to each other
+    vms, next_after = name_page(
+        VirtualMachines.query.filter_by(refrence_key=current_user.id).options(selectinload(VirtualMachines.members)),
+        VirtualMachines,
+    )
+    jobs = visible_jobs(current_user.id, ("vm.", "teardown"))
+    return render_template("virtual_machines/index.html", vms=vms, jobs=jobs, default_region=DEFAULT_REGION,
+                           next_after=next_after, sub_title="Virtual Machines")
 
 
 @vm_blue_print.route("/new", methods=["GET", "POST"])
@@ -29,49 +54,282 @@ def create_vm():
     View handler for creating new VMS
     """
     if request.method == "POST":
-        stack_name = request.form.get("vm-id")
+        stack_name = str(request.form.get("vm-id"))
         keydata = request.form.get("vm-keypair")
         instance_type = request.form.get("instance_type")
-        org_name = current_app.config["PULUMI_ORG"]
-        project_name = current_app.config["PROJECT_NAME"]
+        ami = _ami_choice()
+        stacks = regional_stacks(stack_name, selected_regions())
 
-        def pulumi_program():
-            return create_pulumi_program_vms(keydata, instance_type)
+        if VirtualMachines.query.filter(VirtualMachines.name.in_([name for name, _ in stacks])).first():
+            logger.info(f"{stack_name} already exists")
+            flash(
+                f"VM with name '{stack_name}' already exists, pick a unique name", category="danger")
+            return redirect(url_for("virtual_machines.list_vms"))
+
+        # the stacks are created and deployed by job workers, a repeated submit joins the queued job
+        return submit_regional("vm.create", stacks, {
+            "keydata": keydata,
+            "instance_type": instance_type,
+            "ami": ami,
+            "create": True,
+            "user_id": current_user.id,
+        }, "virtual_machines.list_vms", f"VM '{stack_name}' is being created")
+
+    return render_template("virtual_machines/create.html", instance_types=instance_types, curr_instance_type=None,
+                           amis=ami_service.choices(DEFAULT_REGION), curr_ami=DEFAULT_AMI,
+                           regions=REGIONS, curr_regions=[DEFAULT_REGION])
+
+
+def _bulk_specs() -> list:
+    # JSON clients send {"vms": [{"name", "instance_type", "keydata"}]}, the form
+    # sends one "name[,instance_type]" per line and a shared public key
+    # None when the JSON body isn't shaped like that
+    if request.is_json:
+        payload = request.get_json()
+        specs = payload.get("vms", []) if isinstance(payload, dict) else None
+        if not isinstance(specs, list) or not all(isinstance(spec, dict) for spec in specs):
+            return None
+        return [
+            {
+                "name": str(spec.get("name", "")).strip(),
+                "instance_type": spec.get("instance_type") or instance_types[0],
+                "keydata": spec.get("keydata"),
+            }
+            for spec in specs
+        ]
+
+    keydata = request.form.get("vm-keypair")
+    specs = []
+    for line in request.form.get("vm-specs", "").splitlines():
+        if not line.strip():
+            continue
+        name, _, instance_type = line.partition(",")
+        specs.append({
+            "name": name.strip(),
+            "instance_type": instance_type.strip() or request.form.get("instance_type") or instance_types[0],
+            "keydata": keydata,
+        })
+    return specs
+
+
+def _bulk_error(message: str):
+    logger.info(message)
+    if request.is_json:
+        return {"error": message}, 400
+
+    flash(message, category="danger")
+    return redirect(url_for("virtual_machines.bulk_create_vms"))
+
+
+@vm_blue_print.route("/bulk", methods=["GET", "POST"])
+@login_required
+def bulk_create_vms():
+    """
+    View handler for creating many VMS at once, deployed in parallel
+    """
+    max_parallelism = current_app.config["BULK_MAX_PARALLELISM"]
 
+    if request.method == "POST":
+        specs = _bulk_specs()
+        if specs is None:
+            return _bulk_error("Send the VMs as a list of objects in 'vms'")
+
+        ami = _ami_choice()
+        payload = request.get_json() if request.is_json else request.form
         try:
-            # create a new stack, genrating our pulumi program on the fly from the POST body
-            stack = auto.create_stack(
-                stack_name=str(stack_name),
-                project_name=project_name,
-                program=pulumi_program
-            )
-            stack.set_config("aws:region", auto.ConfigValue("us-east-1"))
-
-            # deploy the stack, tailing the log to stdout
-            stack.up(on_output=logger.info)
-
-            # store the newly created stack into VirtualMachines model
-            outs = stack.outputs()
-            new_vm = VirtualMachines(
-                name=stack_name,
-                dns_name=f"{outs['public_dns'].value}",
-                console_url=f"https://app.pulumi.com/{org_name}/{project_name}/{stack_name}",
-                refrence_key=current_user.id
-            )
-            database.session.add(new_vm)
-            database.session.commit()
+            parallelism = int(payload.get("parallelism") or max_parallelism)
+        except (TypeError, ValueError):
+            return _bulk_error("Parallelism must be a whole number")
+        parallelism = max(1, min(parallelism, max_parallelism))
+        names = [spec["name"] for spec in specs]
+
+        if not specs:
+            return _bulk_error("Add at least one VM")
+
+        if "" in names or len(set(names)) != len(names):
+            return _bulk_error("Every VM needs a unique name")
+
+        invalid = [spec["instance_type"] for spec in specs if spec["instance_type"] not in instance_types]
+        if invalid:
+            return _bulk_error(f"Unsupported instance type '{invalid[0]}'")
+
+        # the worker would fall back to a key file of the server that doesn't exist
+        keyless = [spec["name"] for spec in specs
+                   if not isinstance(spec["keydata"], str) or not spec["keydata"].strip()]
+        if keyless:
+            return _bulk_error(f"VM '{keyless[0]}' needs a public key as 'keydata'")
+
+        # every VM is deployed to every picked region
+        regions = selected_regions()
+        items = [
+            (stack_name, region, spec)
+            for spec in specs
+            for stack_name, region in regional_stacks(spec["name"], regions)
+        ]
+
+        taken = [stack_name for stack_name, _, _ in items
+                 if VirtualMachines.query.filter_by(name=stack_name).first() or stack_in_flight(stack_name)]
+        if taken:
+            return _bulk_error(f"VM with name '{taken[0]}' already exists, pick a unique name")
 
-            flash(
-                f"Successfully created VM '{stack_name}'", category="success")
+        try:
+            batch_id = job_queue.submit_batch("vm.create", [
+                (stack_name, {
+                    "stack_name": stack_name,
+                    "keydata": spec["keydata"],
+                    "instance_type": spec["instance_type"],
+                    "ami": ami,
+                    "region": region,
+                    "create": True,
+                    "user_id": current_user.id,
+                })
+                for stack_name, region, spec in items
+            ], parallelism, user_id=current_user.id)
+        except StackBusy as err:
+            return _bulk_error(f"VM with name '{err.stack_name}' already exists, pick a unique name")
+
+        return batch_response(batch_id, "virtual_machines.list_vms",
+                              f"{len(items)} VMs are being created, {parallelism} at a time")
+
+    return render_template("virtual_machines/bulk.html", instance_types=instance_types,
+                           max_parallelism=max_parallelism, amis=ami_service.choices(DEFAULT_REGION),
+                           curr_ami=DEFAULT_AMI, regions=REGIONS, curr_regions=[DEFAULT_REGION])
+
+
+def _fleet_instances() -> list:
+    # either one "name[,instance_type]" per line or a number of identical instances
+    default_type = request.form.get("instance_type") or instance_types[0]
+    lines = [line for line in request.form.get("fleet-specs", "").splitlines() if line.strip()]
+
+    if lines:
+        instances = []
+        for line in lines:
+            name, _, instance_type = line.partition(",")
+            instances.append({"name": name.strip(), "instance_type": instance_type.strip() or default_type})
+        return instances
+
+    # None when the count isn't a number
+    count = request.form.get("count") or "0"
+    if not count.strip().isdigit():
+        return None
+    count = int(count)
+    return [{"name": f"vm-{index + 1}", "instance_type": default_type} for index in range(count)]
+
+
+def _fleet_error(instances: list):
+    if instances is None:
+        return "The number of instances must be a whole number"
+
+    names = [instance["name"] for instance in instances]
+    max_size = current_app.config["FLEET_MAX_SIZE"]
+
+    if not instances:
+        return "A fleet needs at least one instance"
+    if len(instances) > max_size:
+        return f"A fleet can have at most {max_size} instances"
+    if len(set(names)) != len(names) or not all(member_name_pattern.match(name) for name in names):
+        return "Instance names must be unique and only use letters, digits and dashes"
+    if any(instance["instance_type"] not in instance_types for instance in instances):
+        return "Unsupported instance type"
+    return None
+
+
+@vm_blue_print.route("/fleet/new", methods=["GET", "POST"])
+@login_required
+def create_fleet():
+    """
+    View handler for creating a fleet of VMS in a single stack
+    """
+    if request.method == "POST":
+        stack_name = str(request.form.get("vm-id"))
+        keydata = request.form.get("vm-keypair")
+        instances = _fleet_instances()
+        ami = _ami_choice()
+
+        error = _fleet_error(instances)
+        if error:
+            flash(error, category="danger")
+            return redirect(url_for("virtual_machines.create_fleet"))
 
-        except auto.StackAlreadyExistsError:
+        stacks = regional_stacks(stack_name, selected_regions())
+        if VirtualMachines.query.filter(VirtualMachines.name.in_([name for name, _ in stacks])).first():
             logger.info(f"{stack_name} already exists")
-            flash(
-                f"VM with name '{stack_name}' already exists, pick a unique name", category="danger")
+            flash(f"VM with name '{stack_name}' already exists, pick a unique name", category="danger")
+            return redirect(url_for("virtual_machines.list_vms"))
 
-        return redirect(url_for("virtual_machines.list_vms"))
+        return submit_regional("vm.create-fleet", stacks, {
+            "keydata": keydata,
+            "instances": instances,
+            "ami": ami,
+            "create": True,
+            "user_id": current_user.id,
+        }, "virtual_machines.list_vms", f"Fleet '{stack_name}' of {len(instances)} VMs is being created")
 
-    return render_template("virtual_machines/create.html", instance_types=instance_types, curr_instance_type=None)
+    return render_template("virtual_machines/fleet.html", name=None, specs="", public_key=None,
+                           instance_types=instance_types, amis=ami_service.choices(DEFAULT_REGION),
+                           curr_ami=DEFAULT_AMI, regions=REGIONS, curr_regions=[DEFAULT_REGION])
+
+
+@vm_blue_print.route("/<string:id>/fleet", methods=["GET", "POST"])
+@login_required
+def update_fleet(id: str):
+    """
+    View handler to update the instances of a fleet
+    :param id: vm id
+    """
+    stack_name = id
+    vm = _owned(VirtualMachines, stack_name)
+
+    if request.method == "POST":
+        keydata = request.form.get("vm-keypair")
+        instances = _fleet_instances()
+        ami = _ami_choice()
+        force = request.form.get("force") == "on"
+
+        error = _fleet_error(instances)
+        if error:
+            flash(error, category="danger")
+            return redirect(url_for("virtual_machines.update_fleet", id=stack_name))
+
+        if not vm.members:
+            # the fleet program would replace the instance of a single VM
+            flash(f"VM '{stack_name}' is not a fleet", category="danger")
+            return redirect(url_for("virtual_machines.update_vm", id=stack_name))
+
+        region = vm.region or DEFAULT_REGION
+        fingerprint = fleet_fingerprint(keydata, instances, region, ami)
+        params = {
+            "stack_name": stack_name,
+            "keydata": keydata,
+            "instances": instances,
+            "ami": ami,
+            "region": region,
+        }
+
+        if request.form.get("preview"):
+            return preview_response("vm.preview-fleet", stack_name, params, fingerprint, "virtual_machines.list_vms")
+
+        # skip the engine run when the inputs are what was last deployed
+        if not force and vm.fingerprint == fingerprint:
+            flash(f"Fleet '{stack_name}' is already up to date", category="info")
+            return redirect(url_for("virtual_machines.list_vms"))
+
+        try:
+            job = job_queue.submit("vm.update-fleet", stack_name, {**params, "force": force},
+                                   user_id=current_user.id)
+        except StackBusy as err:
+            logger.info(f"{stack_name} already has an operation in progress")
+            return busy_response(err, "virtual_machines.list_vms",
+                                 f"Fleet '{stack_name}' already has an operation in progress")
+
+        return queued_response(job, "virtual_machines.list_vms", f"Fleet '{stack_name}' is being updated")
+
+    specs = "\n".join(f"{member.name},{member.instance_type}" for member in vm.members)
+    outs = stack_outputs(stack_name)
+
+    return render_template("virtual_machines/fleet.html", name=stack_name, specs=specs,
+                           public_key=outs.get("public_key"), instance_types=instance_types,
+                           amis=ami_service.choices(vm.region or DEFAULT_REGION), curr_ami=vm.ami or DEFAULT_AMI)
 
 
 @vm_blue_print.route("/<string:id>/update", methods=["GET", "POST"])
@@ -82,66 +340,52 @@ def update_vm(id: str):
     :param id: vm id
     """
     stack_name = id
+    vm = _owned(VirtualMachines, stack_name)
 
     if request.method == "POST":
         keydata = request.form.get("vm-keypair")
         instance_type = request.form.get("instance_type")
-        project_name = current_app.config["PROJECT_NAME"]
-        org_name = current_app.config["PULUMI_ORG"]
-
-        def pulumi_program():
-            return create_pulumi_program_vms(keydata, instance_type)
+        ami = _ami_choice()
+        force = request.form.get("force") == "on"
+
+        if vm.members:
+            # the single VM program would delete every instance of a fleet
+            flash(f"'{stack_name}' is a fleet, update it on the fleet page", category="danger")
+            return redirect(url_for("virtual_machines.update_fleet", id=stack_name))
+
+        region = vm.region or DEFAULT_REGION
+        fingerprint = vm_fingerprint(keydata, instance_type, region, ami)
+        params = {
+            "stack_name": stack_name,
+            "keydata": keydata,
+            "instance_type": instance_type,
+            "ami": ami,
+            "region": region,
+        }
+
+        if request.form.get("preview"):
+            return preview_response("vm.preview", stack_name, params, fingerprint, "virtual_machines.list_vms")
+
+        # skip the engine run when the inputs are what was last deployed
+        if not force and vm.fingerprint == fingerprint:
+            flash(f"VM '{stack_name}' is already up to date", category="info")
+            return redirect(url_for("virtual_machines.list_vms"))
 
         try:
-            stack = auto.select_stack(
-                stack_name=str(stack_name),
-                project_name=current_app.config["PROJECT_NAME"],
-                program=pulumi_program
-            )
-            stack.set_config("aws:region", auto.ConfigValue("us-east-1"))
-
-            # deploy the stack, tailing the log to stdout
-            stack.up(on_output=logger.info)
-
-            # update the VirtualMachines model
-            outs = stack.outputs()
-            vm = VirtualMachines.query.filter_by(name=stack_name).first()
-
-            if vm:
-                vm.name = stack_name
-                vm.dns_name = f"{outs['public_dns'].value}"
-                vm.console_url = f"https://app.pulumi.com/{org_name}/{project_name}/{stack_name}"
-                database.session.commit()
-            else:
-                logger.critical(f"{stack_name} stack name not found on Virtual Machine model")
-
-            flash(f"VM '{stack_name}' successfully updated",
-                  category="success")
-
-        except auto.ConcurrentUpdateError:
-            logger.info(f"{stack_name} already has an udpate in progress")
-            flash(f"VM '{stack_name}' already has an udpate in progress", category="danger")
-
-        except Exception as err:
-            logger.critical(f"An error occurred while updating {stack_name} VM -> {err}")
-            flash("Something went wrong", category="danger")
-
-        return redirect(url_for("virtual_machines.list_vms"))
-
-    stack = auto.select_stack(
-        stack_name=stack_name,
-        project_name=current_app.config["PROJECT_NAME"],
-        # no-op program, just to get outputs
-        program=lambda: None
-    )
+            job = job_queue.submit("vm.update", stack_name, {**params, "force": force}, user_id=current_user.id)
+        except StackBusy as err:
+            logger.info(f"{stack_name} already has an operation in progress")
+            return busy_response(err, "virtual_machines.list_vms",
+                                 f"VM '{stack_name}' already has an operation in progress")
+
+        return queued_response(job, "virtual_machines.list_vms", f"VM '{stack_name}' is being updated")
 
-    outs = stack.outputs()
-    public_key = outs.get("public_keys")
-    pk = public_key.value if public_key else None
-    instance_type = outs.get("instance_type")
+    # outputs are served from the outputs cache, the pulumi CLI only runs on a miss
+    outs = stack_outputs(stack_name)
 
-    return render_template("virtual_machines/update.html", name=stack_name, public_key=pk,
-                           instance_types=instance_types, curr_instance_type=instance_type.value)
+    return render_template("virtual_machines/update.html", name=stack_name, public_key=outs.get("public_key"),
+                           instance_types=instance_types, curr_instance_type=outs.get("instance_type"),
+                           amis=ami_service.choices(vm.region or DEFAULT_REGION), curr_ami=vm.ami or DEFAULT_AMI)
 
 
 @vm_blue_print.route("/<string:id>/delete", methods=["POST"])
@@ -152,32 +396,28 @@ def delete_vm(id: str):
     :param id: vm id
     """
     stack_name = id
+    _owned(VirtualMachines, stack_name)
 
     try:
-        stack = auto.select_stack(
-            stack_name=stack_name,
-            project_name=current_app.config["PROJECT_NAME"],
-            # no-op program, just to get outputs
-            program=lambda: None
-        )
+        job = job_queue.submit("vm.destroy", stack_name, {"stack_name": stack_name}, user_id=current_user.id)
+    except StackBusy as err:
+        logger.info(f"{stack_name} already has an operation in progress")
+        return busy_response(err, "virtual_machines.list_vms",
+                             f"VM '{stack_name}' already has an operation in progress")
 
-        # NOTE: stack.destroy will automatically delete the resource on aws
-        stack.destroy(on_output=logger.info)
-        stack.workspace.remove_stack(stack_name)
+    return queued_response(job, "virtual_machines.list_vms", f"VM '{stack_name}' is being deleted")
 
-        # delete the stack from VirtualMachines model
-        vm = VirtualMachines.query.filter_by(name=stack_name).first()
-        database.session.delete(vm)
-        database.session.commit()
 
-        flash(f"VM '{stack_name}' successfully deleted!", category="success")
-
-    except auto.ConcurrentUpdateError:
-        logger.info(f"{stack_name} deletion is in progress")
-        flash(f"Error: VM '{stack_name}' already has an deletion in progress", category="danger")
-
-    except Exception as err:
-        logger.critical(f"An error occurred while deleting the stack {stack_name} -> {err}")
-        flash("Something went wrong", category="danger")
+@vm_blue_print.route("/delete", methods=["POST"])
+@login_required
+def delete_many_vms():
+    """
+    View handler to delete the selected VMS, or every VM of the user with all=on
+    """
+    query = VirtualMachines.query.filter_by(refrence_key=current_user.id)
+    names = selected_names()
+    if names is not None:
+        query = query.filter(VirtualMachines.name.in_(names))
+    names = [vm.name for vm in query]
 
-    return redirect(url_for("virtual_machines.list_vms"))
+    return teardown_response("vm.teardown", [], names, "virtual_machines.list_vms")
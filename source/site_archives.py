@@ -0,0 +1,133 @@
+import mimetypes
+import posixpath
+import tarfile
+import tempfile
+import zipfile
+
+from source import logger
+from source.blobs import BlobTooLarge, blob_store
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+CHUNK_SIZE = 64 * 1024
+
+
+class ArchiveError(Exception):
+    """
+    Raised when an uploaded site archive can't be used
+    """
+
+
+def is_archive(filename: str) -> bool:
+    """
+    True when the file name looks like a supported site archive
+    :param filename: file name or url path
+    """
+    return (filename or "").lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+class SiteAssets:
+    """
+    Unpacks archive sites into the blob store
+
+    Every file is stored under its sha256, so a redeploy hands pulumi the same
+    FileAsset path for unchanged files and only changed objects are updated.
+    """
+
+    def __init__(self):
+        self.max_bytes = 100 * 1024 * 1024
+        self.max_files = 1000
+
+    def init_app(self, app):
+        """
+        Configure the archive limits from the flask app config
+        :param app: Flask app
+        """
+        self.max_bytes = app.config["SITE_ARCHIVE_MAX_BYTES"]
+        self.max_files = app.config["SITE_ARCHIVE_MAX_FILES"]
+        app.extensions["site_assets"] = self
+
+    def _members(self, fileobj, filename: str):
+        # yield (name, readable) for every regular file, without extracting to disk
+        if filename.lower().endswith(".zip"):
+            with zipfile.ZipFile(fileobj) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        with archive.open(info) as member:
+                            yield info.filename, member
+            return
+
+        # "r|*" reads the tar as a stream, members are only available in order
+        with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+            for info in archive:
+                if info.isfile():
+                    yield info.name, archive.extractfile(info)
+
+    def unpack(self, fileobj, filename: str) -> dict:
+        """
+        Store the files of a zip or tar archive
+        :param fileobj: readable archive, must be seekable for zip files
+        :param filename: archive file name, used to detect the format
+        :return: manifest of object key to {"sha256", "content_type", "size"}
+        """
+        manifest = {}
+        budget = self.max_bytes
+
+        try:
+            for name, member in self._members(fileobj, filename):
+                key = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+                if key.startswith("..") or key == ".":
+                    raise ArchiveError(f"Invalid path '{name}' in site archive")
+
+                if len(manifest) >= self.max_files:
+                    raise ArchiveError(f"Site archive has more than {self.max_files} files")
+
+                try:
+                    sha256, size = blob_store.put_stream(member, limit=budget)
+                except BlobTooLarge:
+                    raise ArchiveError("Site archive is too large")
+                budget -= size
+                content_type, _ = mimetypes.guess_type(key)
+                manifest[key] = {
+                    "sha256": sha256,
+                    "content_type": content_type or "application/octet-stream",
+                    "size": size,
+                }
+        except (zipfile.BadZipFile, tarfile.TarError) as err:
+            raise ArchiveError(f"Could not read site archive -> {err}")
+
+        manifest = _strip_common_root(manifest)
+        if "index.html" not in manifest:
+            raise ArchiveError("Site archive must contain an index.html")
+
+        logger.info(f"Unpacked {len(manifest)} files from {filename}")
+        return manifest
+
+    def unpack_response(self, response, url: str) -> dict:
+        """
+        Spool a streaming archive download in chunks to a temp file and store its files
+        :param response: streaming requests response of the archive
+        :param url: archive url, used to detect the format
+        """
+        with tempfile.TemporaryFile() as tmp:
+            size = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise ArchiveError("Site archive is too large")
+                tmp.write(chunk)
+
+            tmp.seek(0)
+            return self.unpack(tmp, url.split("?")[0])
+
+
+def _strip_common_root(manifest: dict) -> dict:
+    # archives of a folder put every file under that folder, serve its content from the bucket root
+    roots = {key.split("/")[0] for key in manifest}
+    if len(roots) != 1 or all("/" not in key for key in manifest):
+        return manifest
+
+    prefix = f"{roots.pop()}/"
+    return {key[len(prefix):]: entry for key, entry in manifest.items()}
+
+
+site_assets = SiteAssets()
@@ -0,0 +1,179 @@
+import gzip
+import json
+import os
+import posixpath
+import re
+import tempfile
+
+from source import logger
+from source.blobs import CHUNK_SIZE, blob_store
+
+# content types worth compressing, images, fonts and archives already are
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/xml",
+                      "application/xhtml+xml", "image/svg+xml", "application/wasm")
+
+# cache policies per content type, "type/*" matches a whole family and "*" everything else.
+# "immutable" is used for assets served under a hashed file name
+CACHE_CONTROL = {
+    "text/html": "no-cache",
+    "immutable": "public, max-age=31536000, immutable",
+    "*": "public, max-age=3600",
+}
+
+# files that get a hashed copy, the HTML and CSS referencing them is rewritten to it
+HASHED_EXTENSIONS = (".css", ".js", ".mjs", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".svg", ".ico",
+                     ".woff", ".woff2", ".ttf", ".otf", ".eot")
+
+HTML_REFERENCE = re.compile(r"""(\b(?:src|href)\s*=\s*["'])([^"'#?]+)""", re.IGNORECASE)
+CSS_REFERENCE = re.compile(r"""(url\(\s*["']?)([^"')#?]+)""", re.IGNORECASE)
+
+
+def _base_type(content_type: str) -> str:
+    return content_type.split(";")[0].strip().lower()
+
+
+def _hashed_key(key: str, sha256: str) -> str:
+    stem, extension = posixpath.splitext(key)
+    return f"{stem}.{sha256[:12]}{extension}"
+
+
+class SiteBuilder:
+    """
+    Turns the files of a site into the objects uploaded to the bucket
+
+    Static assets get a copy under a content-hashed file name with a long lived
+    immutable cache policy, the HTML and CSS referencing them is rewritten to
+    the hashed names. Text files are stored pre-compressed with their
+    content encoding set; compressed variants are cached on disk by the
+    sha256 of their source, so a redeploy only compresses changed files.
+    """
+
+    def __init__(self):
+        self.encoding = "gzip"
+        self.min_bytes = 1024
+        self.hashed_assets = True
+        self.cache_control = dict(CACHE_CONTROL)
+        self.root = None
+
+    def init_app(self, app):
+        """
+        Configure the builder from the flask app config
+        :param app: Flask app
+        """
+        self.encoding = (app.config["SITE_COMPRESSION"] or "identity").lower()
+        self.min_bytes = app.config["SITE_COMPRESSION_MIN_BYTES"]
+        self.hashed_assets = app.config["SITE_HASHED_ASSETS"]
+        self.cache_control = {**CACHE_CONTROL, **json.loads(app.config.get("SITE_CACHE_CONTROL") or "{}")}
+        self.root = app.config.get("COMPRESSION_CACHE_PATH") or os.path.join(app.instance_path, "compressed")
+        app.extensions["site_builder"] = self
+
+        # sites are served from the http:// website endpoint of the bucket and browsers only
+        # accept br over https, so gzip is the only encoding
+        if self.encoding not in ("gzip", "identity"):
+            logger.warning(f"Unsupported SITE_COMPRESSION '{self.encoding}', falling back to gzip")
+            self.encoding = "gzip"
+
+    def policy(self, content_type: str, immutable: bool = False) -> str:
+        """
+        Cache-Control of an object
+        :param content_type: content type of the object
+        :param immutable: the object is served under a content-hashed name
+        """
+        if immutable:
+            return self.cache_control["immutable"]
+        base_type = _base_type(content_type)
+        family = f"{base_type.split('/')[0]}/*"
+        return self.cache_control.get(base_type) or self.cache_control.get(family) or self.cache_control["*"]
+
+    def _compressed_path(self, sha256: str) -> str:
+        return os.path.join(self.root, self.encoding, sha256[:2], sha256)
+
+    def _compress(self, sha256: str):
+        # compressed variants are keyed by the source content, unchanged files are never recompressed
+        path = self._compressed_path(sha256)
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with open(blob_store.path(sha256), "rb") as source, os.fdopen(fd, "wb") as tmp:
+                # mtime=0 keeps the output, and with it the pulumi asset hash, stable
+                with gzip.GzipFile(fileobj=tmp, mode="wb", compresslevel=9, mtime=0) as compressed:
+                    for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                        compressed.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def _object(self, entry: dict, immutable: bool = False) -> dict:
+        path = blob_store.path(entry["sha256"])
+        content_type = entry["content_type"]
+        obj = {"path": path, "content_type": content_type, "cache_control": self.policy(content_type, immutable)}
+
+        size = entry.get("size")
+        if size is None:
+            size = os.path.getsize(path)
+        if self.encoding == "gzip" and size >= self.min_bytes \
+                and _base_type(content_type).startswith(COMPRESSIBLE_TYPES):
+            compressed_path = self._compress(entry["sha256"])
+            # incompressible content is served as is
+            if os.path.getsize(compressed_path) < size:
+                obj["path"] = compressed_path
+                obj["content_encoding"] = self.encoding
+        return obj
+
+    def _rewrite(self, key: str, entry: dict, hashed: dict, pattern) -> dict:
+        # point the references of an HTML or CSS file at the hashed copies
+        text = blob_store.read_text(entry["sha256"])
+        directory = posixpath.dirname(key)
+
+        def replace(match):
+            reference = match.group(2)
+            if "://" in reference or reference.startswith(("//", "data:", "mailto:")):
+                return match.group(0)
+            target = posixpath.normpath(reference.lstrip("/") if reference.startswith("/")
+                                        else posixpath.join(directory, reference))
+            if target not in hashed:
+                return match.group(0)
+            hashed_name = posixpath.basename(hashed[target])
+            return match.group(1) + posixpath.join(posixpath.dirname(reference), hashed_name)
+
+        rewritten = pattern.sub(replace, text)
+        if rewritten == text:
+            return entry
+        return {**entry, "sha256": blob_store.put_bytes(rewritten.encode()), "size": None}
+
+    def build(self, files: dict) -> dict:
+        """
+        Objects to upload for the files of a site
+        :param files: object key to {"sha256", "content_type", "size"}, see SiteAssets.unpack
+        :return: object key to {"path", "content_type", "cache_control", "content_encoding"}
+        """
+        files = dict(files)
+        hashed = {}
+        if self.hashed_assets:
+            # CSS is rewritten before it is hashed, so it can point at hashed fonts and images
+            assets = [key for key in files if key.lower().endswith(HASHED_EXTENSIONS)]
+            for key in sorted(assets, key=lambda key: key.lower().endswith(".css")):
+                if key.lower().endswith(".css"):
+                    files[key] = self._rewrite(key, files[key], hashed, CSS_REFERENCE)
+                hashed[key] = _hashed_key(key, files[key]["sha256"])
+
+            for key, entry in files.items():
+                if _base_type(entry["content_type"]) in ("text/html", "application/xhtml+xml"):
+                    files[key] = self._rewrite(key, entry, hashed, HTML_REFERENCE)
+
+        # the original names stay available for references that were not rewritten, e.g. from scripts
+        objects = {key: self._object(entry) for key, entry in files.items()}
+        objects.update({hashed_key: self._object(files[key], immutable=True) for key, hashed_key in hashed.items()})
+
+        encoded = sum(1 for obj in objects.values() if obj.get("content_encoding"))
+        logger.info(f"Built {len(objects)} site objects, {len(hashed)} hashed, {encoded} {self.encoding} encoded")
+        return objects
+
+
+site_builder = SiteBuilder()
@@ -0,0 +1,105 @@
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from source import database, logger
+
+
+def database_uri(uri: str) -> str:
+    """
+    Normalize the configured database uri
+    :param uri: SQLALCHEMY_DATABASE_URI, a sqlite file or a server database
+    """
+    # hosting providers still hand out the postgres:// scheme sqlalchemy 1.4+ dropped
+    if uri.startswith("postgres://"):
+        return "postgresql://" + uri[len("postgres://"):]
+    return uri
+
+
+def engine_options(uri: str, config) -> dict:
+    """
+    Engine options for SQLALCHEMY_ENGINE_OPTIONS, sized for the job workers and request threads
+    :param uri: database uri
+    :param config: flask app config
+    """
+    url = make_url(uri)
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            # in-memory databases live in a single connection
+            return {}
+        return {
+            "pool_size": config["DB_POOL_SIZE"],
+            "max_overflow": config["DB_MAX_OVERFLOW"],
+            # wait for the write lock instead of failing with "database is locked"
+            "connect_args": {"timeout": config["SQLITE_BUSY_TIMEOUT"] / 1000},
+        }
+
+    # server databases drop idle connections, check them out alive
+    return {
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": True,
+    }
+
+
+def _sqlite_pragmas(config) -> list:
+    return [
+        # readers no longer block the writer and the writer no longer blocks readers
+        f"PRAGMA journal_mode={config['SQLITE_JOURNAL_MODE']}",
+        # with WAL, NORMAL only syncs at checkpoints and is still safe against corruption
+        f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA busy_timeout={config['SQLITE_BUSY_TIMEOUT']}",
+        "PRAGMA foreign_keys=ON",
+        "PRAGMA temp_store=MEMORY",
+        # negative sizes are in KiB
+        f"PRAGMA cache_size=-{config['SQLITE_CACHE_KB']}",
+    ]
+
+
+def init_storage(app):
+    """
+    Tune every engine of the app and create the schema on first boot
+    :param app: Flask app, `database.init_app` must have run
+    """
+    pragmas = _sqlite_pragmas(app.config)
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+    with app.app_context():
+        for engine in database.engines.values():
+            if engine.dialect.name == "sqlite":
+                event.listen(engine, "connect", on_connect)
+            logger.info(f"Database {engine.url.render_as_string(hide_password=True)}, "
+                        f"pool {engine.pool.__class__.__name__}")
+
+        create_schema()
+
+
+def create_schema():
+    """
+    Create the missing tables, columns and indexes, safe to run from several workers booting at once
+    """
+    from source.models import create_missing_columns, create_missing_indexes
+
+    def create():
+        missing = set(database.metadata.tables) - set(inspect(database.engine).get_table_names())
+        if missing:
+            logger.info(f"Creating tables {', '.join(sorted(missing))}")
+            database.create_all()
+        # databases of older versions lack the columns added since
+        create_missing_columns()
+        create_missing_indexes()
+
+    try:
+        create()
+    except (OperationalError, ProgrammingError) as err:
+        # another worker created a table, column or index between the check and the create
+        logger.info(f"Schema created concurrently, retrying -> {err}")
+        create()
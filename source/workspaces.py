@@ -0,0 +1,181 @@
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+import yaml
+
+from source import logger
+from source.helper_functions import auto, ensure_plugins
+
+
+class WorkspacePoolExhausted(Exception):
+    """
+    Raised when no workspace could be borrowed before the timeout
+    """
+
+
+class WorkspacePool:
+    """
+    Pool of pre-initialized LocalWorkspaces per pulumi project
+
+    Building a LocalWorkspace starts the pulumi CLI to check its version and
+    writes the project settings into a fresh work dir, so routes borrow a warm
+    one instead and hand it back when their stack operation is done.
+    """
+
+    def __init__(self):
+        self.max_size = 4
+        self.max_uses = 100
+        self.timeout = 30.0
+        self.settings_path = None
+        self._idle = {}
+        self._created = {}
+        self._uses = {}
+        self._plugins_checked = False
+        self._condition = threading.Condition()
+
+    def init_app(self, app):
+        """
+        Configure the pool from the flask app config
+        :param app: Flask app
+        """
+        self.max_size = app.config["WORKSPACE_POOL_SIZE"]
+        self.max_uses = app.config["WORKSPACE_MAX_USES"]
+        self.timeout = app.config["WORKSPACE_BORROW_TIMEOUT"]
+        self.settings_path = os.path.join(os.path.dirname(app.root_path), "Pulumi.yaml")
+        app.extensions["workspace_pool"] = self
+
+    def project_settings(self, project_name: str):
+        """
+        Project settings of Pulumi.yaml, renamed to the configured project
+        :param project_name: pulumi project name
+        """
+        settings = {}
+        if self.settings_path and os.path.exists(self.settings_path):
+            with open(self.settings_path, "r") as file:
+                settings = yaml.safe_load(file) or {}
+
+        runtime = settings.get("runtime", "python")
+        if isinstance(runtime, dict):
+            runtime = runtime.get("name", "python")
+
+        return auto.ProjectSettings(name=project_name, runtime=runtime, description=settings.get("description"))
+
+    def _create(self, project_name: str):
+        if not self._plugins_checked:
+            ensure_plugins()
+            self._plugins_checked = True
+
+        workspace = auto.LocalWorkspace(project_settings=self.project_settings(project_name))
+        self._uses[id(workspace)] = 0
+        return workspace
+
+    def _healthy(self, workspace) -> bool:
+        if self._uses.get(id(workspace), 0) >= self.max_uses:
+            return False
+        return os.path.exists(os.path.join(workspace.work_dir, "Pulumi.yaml"))
+
+    def _discard(self, project_name: str, workspace):
+        with self._condition:
+            self._created[project_name] -= 1
+            self._uses.pop(id(workspace), None)
+            self._condition.notify()
+
+        # the work dir is a temp dir LocalWorkspace made for the pool, nothing else uses it
+        if workspace is not None and workspace.work_dir:
+            shutil.rmtree(workspace.work_dir, ignore_errors=True)
+
+    def warm(self, project_name: str, count: int = 1):
+        """
+        Pre-create workspaces so the first requests don't pay for them
+        :param project_name: pulumi project name
+        :param count: number of workspaces to create, capped by the pool size
+        """
+        for _ in range(count):
+            with self._condition:
+                if self._created.get(project_name, 0) >= self.max_size:
+                    return
+                self._created[project_name] = self._created.get(project_name, 0) + 1
+
+            try:
+                workspace = self._create(project_name)
+            except Exception:
+                self._discard(project_name, None)
+                raise
+
+            with self._condition:
+                self._idle.setdefault(project_name, []).append(workspace)
+                self._condition.notify()
+
+    def acquire(self, project_name: str):
+        """
+        Take a healthy workspace out of the pool, creating one while below the size limit
+        :param project_name: pulumi project name
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._condition:
+                idle = self._idle.setdefault(project_name, [])
+                while not idle and self._created.get(project_name, 0) >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise WorkspacePoolExhausted(f"No workspace for '{project_name}' available")
+                    self._condition.wait(remaining)
+
+                workspace = idle.pop() if idle else None
+                if workspace is None:
+                    self._created[project_name] = self._created.get(project_name, 0) + 1
+
+            if workspace is None:
+                try:
+                    return self._create(project_name)
+                except Exception:
+                    self._discard(project_name, None)
+                    raise
+
+            if self._healthy(workspace):
+                return workspace
+
+            logger.info(f"Recycling workspace {workspace.work_dir}")
+            self._discard(project_name, workspace)
+
+    def release(self, project_name: str, workspace):
+        """
+        Hand a workspace back to the pool
+        :param project_name: pulumi project name
+        :param workspace: workspace returned by acquire
+        """
+        workspace.program = None
+        with self._condition:
+            self._uses[id(workspace)] = self._uses.get(id(workspace), 0) + 1
+            self._idle.setdefault(project_name, []).append(workspace)
+            self._condition.notify()
+
+    @contextmanager
+    def borrow(self, project_name: str, program=None):
+        """
+        Borrow a workspace for the duration of a stack operation
+        :param project_name: pulumi project name
+        :param program: inline pulumi program to run in the workspace
+        """
+        workspace = self.acquire(project_name)
+        workspace.program = program
+        try:
+            yield workspace
+        finally:
+            self.release(project_name, workspace)
+
+    def stats(self) -> dict:
+        """
+        Number of created and idle workspaces per project
+        """
+        with self._condition:
+            return {
+                project_name: {"created": created, "idle": len(self._idle.get(project_name, []))}
+                for project_name, created in self._created.items()
+            }
+
+
+workspace_pool = WorkspacePool()
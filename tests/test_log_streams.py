@@ -0,0 +1,59 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from deployments import build_app, issue_tokens  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def app():
+    return build_app(tempfile.mkdtemp(), workers=1)
+
+
+@pytest.fixture(scope="module")
+def job_id(app):
+    token = issue_tokens(app, 1)[0]
+    response = app.test_client().post("/api/v1/sites", json={"name": "logs", "content": "<h1>logs</h1>"},
+                                      headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 202
+    return response.json["id"]
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        # the user issue_tokens created
+        session["_user_id"] = "1"
+        session["_fresh"] = True
+    return client
+
+
+def test_offset_parsing(app):
+    from source.log_streams import LogStreams
+
+    streams = LogStreams()
+    assert streams.offset(None) is None
+    assert streams.offset("") is None
+    assert streams.offset("12") == 12
+    with pytest.raises(ValueError):
+        streams.offset("abc")
+
+
+@pytest.mark.parametrize("query, headers", [
+    ("?offset=abc", {}),
+    ("", {"Last-Event-ID": "1700000000000-0"}),
+])
+def test_stream_rejects_invalid_offset(client, job_id, query, headers):
+    response = client.get(f"/jobs/{job_id}/logs/stream{query}", headers=headers)
+    assert response.status_code == 400
+
+
+def test_stream_from_offset(client, job_id):
+    response = client.get(f"/jobs/{job_id}/logs/stream?offset=0")
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).endswith("event: end\ndata: \n\n")